@@ -24,6 +24,9 @@
 # **************************************************************************
 
 import os
+import subprocess
+import threading
+import types
 import pwem
 import pyworkflow.utils as pwutils
 import getpass
@@ -37,10 +40,23 @@ __version__ = "3.2.0"
 class Plugin(pwem.Plugin):
     _homeVar = CCP4_HOME_VARNAME
     _versions = {'CCP4': [V7_0]}
+    # CCP4 environment, computed once for each CCP4 home and os.environ
+    _ccp4Environ = None
+    _ccp4EnvironKey = None
+    # environment defined by ccp4.setup-sh, computed once for each
+    # setup file, modification time and CCP4 environment
+    _setupEnviron = None
+    _setupEnvironKey = None
+    # steps running in parallel threads share the memos, reentrant
+    # because the setup environment is captured on top of getCcp4Environ
+    _environLock = threading.RLock()
 
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(CCP4_HOME_VARNAME, 'ccp4-7.0.056')
+        cls._defineVar(CCP4_CACHE_MAX_SIZE_VARNAME,
+                       CCP4_CACHE_MAX_SIZE_DEFAULT)
+        cls._defineVar(CCP4_CACHE_SETUP_VARNAME, CCP4_CACHE_SETUP_DEFAULT)
 
     @classmethod
     def getProgram(cls, progName):
@@ -48,25 +64,80 @@ class Plugin(pwem.Plugin):
         return os.path.join(cls.getHome(), 'bin',
                             os.path.basename(progName))
 
+    @classmethod
+    def getCacheMaxSize(cls):
+        """ Return the maximum size (bytes) of each project cache,
+        0 if caches are disabled. """
+        return int(float(cls.getVar(CCP4_CACHE_MAX_SIZE_VARNAME)) * 2**30)
+
     @classmethod
     def getEnviron(cls, first=True):
-        def deleteEnv(name):
-            if name in os.environ:
-                os.environ.pop(name)
+        """ Return a copy of the CCP4 environment, callers may modify it.
+        See getCcp4Environ. """
+        return pwutils.Environ(cls.getCcp4Environ())
+
+    @classmethod
+    def getCcp4Environ(cls):
+        """ Return the environment used to run CCP4 programs as a read
+        only mapping. It is computed the first time and again only if
+        CCP4_HOME or os.environ change; os.environ is not modified. """
+        ccp4Home = cls.getHome()
+        key = (ccp4Home, dict(os.environ))
+        with cls._environLock:
+            if cls._ccp4EnvironKey != key:
+                cls._ccp4Environ = types.MappingProxyType(
+                    dict(cls._computeEnviron(ccp4Home)))
+                cls._ccp4EnvironKey = key
+            return cls._ccp4Environ
+
+    @classmethod
+    def getSetupEnviron(cls):
+        """ Return, as a read only mapping, the whole environment that
+        results from sourcing bin/ccp4.setup-sh (on top of
+        getCcp4Environ). The file is sourced once, and again only if it
+        or the CCP4 environment change. Returns None if CCP4_CACHE_SETUP
+        is False or the environment cannot be captured; scripts must
+        source the setup file then. """
+        if not pwutils.strToBoolean(cls.getVar(CCP4_CACHE_SETUP_VARNAME)):
+            return None
+        setupFileName = os.path.join(cls.getHome(), 'bin',
+                                     CCP4_SETUP_FILENAME)
+        try:
+            key = (setupFileName, os.path.getmtime(setupFileName))
+        except OSError:
+            return None
+        with cls._environLock:
+            key += (cls.getCcp4Environ(),)
+            if cls._setupEnvironKey != key:
+                cls._setupEnviron = cls._captureSetupEnviron(setupFileName)
+                cls._setupEnvironKey = key
+            return cls._setupEnviron
+
+    @classmethod
+    def _captureSetupEnviron(cls, setupFileName):
+        try:
+            output = subprocess.check_output(
+                ['sh', '-c', '. "$0" > /dev/null 2>&1; env -0',
+                 setupFileName],
+                env=dict(cls.getCcp4Environ()), stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        environ = dict(item.split('=', 1)
+                       for item in output.decode().split('\0') if '=' in item)
+        # variables that belong to the shell that sourced the file
+        for name in ['PWD', 'OLDPWD', 'SHLVL', '_']:
+            environ.pop(name, None)
+        return types.MappingProxyType(environ)
 
+    @classmethod
+    def _computeEnviron(cls, _ccp4_home):
         environ = pwutils.Environ(os.environ)
-        #environ = pwutils.Environ()
-        # pos = pwutils.Environ.BEGIN if ccp4First else pwutils.Environ.END
-        _ccp4_home = cls.getHome()
         _ccp4_master, _dir = os.path.split(_ccp4_home)
         _username = getpass.getuser()
 
-        deleteEnv("CCP4_MASTER")
-
         environ.update({
-            'PATH': Plugin.getHome(),
-            'LD_LIBRARY_PATH': str.join(cls.getHome(), 'lib')
-                               + ":" + cls.getHome(),
+            'PATH': os.path.join(_ccp4_home, 'bin'),
+            'LD_LIBRARY_PATH': os.path.join(_ccp4_home, 'lib'),
         }, position=pwutils.Environ.BEGIN)  # add to variable
 
         environ.update({
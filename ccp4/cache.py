@@ -0,0 +1,201 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Project level cache of files created by CCP4 programs.
+
+Each entry is a directory whose name is the hash of a dictionary
+describing how the files were computed (input checksums and program
+parameters). Files are hardlinked (or copied if hardlinks are not
+possible) from/to the protocol directories, so evicting an entry never
+breaks the files of previous runs.
+
+The size of each cache may be bounded, the least recently used entries
+are removed when the bound is exceeded.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+# name of the directory, inside the project Tmp folder, used as cache
+CACHEDIRNAME = 'ccp4_cache'
+# file with the list of files stored in an entry
+MANIFESTFILENAME = 'manifest.json'
+# file with checksums already computed
+CHECKSUMSFILENAME = 'checksums.json'
+
+
+def getProjectCacheDir(protocol, *paths):
+    """ cache directory of the project the protocol belongs to"""
+    # working dir is <project>/Runs/<protocol>
+    projectDir = os.path.dirname(os.path.dirname(
+        os.path.abspath(protocol.getWorkingDir())))
+    return os.path.join(projectDir, 'Tmp', CACHEDIRNAME, *paths)
+
+
+def linkOrCopy(source, dest):
+    """ hardlink source to dest, copy it if this is not possible.
+    Existing dest files are replaced"""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+
+class FileCache():
+    """ content addressed cache of files. maxSize (bytes) bounds the size
+    of the cache, None means no limit"""
+    def __init__(self, cacheDir, maxSize=None):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def getKey(self, keyDict):
+        """ hash of the dictionary that describes an entry"""
+        keyString = json.dumps(keyDict, sort_keys=True)
+        return hashlib.sha1(keyString.encode()).hexdigest()
+
+    def _getEntryPath(self, keyDict, *paths):
+        return os.path.join(self.cacheDir, self.getKey(keyDict), *paths)
+
+    def contains(self, keyDict):
+        return os.path.exists(self._getEntryPath(keyDict, MANIFESTFILENAME))
+
+    def fetch(self, keyDict, destDir):
+        """ link the files of the entry into destDir.
+        Returns False if the entry is not available"""
+        try:
+            with open(self._getEntryPath(keyDict, MANIFESTFILENAME)) as f:
+                fileNames = json.load(f)
+            for fileName in fileNames:
+                linkOrCopy(self._getEntryPath(keyDict, fileName),
+                           os.path.join(destDir, fileName))
+            # entries are evicted by modification time of the manifest
+            os.utime(self._getEntryPath(keyDict, MANIFESTFILENAME))
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def fetchFile(self, keyDict, destFileName):
+        """ link the only file of the entry as destFileName.
+        Returns False if the entry is not available"""
+        try:
+            with open(self._getEntryPath(keyDict, MANIFESTFILENAME)) as f:
+                fileName, = json.load(f)
+            linkOrCopy(self._getEntryPath(keyDict, fileName), destFileName)
+            os.utime(self._getEntryPath(keyDict, MANIFESTFILENAME))
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def storeFile(self, keyDict, sourceFileName):
+        """ store a single file, see fetchFile"""
+        self.store(keyDict, [os.path.basename(sourceFileName)],
+                   os.path.dirname(sourceFileName))
+
+    def store(self, keyDict, fileNames, sourceDir):
+        """ store the files (basenames relative to sourceDir) in the
+        cache. Missing files are ignored"""
+        entryPath = self._getEntryPath(keyDict)
+        if os.path.exists(entryPath):
+            return
+        # fill a temporary directory and rename it, so other processes
+        # never see incomplete entries
+        tmpPath = tempfile.mkdtemp(dir=self.cacheDir, prefix='.tmp')
+        os.chmod(tmpPath, 0o755)
+        stored = []
+        for fileName in fileNames:
+            sourceFileName = os.path.join(sourceDir, fileName)
+            if os.path.exists(sourceFileName):
+                linkOrCopy(sourceFileName, os.path.join(tmpPath, fileName))
+                stored.append(fileName)
+        with open(os.path.join(tmpPath, MANIFESTFILENAME), 'w') as f:
+            json.dump(stored, f)
+        try:
+            os.rename(tmpPath, entryPath)
+        except OSError:
+            # another process stored the same entry
+            shutil.rmtree(tmpPath, ignore_errors=True)
+        if self.maxSize is not None:
+            self.evict(self.maxSize)
+
+    def evict(self, maxSize):
+        """ remove least recently used entries until the cache
+        takes at most maxSize bytes"""
+        entries = []
+        totalSize = 0
+        for name in os.listdir(self.cacheDir):
+            entryPath = os.path.join(self.cacheDir, name)
+            if name.startswith('.') or not os.path.isdir(entryPath):
+                continue
+            try:
+                lastUse = os.path.getmtime(
+                    os.path.join(entryPath, MANIFESTFILENAME))
+                size = sum(os.path.getsize(os.path.join(entryPath, f))
+                           for f in os.listdir(entryPath))
+            except OSError:
+                continue  # entry being evicted by another process
+            entries.append((lastUse, size, entryPath))
+            totalSize += size
+        for lastUse, size, entryPath in sorted(entries):
+            if totalSize <= maxSize:
+                break
+            shutil.rmtree(entryPath, ignore_errors=True)
+            totalSize -= size
+
+    def getFileChecksum(self, fileName, blockSize=1 << 20):
+        """ sha1 of the file content. Checksums are remembered (using
+        the file path, size and modification time) so a file is only
+        read once"""
+        fileName = os.path.realpath(fileName)
+        st = os.stat(fileName)
+        fileId = "%s:%d:%d" % (fileName, st.st_size, st.st_mtime_ns)
+        checksumsFileName = os.path.join(self.cacheDir, CHECKSUMSFILENAME)
+        try:
+            with open(checksumsFileName) as f:
+                checksums = json.load(f)
+        except (OSError, ValueError):
+            checksums = {}
+        if fileId not in checksums:
+            sha1 = hashlib.sha1()
+            with open(fileName, 'rb') as f:
+                for block in iter(lambda: f.read(blockSize), b''):
+                    sha1.update(block)
+            checksums = {k: v for k, v in checksums.items()
+                         if not k.startswith(fileName + ":")}
+            checksums[fileId] = sha1.hexdigest()
+            # unique for each process and thread
+            tmpFileName = "%s.%d.%d" % (checksumsFileName, os.getpid(),
+                                        threading.get_ident())
+            with open(tmpFileName, 'w') as f:
+                json.dump(checksums, f)
+            os.replace(tmpFileName, checksumsFileName)
+        return checksums[fileId]
@@ -1,5 +1,14 @@
 CCP4_HOME_VARNAME='CCP4_HOME'
 CCP4_HOME_DEFAULT='/usr/local/ccp4-7.0'
+# maximum size (GB) of each cache of files created in the project Tmp
+# folder (normalized maps, map to mtz conversions), 0 disables the caches
+CCP4_CACHE_MAX_SIZE_VARNAME='CCP4_CACHE_MAX_SIZE'
+CCP4_CACHE_MAX_SIZE_DEFAULT='20'
+# capture once the environment defined by bin/ccp4.setup-sh instead of
+# sourcing it in each script
+CCP4_CACHE_SETUP_VARNAME='CCP4_CACHE_SETUP'
+CCP4_CACHE_SETUP_DEFAULT='True'
+CCP4_SETUP_FILENAME='ccp4.setup-sh'
 
 #Supported version
 V7_0 = '7.0.056'
@@ -31,10 +31,43 @@ TODO:
 2. Read/Write CCP4 specific files
 """
 
+import math
 import os
+import shutil
+import struct
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
+import numpy as np
 import pyworkflow.utils as pwutils
+from pwem.convert.headers import Ccp4Header
 from ccp4 import Plugin
 
+MRCHEADERSIZE = 1024
+MRCEXTENSIONS = ['.mrc', '.map', '.ccp4']
+# data type of each MRC mode
+MRCMODES = {0: np.dtype('<i1'), 1: np.dtype('<i2'), 2: np.dtype('<f4'),
+            6: np.dtype('<u2')}
+# bytes of map read at once when streaming a map
+SLABSIZE = 1 << 26
+FICLONE = 0x40049409  # linux ioctl that clones (reflinks) a file
+
+
+def getFftSize(n):
+    """ smallest even number >= n without prime factors other than 2, 3
+    and 5, sizes for which the fft programs are fast"""
+    size = max(2, int(math.ceil(n)))
+    while True:
+        if size % 2 == 0:
+            rest = size
+            for factor in (2, 3, 5):
+                while rest % factor == 0:
+                    rest //= factor
+            if rest == 1:
+                return size
+        size += 1
+
 
 def runCCP4Program(program, args="", extraEnvDict=None, cwd=None):
     """ Internal shortcut function to launch a CCP4 program. """
@@ -65,3 +98,228 @@ def validVersion(major=7, minor=0.056, greater=True):
             if _major == major and _minor == minor:
                 return True
     return False
+
+
+def fixMapFile(inFileName, outFileName, scipionOriginShifts, sampling):
+    """ Create outFileName from the map inFileName with the origin (as
+    start pixel) and sampling fixed in the header, like
+    Ccp4Header.fixFile(..., Ccp4Header.START).
+
+    Float32 MRC maps are not converted: if the header does not change a
+    symbolic link to the input is created, otherwise the voxels are
+    cloned (reflink) or copied by the kernel and only the header is
+    rewritten."""
+    inFileName = inFileName.replace(":mrc", "")
+    header = _getFixedMrcHeader(inFileName, scipionOriginShifts, sampling)
+    if header is None:
+        Ccp4Header.fixFile(inFileName, outFileName, scipionOriginShifts,
+                           sampling, Ccp4Header.START)
+        return
+    if os.path.lexists(outFileName):
+        os.remove(outFileName)
+    with open(inFileName, 'rb') as f:
+        if f.read(MRCHEADERSIZE) == header:
+            os.symlink(os.path.abspath(inFileName), outFileName)
+            return
+    with open(inFileName, 'rb') as fIn, open(outFileName, 'wb') as fOut:
+        _cloneFile(fIn, fOut)
+        fOut.seek(0)
+        fOut.write(header)
+
+
+def _readMrcHeader(fileName):
+    """ Return (header, (nc, nr, ns), dtype) of a little endian MRC volume
+    with the standard axis order. header is the first 1024 bytes as a
+    bytearray. None if the file is not such a map"""
+    if os.path.splitext(fileName)[1].lower() not in MRCEXTENSIONS:
+        return None
+    with open(fileName, 'rb') as f:
+        header = bytearray(f.read(MRCHEADERSIZE))
+    if len(header) < MRCHEADERSIZE or header[208:212] != b'MAP ' or \
+            header[212] == 0x11:  # big endian machine stamp
+        return None
+    nc, nr, ns, mode = struct.unpack_from('<4i', header, 0)
+    axes = struct.unpack_from('<3i', header, 64)
+    nsymbt = struct.unpack_from('<i', header, 92)[0]
+    if mode not in MRCMODES or axes != (1, 2, 3) or min(nc, nr, ns) <= 0:
+        return None
+    dtype = MRCMODES[mode]
+    if os.path.getsize(fileName) != \
+            MRCHEADERSIZE + nsymbt + nc * nr * ns * dtype.itemsize:
+        return None
+    return header, (nc, nr, ns), dtype
+
+
+def _getFixedMrcHeader(inFileName, scipionOriginShifts, sampling):
+    """ Return the first 1024 bytes of the map with the header fixed.
+    None if the map is not a float32 MRC volume handled by _readMrcHeader,
+    such maps must be converted"""
+    mrc = _readMrcHeader(inFileName)
+    if mrc is None or mrc[2] != MRCMODES[2]:
+        return None
+    header, (nc, nr, ns), _ = mrc
+    ispg = struct.unpack_from('<i', header, 88)[0]
+    start = [int(round(x / sampling)) for x in scipionOriginShifts]
+    struct.pack_into('<3i', header, 16, *start)  # NCSTART, NRSTART, NSSTART
+    struct.pack_into('<3i', header, 28, nc, nr, ns)  # NX, NY, NZ
+    struct.pack_into('<3f', header, 40,
+                     nc * sampling, nr * sampling, ns * sampling)  # cell
+    struct.pack_into('<3f', header, 196, 0., 0., 0.)  # origin
+    if ispg == 0:
+        struct.pack_into('<i', header, 88, 1)  # volume, not image stack
+    return bytes(header)
+
+
+def _cloneFile(fIn, fOut):
+    """ copy fIn to fOut sharing the data blocks if the file system allows
+    it, otherwise let the kernel copy the data"""
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(fOut.fileno(), FICLONE, fIn.fileno())
+            return
+        except OSError:
+            pass
+    size = os.fstat(fIn.fileno()).st_size
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(fIn.fileno(), fOut.fileno(),
+                                       size - copied, copied, copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return
+        except OSError:
+            pass
+    fIn.seek(0)
+    fOut.seek(0)
+    fOut.truncate()
+    shutil.copyfileobj(fIn, fOut, 1 << 24)
+
+
+def normalizeMrcFile(inFileName, outFileName, slabSize=SLABSIZE):
+    """ Write in outFileName (float32 MRC) the map inFileName divided by
+    its maximum. The map is memory mapped and processed in slabs of
+    sections, one pass computes the statistics and another one scales
+    the map, so memory usage does not depend on the map size.
+    Returns False (and does nothing) if inFileName is not a MRC volume
+    handled by _readMrcHeader"""
+    inFileName = inFileName.replace(":mrc", "")
+    mrc = _readMrcHeader(inFileName)
+    if mrc is None:
+        return False
+    header, (nc, nr, ns), dtype = mrc
+    nsymbt = struct.unpack_from('<i', header, 92)[0]
+    data = np.memmap(inFileName, dtype=dtype, mode='r',
+                     offset=MRCHEADERSIZE + nsymbt, shape=(ns, nr, nc))
+    step = max(1, slabSize // (nr * nc * dtype.itemsize))
+
+    # statistics
+    minValue, maxValue = np.inf, -np.inf
+    total = totalSquares = 0.
+    for first in range(0, ns, step):
+        slab = np.asarray(data[first:first + step], dtype=np.float64)
+        minValue = min(minValue, slab.min())
+        maxValue = max(maxValue, slab.max())
+        total += slab.sum()
+        totalSquares += np.square(slab).sum()
+    n = float(nc) * nr * ns
+    mean = total / n
+    std = np.sqrt(max(totalSquares / n - mean * mean, 0.))
+    scale = 1. / maxValue if maxValue != 0 else 1.
+
+    # scaled map, statistics in the header refer to the new values
+    struct.pack_into('<i', header, 12, 2)  # mode float32
+    struct.pack_into('<3f', header, 76, minValue * scale, maxValue * scale,
+                     mean * scale)
+    struct.pack_into('<f', header, 216, std * abs(scale))
+    with open(inFileName, 'rb') as f:
+        f.seek(MRCHEADERSIZE)
+        extendedHeader = f.read(nsymbt)
+    # a map interrupted while being written is not taken as normalized
+    tmpFileName = outFileName + '.tmp'
+    with open(tmpFileName, 'wb') as f:
+        f.write(header)
+        f.write(extendedHeader)
+        for first in range(0, ns, step):
+            slab = np.multiply(data[first:first + step], scale,
+                               dtype=np.float32)
+            f.write(slab.astype('<f4', copy=False).tobytes())
+    del data
+    os.replace(tmpFileName, outFileName)
+    return True
+
+
+def cropMrcFile(inFileName, outFileName, lower, upper):
+    """ Write in outFileName (float32 MRC) the box of the map inFileName
+    that contains the points between lower and upper ((x, y, z) in
+    Angstroms, in the frame of the map). The box keeps its start, so
+    coordinates valid for inFileName are valid for outFileName, and its
+    cell is the box. The map is memory mapped, only the box is read.
+    Returns False (and does nothing) if inFileName is not a MRC volume
+    handled by _readMrcHeader or the box is the whole map"""
+    inFileName = inFileName.replace(":mrc", "")
+    mrc = _readMrcHeader(inFileName)
+    if mrc is None:
+        return False
+    header, shape, dtype = mrc
+    nsymbt = struct.unpack_from('<i', header, 92)[0]
+    start = struct.unpack_from('<3i', header, 16)
+    grid = struct.unpack_from('<3i', header, 28)
+    cell = struct.unpack_from('<3f', header, 40)
+    first, last = [], []
+    for axis in range(3):
+        sampling = cell[axis] / grid[axis]
+        i0 = max(0, int(math.floor(lower[axis] / sampling)) - start[axis])
+        i1 = min(shape[axis],
+                 int(math.ceil(upper[axis] / sampling)) + 1 - start[axis])
+        if i1 <= i0:
+            return False  # the points are outside the map
+        if (i1 - i0) % 2 and i1 - i0 < shape[axis]:
+            # even sizes, as preferred by the fft programs
+            if i1 < shape[axis]:
+                i1 += 1
+            else:
+                i0 -= 1
+        first.append(i0)
+        last.append(i1)
+    if first == [0, 0, 0] and last == list(shape):
+        return False
+    data = np.memmap(inFileName, dtype=dtype, mode='r',
+                     offset=MRCHEADERSIZE + nsymbt,
+                     shape=(shape[2], shape[1], shape[0]))
+    box = np.asarray(data[first[2]:last[2], first[1]:last[1],
+                          first[0]:last[0]], dtype=np.float32)
+    del data
+    size = [l - f for f, l in zip(first, last)]
+    struct.pack_into('<3i', header, 0, *size)  # NC, NR, NS
+    struct.pack_into('<i', header, 12, 2)  # mode float32
+    struct.pack_into('<3i', header, 16,
+                     *[s + f for s, f in zip(start, first)])
+    struct.pack_into('<3i', header, 28, *size)  # NX, NY, NZ
+    struct.pack_into('<3f', header, 40,
+                     *[n * c / g for n, c, g in zip(size, cell, grid)])
+    struct.pack_into('<3f', header, 76, box.min(), box.max(), box.mean())
+    struct.pack_into('<i', header, 92, 0)  # no extended header
+    struct.pack_into('<f', header, 216, box.std())
+    tmpFileName = outFileName + '.tmp'
+    with open(tmpFileName, 'wb') as f:
+        f.write(header)
+        f.write(box.astype('<f4', copy=False).tobytes())
+    os.replace(tmpFileName, outFileName)
+    return True
+
+
+def setPdbCell(fileName, cell):
+    """ set the cell lengths (a, b, c) of the CRYST1 record of the PDB
+    file fileName"""
+    with open(fileName) as f:
+        lines = f.readlines()
+    for i, line in enumerate(lines):
+        if line.startswith('CRYST1'):
+            lines[i] = "CRYST1%9.3f%9.3f%9.3f%s" % (tuple(cell) +
+                                                    (line[33:],))
+    with open(fileName, 'w') as f:
+        f.writelines(lines)
@@ -1,3 +1,5 @@
 
 from .protocol_refmac import CCP4ProtRunRefmac
+from .protocol_refmac_batch import CCP4ProtRunRefmacBatch
 from .protocol_coot import CootRefine
+from .protocol_coot_batch import CootBatch
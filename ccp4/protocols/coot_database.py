@@ -0,0 +1,204 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Access to the sqlite database shared by scipion and coot. Coot inserts a
+row each time a model is saved and scipion registers these files as
+outputs of the coot protocol.
+
+Connections are kept open (one per thread and database) and use WAL
+journaling, so that coot may write while scipion reads. Both sides wait
+up to TIMEOUT seconds for locks instead of failing with
+"database is locked".
+"""
+
+import os
+import sqlite3
+import threading
+
+# table with the information
+DATABASETABLENAME = 'pdb'
+
+# last id processed by each consumer of the table
+WATERMARKTABLENAME = 'watermark'
+OUTPUTWATERMARK = 'output'
+
+# last version saved of each model, used by coot to name new files
+VERSIONTABLENAME = 'version'
+
+# values of the type column
+TYPE_3DMAP = 0
+TYPE_ATOMSTRUCT = 1
+
+# seconds to wait for a lock held by another connection
+TIMEOUT = 30
+
+_local = threading.local()
+
+
+def getConnection(databasePath):
+    """ return the connection of this thread to databasePath, it is
+    created the first time"""
+    connections = _local.__dict__.setdefault('connections', {})
+    key = os.path.abspath(databasePath)
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(key, timeout=TIMEOUT)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass  # WAL is not supported by some network file systems
+        conn.execute('PRAGMA busy_timeout=%d' % (TIMEOUT * 1000))
+        connections[key] = conn
+    return conn
+
+
+def closeConnection(databasePath):
+    """ close the connection of this thread to databasePath"""
+    connections = _local.__dict__.get('connections', {})
+    conn = connections.pop(os.path.abspath(databasePath), None)
+    if conn is not None:
+        conn.close()
+
+
+class CootDataBase():
+    """ files saved by coot. Each row has
+         id: increases with each saved file
+         modelId: coot model id (imol)
+         fileName, labelName: file and name of the scipion output
+         type: TYPE_3DMAP or TYPE_ATOMSTRUCT
+         saved: 0 if the file has not been registered in scipion yet
+    """
+    def __init__(self, databasePath, tableName=DATABASETABLENAME):
+        self.databasePath = databasePath
+        self.tableName = tableName
+
+    def getConnection(self):
+        return getConnection(self.databasePath)
+
+    def createTables(self):
+        """ create table, indexes and views if they do not exist"""
+        conn = self.getConnection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS %s
+                               (id integer primary key AUTOINCREMENT,
+                                modelId integer,
+                                fileName text,
+                                labelName text,
+                                type int,
+                                saved integer default 1
+                                )""" % self.tableName)
+            conn.execute("CREATE INDEX IF NOT EXISTS %s_type_saved "
+                         "ON %s (type, saved)"
+                         % (self.tableName, self.tableName))
+            conn.execute("CREATE INDEX IF NOT EXISTS %s_modelId_id "
+                         "ON %s (modelId, id)"
+                         % (self.tableName, self.tableName))
+            # last row processed by scipion (high watermark)
+            conn.execute("CREATE TABLE IF NOT EXISTS %s "
+                         "(name text primary key, lastId integer)"
+                         % WATERMARKTABLENAME)
+            conn.execute("CREATE TABLE IF NOT EXISTS %s "
+                         "(modelId integer primary key, lastVersion integer)"
+                         % VERSIONTABLENAME)
+            # id of the last copy for each model id (coot call imol to
+            # this id)
+            conn.execute("""CREATE VIEW IF NOT EXISTS lastid AS
+                            SELECT modelId, max(id) as id
+                            FROM %s
+                            GROUP BY modelId""" % self.tableName)
+
+    def tableExists(self):
+        if not os.path.exists(self.databasePath):
+            return False
+        cursor = self.getConnection().execute(
+            "SELECT COUNT(*) FROM sqlite_master "
+            "WHERE type='table' AND name=?", (self.tableName,))
+        return cursor.fetchone()[0] == 1
+
+    def insertFiles(self, rows):
+        """ rows are (modelId, fileName, labelName, type, saved) tuples"""
+        conn = self.getConnection()
+        with conn:
+            conn.executemany("INSERT INTO %s "
+                             "(modelId, fileName, labelName, type, saved) "
+                             "VALUES (?, ?, ?, ?, ?)" % self.tableName,
+                             rows)
+
+    def insertFile(self, modelId, fileName, labelName, type, saved=0):
+        self.insertFiles([(modelId, fileName, labelName, type, saved)])
+
+    def getWatermark(self, name=OUTPUTWATERMARK):
+        """ id of the last row already processed by name"""
+        cursor = self.getConnection().execute(
+            "SELECT lastId FROM %s WHERE name = ?" % WATERMARKTABLENAME,
+            (name,))
+        row = cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    def getUnsavedFilesAfter(self, lastId):
+        """ (id, modelId, fileName, labelName, type) of the files not
+        registered in scipion with id > lastId. Only the new rows are read
+        (primary key range)"""
+        cursor = self.getConnection().execute(
+            "SELECT id, modelId, fileName, labelName, type FROM %s "
+            "WHERE id > ? AND saved = 0 ORDER BY id" % self.tableName,
+            (lastId,))
+        return cursor.fetchall()
+
+    def setSavedUpTo(self, lastId, newLastId, name=OUTPUTWATERMARK):
+        """ mark the files with lastId < id <= newLastId as registered in
+        scipion and move the watermark to newLastId"""
+        conn = self.getConnection()
+        with conn:
+            conn.execute("UPDATE %s SET saved = 1 "
+                         "WHERE id > ? AND id <= ? AND saved = 0"
+                         % self.tableName, (lastId, newLastId))
+            conn.execute("INSERT OR REPLACE INTO %s (name, lastId) "
+                         "VALUES (?, ?)" % WATERMARKTABLENAME,
+                         (name, newLastId))
+
+    def getLastFileNames(self, type):
+        """ last saved file of each model, by model id"""
+        cursor = self.getConnection().execute(
+            "SELECT fileName FROM %s WHERE id IN "
+            "(SELECT max(id) FROM %s WHERE type = ? GROUP BY modelId) "
+            "ORDER BY modelId" % (self.tableName, self.tableName), (type,))
+        return [row[0] for row in cursor]
+
+    def getLastFileName(self, labelName):
+        """ last saved file with labelName, None if none"""
+        cursor = self.getConnection().execute(
+            "SELECT fileName FROM %s WHERE labelName = ? "
+            "ORDER BY id DESC LIMIT 1" % self.tableName, (labelName,))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def getSavedFileNames(self):
+        """ files registered in scipion, in save order"""
+        cursor = self.getConnection().execute(
+            "SELECT fileName FROM %s WHERE saved = 1 ORDER BY id"
+            % self.tableName)
+        return [row[0] for row in cursor]
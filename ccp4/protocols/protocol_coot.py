@@ -24,22 +24,28 @@
 # **************************************************************************
 
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pyworkflow.utils as pwutils
+import pyworkflow.protocol.constants as const
 from pyworkflow import VERSION_1_2
 from pwem.objects import Volume, EMObject
 from pwem.objects import AtomStruct
 from pwem.emlib.image import ImageHandler
 from pwem.convert import Ccp4Header
 from ccp4 import Plugin
-from ccp4.convert import (runCCP4Program, validVersion)
+from ccp4.convert import (runCCP4Program, validVersion, normalizeMrcFile)
+from ccp4.cache import FileCache, getProjectCacheDir
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.constants import STATUS_FINISHED
 from pyworkflow.protocol.params import (MultiPointerParam, PointerParam,
                                         BooleanParam, StringParam)
 from pyworkflow.utils.properties import Message
 from ccp4.constants import CCP4_BINARIES
-import sqlite3
+from .coot_database import (CootDataBase, DATABASETABLENAME, TYPE_3DMAP,
+                            TYPE_ATOMSTRUCT, TIMEOUT, VERSIONTABLENAME,
+                            closeConnection)
 
 
 # template for new atomic models, first ID is the coot model id
@@ -48,12 +54,14 @@ COOTPDBTEMPLATEFILENAME = "coot_%06d_Imol_%04d_version_%04d.pdb" # protId, model
 # filename for coot script file
 COOTSCRIPTFILENAME = "cootScript.py"
 # database that stores filenames and corresponding models
+# (table DATABASETABLENAME, see coot_database)
 OUTPUTDATABASENAMESWITHLABELS = "outpuDataBaseNameWithLabels.sqlite"
-#table with the information
-DATABASETABLENAME = 'pdb'
 
-TYPE_3DMAP = 0
-TYPE_ATOMSTRUCT = 1
+# maps normalized at the same time
+NORMALIZETHREADS = 4
+
+# seconds between checks of the database while coot is running
+WATCHERINTERVAL = 2
 
 
 class CootRefine(EMProtocol):
@@ -92,6 +100,22 @@ the pdb file from coot  to scipion '
                       label='Other reference atomic structures',
                       help="Other PDBx/mmCIF files used as reference. These PDBx/mmCIF "
                            "objects will not be saved")
+        form.addParam('onlyLastVersion', BooleanParam, default=False,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      label='Register only last version',
+                      help='If set to True, only the last version saved of '
+                           'each coot model is registered as output each '
+                           'time coot is closed. Otherwise every saved file '
+                           'is a new output.')
+        form.addParam('registerWhileRunning', BooleanParam, default=False,
+                      condition='not onlyLastVersion',
+                      expertLevel=const.LEVEL_ADVANCED,
+                      label='Register outputs while coot runs',
+                      help='If set to True, the atomic structures saved in '
+                           'coot are registered as outputs as soon as they '
+                           'are saved, so other protocols may use them '
+                           'before coot is closed. Not possible if only the '
+                           'last version is registered.')
         form.addParam('extraCommands', StringParam,
                       default='',
                       condition='False',
@@ -162,93 +186,40 @@ the pdb file from coot  to scipion '
         # create database and table
         # this table will be used to record the last version of any file
         # save in coot
-        conn = sqlite3.connect(databasePath)
-
-        # create table
         # saved = 0, means this file need to be converted to a scipion object
         # type  = 0-> Map, 1 -> atom struct
-        # predefined macros for type:
-        # TYPE_3DMAP = 0
-        # TYPE_ATOMSTRUCT = 1
-
-        sqlCommand = """create table if not exists %s 
-                               (id integer primary key AUTOINCREMENT,
-                                modelId integer,
-                                fileName text,
-                                labelName text,
-                                type int,
-                                saved integer default 1
-                                )""" % (DATABASETABLENAME)
-
-        conn.execute(sqlCommand)
-
-        # create view to retrieve the id of the last copy
-        # for each model id  (coot call imol to this id)
-        sqlCommand = """CREATE VIEW lastid AS 
-                        SELECT modelId, max(id) as id
-                        FROM %s
-                        GROUP BY modelId
-        """ % DATABASETABLENAME
-
-        conn.execute(sqlCommand)
+        db = CootDataBase(databasePath)
+        db.createTables()
 
         inVolumes, norVolumesNames = self._getVolumesList()
-
-        sqlCommand = """INSERT INTO %s (modelId, fileName, labelName, type, saved) values
-                        (%d, '%s', '%s', %d, %d)"""
+        rows = []
 
         #process main atomic Structure
         counter=0
         pdbFileToBeRefined = self.pdbFileToBeRefined.get().getFileName()
         base = os.path.basename(pdbFileToBeRefined)
-        conn.execute(sqlCommand % (DATABASETABLENAME, counter, pdbFileToBeRefined,
-                                   os.path.splitext(base)[0], TYPE_ATOMSTRUCT, 1 # saved
-                                   )
-                     )
+        rows.append((counter, pdbFileToBeRefined, os.path.splitext(base)[0],
+                     TYPE_ATOMSTRUCT, 1))  # saved
         counter += 1
 
         # Process another atom structures
         for pdb in self.inputPdbFiles:
             fileName = pdb.get().getFileName()
             base = os.path.basename(fileName)
-            conn.execute(sqlCommand % (DATABASETABLENAME, counter,
-                                       fileName,
-                                       os.path.splitext(base)[0], TYPE_ATOMSTRUCT,
-                                       1 # saved
-                                       )
-                         )
+            rows.append((counter, fileName, os.path.splitext(base)[0],
+                         TYPE_ATOMSTRUCT, 1))  # saved
             counter += 1
 
         # Process 3D maps
         # normalize them if needed
-        ih = ImageHandler()
-        for inVol, norVolName in zip(inVolumes, norVolumesNames):
-            inVolName = inVol.getFileName()
-
-            if inVolName.endswith(".mrc"):
-                inVolName += ":mrc"
-            if norVolName.endswith(".mrc"):
-                norVolName += ":mrc"
-            if not ih.existsLocation(norVolName):
-                if True:  # self.doNormalize:
-                    img = ImageHandler()._img
-                    img.read(inVolName)
-                    mean, dev, min, max = img.computeStats()
-                    img.inplaceMultiply(1./max)
-                    img.write(norVolName)
-                else:
-                    ImageHandler().convert(inVolName, norVolName)
-                Ccp4Header(norVolName, readHeader=True).copyCCP4Header(
-                    inVol.getOrigin(force=True).getShifts(),
-                    inVol.getSamplingRate(), originField=Ccp4Header.START)
-
-            conn.execute(sqlCommand%(DATABASETABLENAME, counter, norVolName[:-4],
-                                     os.path.basename(norVolName)[:-8], TYPE_3DMAP, 0 # saved
-                                     )
-                         )
+        self._normalizeVolumes(inVolumes, norVolumesNames)
+        for norVolName in norVolumesNames:
+            rows.append((counter, norVolName,
+                         os.path.basename(norVolName)[:-4], TYPE_3DMAP,
+                         0))  # saved
             counter += 1
 
-        conn.commit()
+        db.insertFiles(rows)
 
     def runCootStep(self):
 
@@ -278,6 +249,14 @@ the pdb file from coot  to scipion '
         # script with auxiliary files
         self._log.info('Launching: ' + Plugin.getProgram(self.COOT) + ' ' + args)
 
+        # files saved in coot are registered while coot is running
+        stopWatcher = threading.Event()
+        watcher = threading.Thread(target=self._watchOutputs,
+                                   args=(stopWatcher,), daemon=True)
+        if (self.registerWhileRunning.get() and
+                not self.onlyLastVersion.get()):
+            watcher.start()
+
         # run in the background
         try:
             runCCP4Program(Plugin.getProgram(self.COOT), args)
@@ -286,30 +265,74 @@ the pdb file from coot  to scipion '
             print(pwutils.redStr("ERROR: Coot execution failed"))
             print(pwutils.redStr("Last SAVED atomic model will be shown if protocol is continued"))
             print(pwutils.redStr("=============================================================="))
- 
+
+        if watcher.is_alive():
+            stopWatcher.set()
+            watcher.join()
         self.createOutput()
 
     def createOutput(self):
         """ Copy the PDB structure and register the output object.
         """
+        self._registerNewOutputs(cootClosed=True)
+
+        if os.path.isfile(self._getExtraPath('STOPPROTCOL')):
+            self.setStatus(STATUS_FINISHED)
+            # NOTE: (ROB) can a dirty way to make an interactive process finish but I do not
+            # think there is a clean one
+            self._steps[self.step-1].setInteractive(False)
+
+    def _watchOutputs(self, stopWatcher):
+        """ register new outputs each time the database changes, until
+        stopWatcher is set. Runs in its own thread while coot is running,
+        the main thread is waiting for coot meanwhile"""
+        databasePath = self._getExtraPath(OUTPUTDATABASENAMESWITHLABELS)
+        lastStamp = None
+        while not stopWatcher.wait(WATCHERINTERVAL):
+            # coot writes the WAL file, the database itself changes
+            # when it is checkpointed
+            stamp = []
+            for fileName in [databasePath, databasePath + '-wal']:
+                if os.path.exists(fileName):
+                    st = os.stat(fileName)
+                    stamp.append((st.st_mtime, st.st_size))
+            if stamp == lastStamp:
+                continue
+            lastStamp = stamp
+            try:
+                self._registerNewOutputs()
+            except Exception as e:
+                print(pwutils.redStr("Cannot register coot outputs: %s" % e))
+        closeConnection(databasePath)
+
+    def _registerNewOutputs(self, cootClosed=False):
+        """ register as outputs the files saved since the last call. If
+        only the last version of each model is registered, nothing is done
+        until coot is closed, so the versions saved in the whole coot
+        session are compared"""
+        if self.onlyLastVersion.get() and not cootClosed:
+            return
         databasePath = self._getExtraPath(OUTPUTDATABASENAMESWITHLABELS)
-        getModels(databasePath, DATABASETABLENAME)
 
         # open database
-        conn = sqlite3.connect(databasePath)
-        if not _checkTableExists(conn, DATABASETABLENAME):
-            conn.close()
+        db = CootDataBase(databasePath)
+        if not db.tableExists():
             return
-
-        c = conn.cursor()
+        db.createTables()  # databases created by older versions
+
+        # only rows saved since the last call are read
+        lastId = db.getWatermark()
+        rows = db.getUnsavedFilesAfter(lastId)
+        atomStructRows = [row for row in rows if row[4] == TYPE_ATOMSTRUCT]
+        if self.onlyLastVersion.get():
+            # last saved version of each model
+            lastRows = {}
+            for row in atomStructRows:
+                lastRows[row[1]] = row
+            atomStructRows = sorted(lastRows.values())
 
         # read atom struct filename and label in a loop
-        c.execute('SELECT fileName, labelName '
-                  'FROM %s '
-                  'WHERE saved = 0 AND type=%d' % (DATABASETABLENAME, TYPE_ATOMSTRUCT))
-        for row in c:
-            pdbFileName = row[0]
-            pdbLabelName = row[1]
+        for _, _, pdbFileName, pdbLabelName, _ in atomStructRows:
             pdb = AtomStruct()
             pdb.setFileName(pdbFileName)
 
@@ -317,26 +340,8 @@ the pdb file from coot  to scipion '
             self._defineOutputs(**outputs)
             self._defineSourceRelation(self.inputPdbFiles, pdb)
 
-        # files has been saved
-        sql = 'UPDATE %s SET saved = 1 WHERE saved=0 ' \
-              'AND type=%d' % (DATABASETABLENAME, TYPE_ATOMSTRUCT)
-        c.execute(sql)
-
         # check if normalized files are saved
-        sql = "SELECT count(*) " \
-              "FROM %s " \
-              "WHERE saved = 0 " \
-              "  AND type = %d LIMIT 1" % (DATABASETABLENAME, TYPE_3DMAP)
-        c.execute(sql)
-        result = c.fetchone()[0]
-
-        # update  saved parameter
-        if result>0:
-            sql = 'UPDATE %s SET saved = 1 WHERE saved=0 ' \
-                  'AND type=%d' % (DATABASETABLENAME, TYPE_3DMAP)
-            c.execute(sql)
-        conn.commit()
-        conn.close()
+        result = len([row for row in rows if row[4] == TYPE_3DMAP])
 
         # save normalized  vols...
         if result>0:
@@ -361,11 +366,9 @@ the pdb file from coot  to scipion '
         else:
             print("skip save normalized vol")
 
-        if os.path.isfile(self._getExtraPath('STOPPROTCOL')):
-            self.setStatus(STATUS_FINISHED)
-            # NOTE: (ROB) can a dirty way to make an interactive process finish but I do not
-            # think there is a clean one
-            self._steps[self.step-1].setInteractive(False)
+        # files has been saved
+        if rows:
+            db.setSavedUpTo(lastId, rows[-1][0])
 
     # --------------------------- INFO functions ---------------------------
     def _validate(self):
@@ -438,6 +441,57 @@ the pdb file from coot  to scipion '
 
         return inVolumes, norVolumesNames
 
+    def _normalizeVolumes(self, inVolumes, norVolumesNames):
+        """ divide each map by its maximum, maps already normalized are
+        skipped. Normalized maps are kept in a project cache and reused
+        by later runs. MRC maps are streamed (see normalizeMrcFile) and
+        several of them are processed at the same time, other formats are
+        read by ImageHandler
+        """
+        pending = [(inVol, norVolName) for inVol, norVolName
+                   in zip(inVolumes, norVolumesNames)
+                   if not os.path.exists(norVolName)]
+        cache = None
+        if Plugin.getCacheMaxSize():
+            cache = FileCache(getProjectCacheDir(self, 'normalized'),
+                              Plugin.getCacheMaxSize())
+            missing = []
+            for inVol, norVolName in pending:
+                if not cache.fetchFile(self._getNormalizedCacheKey(
+                        cache, inVol), norVolName):
+                    missing.append((inVol, norVolName))
+            pending = missing
+
+        with ThreadPoolExecutor(max_workers=NORMALIZETHREADS) as executor:
+            futures = [executor.submit(normalizeMrcFile, inVol.getFileName(),
+                                       norVolName)
+                       for inVol, norVolName in pending]
+            normalized = [future.result() for future in futures]
+
+        for (inVol, norVolName), done in zip(pending, normalized):
+            if not done:
+                inVolName = inVol.getFileName()
+                if inVolName.endswith(".mrc"):
+                    inVolName += ":mrc"
+                img = ImageHandler()._img
+                img.read(inVolName)
+                mean, dev, min, max = img.computeStats()
+                img.inplaceMultiply(1./max)
+                img.write(norVolName + ":mrc")
+            Ccp4Header(norVolName, readHeader=True).copyCCP4Header(
+                inVol.getOrigin(force=True).getShifts(),
+                inVol.getSamplingRate(), originField=Ccp4Header.START)
+            if cache is not None:
+                cache.storeFile(self._getNormalizedCacheKey(cache, inVol),
+                                norVolName)
+
+    def _getNormalizedCacheKey(self, cache, inVol):
+        """ values that determine a normalized map"""
+        return {'map': cache.getFileChecksum(
+                    inVol.getFileName().replace(":mrc", "")),
+                'sampling': inVol.getSamplingRate(),
+                'origin': list(inVol.getOrigin(force=True).getShifts())}
+
     def _getVolumeFileName(self, inFileName):
         return os.path.join(self._getExtraPath(''),
                             pwutils.replaceBaseExt(inFileName, 'mrc'))
@@ -445,16 +499,16 @@ the pdb file from coot  to scipion '
     def replace_at_index(self, tup, ix, val):
         return tup[:ix] + (val,) + tup[ix+1:]
 
-    def getCounter(self):
-        template = self._getExtraPath(COOTPDBTEMPLATEFILENAME)
-        counter = 1
-        while os.path.isfile(template % counter):
-            counter += 1
-        return counter  # returns next free
-
 cootScriptHeader = '''import ConfigParser
 import os
 import subprocess
+import threading
+import time
+import atexit
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 try:
     import coot_python
     has_gui = True
@@ -472,9 +526,17 @@ cootPath='{cootFileName}'
 editorPath='{editorFileName}'
 databasePath='{outpuDataBaseNameWithLabels}'
 table_name = '{table_name}'
+version_table_name = '{version_table_name}'
 TYPE_3DMAP = {TYPE_3DMAP}
 TYPE_ATOMSTRUCT = {TYPE_ATOMSTRUCT}
 protId={protId}
+dbTimeout = {TIMEOUT}
+# rows saved within dbFlushInterval seconds are inserted together
+dbFlushInterval = 0.5
+dbQueue = Queue.Queue()
+dbWorker = None
+dbLocal = threading.local()
+modelVersions = {{}}
 '''
 
 cootScriptBody = '''
@@ -484,9 +546,12 @@ def beep(time):
       This system call seems to work pretty well if you have sox
       installed"""
    try:
-      command = "play --no-show-progress -n synth %f sin 880"%time
-      # print command
-      os.system(command)
+      command = ["play", "--no-show-progress", "-n",
+                 "synth", "%f" % time, "sin", "880"]
+      # do not wait for the sound
+      devnull = open(os.devnull, "w")
+      subprocess.Popen(command, stdout=devnull, stderr=devnull)
+      devnull.close()
    except:
       pass
 
@@ -561,46 +626,131 @@ def _updateMol():
 
 def getOutPutFileName(template, imol):
     """get name based on template that does not exists
-    %04d will be incremented untill it does not exists"""
+    %04d is the next version of model imol, so usually a single
+    file is checked"""
     counter=1
     if "%04d" in template:
+        counter = nextVersion(template, imol)
         while os.path.isfile(template%(protId, imol, counter)):
-             counter += 1
+             counter = nextVersion(template, imol)
 
     return template % (protId, imol, counter)
 
+def nextVersion(template, imol):
+    """increment and return the last version of model imol. The
+    database is only read the first time a model is saved (files written
+    by previous versions of the protocol are looked for if the model is
+    not there), new versions are stored by the database worker"""
+    if imol not in modelVersions:
+        conn = getDataBaseConnection()
+        row = conn.execute('select lastVersion from ' + version_table_name +
+                           ' where modelId = ?', (imol,)).fetchone()
+        if row is None:
+            counter = 1
+            while os.path.isfile(template%(protId, imol, counter)):
+                 counter += 1
+            modelVersions[imol] = counter - 1
+        else:
+            modelVersions[imol] = row[0]
+    modelVersions[imol] += 1
+    _enqueue(('version', imol, modelVersions[imol]))
+    return modelVersions[imol]
+
+def getDataBaseConnection():
+    """connection of this thread to the scipion database, kept open.
+    WAL journaling lets scipion read while coot writes"""
+    conn = getattr(dbLocal, 'connection', None)
+    if conn is None:
+        import sqlite3
+        conn = sqlite3.connect(databasePath, timeout=dbTimeout)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        conn.execute('create table if not exists ' + version_table_name +
+                     ' (modelId integer primary key,'
+                     ' lastVersion integer)')
+        conn.commit()
+        dbLocal.connection = conn
+    return conn
+
+def _enqueue(item):
+    """hand item to the database worker, started the first time"""
+    global dbWorker
+    if dbWorker is None:
+        dbWorker = threading.Thread(target=_dataBaseWorker)
+        dbWorker.daemon = True
+        dbWorker.start()
+    dbQueue.put(item)
+
+def _dataBaseWorker():
+    """write the queued rows, in a single transaction for all the rows
+    queued within dbFlushInterval seconds. Runs outside the GUI thread
+    so that saving never waits for the (maybe remote) database"""
+    while True:
+        items = [dbQueue.get()]
+        deadline = time.time() + dbFlushInterval
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(dbQueue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        rows = []
+        versions = {}
+        events = []
+        for item in items:
+            if item[0] == 'file':
+                rows.append(item[1])
+            elif item[0] == 'version':
+                versions[item[1]] = max(item[2], versions.get(item[1], 0))
+            else:
+                events.append(item[1])
+        try:
+            _writeDataBase(rows, versions)
+        except Exception as e:
+            print("ERROR: cannot write to %s: %s" % (databasePath, e))
+        for event in events:
+            event.set()
+
+def _writeDataBase(rows, versions):
+    conn = getDataBaseConnection()
+    try:
+        for imol, version in versions.items():
+            cursor = conn.execute('update ' + version_table_name +
+                                  ' set lastVersion = max(lastVersion, ?)'
+                                  ' where modelId = ?', (version, imol))
+            if cursor.rowcount == 0:
+                conn.execute('insert into ' + version_table_name +
+                             ' (modelId, lastVersion) values (?, ?)',
+                             (imol, version))
+        conn.executemany('insert into ' + table_name +
+                         ' (modelId, fileName, labelName, type, saved)'
+                         ' values (?, ?, ?, ?, ?)', rows)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def flushDataBase(timeout=dbTimeout):
+    """wait until the queued rows are in the database"""
+    if dbWorker is None:
+        return
+    event = threading.Event()
+    dbQueue.put(('flush', event))
+    event.wait(timeout)
+
+atexit.register(flushDataBase)
+
 def storeFileNameDataBase(imol, outFileName, outLabel=None, type=TYPE_ATOMSTRUCT):
-    import sqlite3
-    conn = sqlite3.connect(databasePath)
-    c = conn.cursor()
-    # create_database if it does not exists
-    # in new version database is always created
-    # sqlCommand = """create table if not exists %s 
-    #                       (id integer primary key AUTOINCREMENT,
-    #                        modelId integer,
-    #                        fileName text,
-    #                        labelName text,
-    #                        type int,
-    #                        saved integer default 1
-    #                        )""" % (DATABASETABLENAME)
-    #
-    # conn.execute(sqlCommand)
-    
-    # insert record
+    """queue the record of a saved file, see _dataBaseWorker"""
     if outLabel is None:
         outLabel = os.path.splitext(os.path.basename(outFileName))[0]
 
-    # sqlCommand = """INSERT INTO %s (modelId, fileName, labelName, type, saved) values
-    #                     (%d, '%s', '%s', %d)"""
     saved = 0 # saved = 0 -> This file has not been aaded to scipion
-    sql = 'insert into ' + table_name + """ (modelId, fileName, labelName, type, saved) values
-                                            (%d, '%s', '%s', %d, %d)""" % (imol, outFileName, outLabel, type, saved)
-    c.execute(sql)
-
-    # commit
-    conn.commit()
-    # close connection
-    conn.close()
+    _enqueue(('file', (imol, outFileName, outLabel, type, saved)))
 
 def _write(imol=-1, outLabel=None):
     """write pdb file, default names
@@ -628,7 +778,7 @@ def _write(imol=-1, outLabel=None):
     
     if os.path.isfile(outFileName):
         type = TYPE_ATOMSTRUCT
-        storeFileNameDataBase(imol, outFileName, outLabel, type)
+        storeFileNameDataBase(aa_imol, outFileName, outLabel, type)
         add_status_bar_text("Saved imol: %(imol)s as %(outfile)s" % dic)
     else:
         add_status_bar_text("I do not know how to export a 3D map. File NOT saved.")
@@ -650,6 +800,78 @@ def scipion_write(imol=0, outLabel=None):
     global mydict
     mydict['imol']=imol
     _write(imol, outLabel)
+    # scripts usually exit coot just after writing
+    flushDataBase()
+
+def refine_windows(imol, chain, size=10, overlap=2):
+    """real space refine chain in windows of size residues,
+    consecutive windows share overlap residues"""
+    first = first_residue_in_chain(imol, chain)
+    last = last_residue_in_chain(imol, chain)
+    start = first
+    while start <= last:
+        end = min(start + size - 1, last)
+        refine_zone(imol, chain, start, end, "")
+        accept_regularizement()
+        if end == last:
+            break
+        start = end - overlap + 1
+
+def refine_chain(imol, chain):
+    """real space refine the whole chain"""
+    refine_zone(imol, chain, first_residue_in_chain(imol, chain),
+                last_residue_in_chain(imol, chain), "")
+    accept_regularizement()
+
+def fit_chain(imol, chain):
+    """rigid body fit of the chain"""
+    rigid_body_refine_by_atom_selection(imol, "//%s" % chain)
+    accept_regularizement()
+
+batchOperations = {'refine_windows': refine_windows,
+                   'refine_chain': refine_chain,
+                   'fit_chain': fit_chain}
+
+def scipion_batch(imol, chain, operations, outLabel):
+    """apply operations ([name, arg1, ...] lists) to chain of model imol,
+    remove the other chains and write the result.
+    This function is used by the coot batch protocol"""
+    set_refinement_immediate_replacement(1)
+    for operation in operations:
+        name, args = operation[0], operation[1:]
+        if name == 'change_chain_id':
+            change_chain_id(imol, chain, args[0], 0, 0, 0)
+            chain = args[0]
+        else:
+            batchOperations[name](imol, chain, *args)
+    for otherChain in chain_ids(imol):
+        if otherChain != chain:
+            delete_chain(imol, otherChain)
+    scipion_write(imol, outLabel)
+
+def scipion_merge(imols, outLabel):
+    """merge models imols into the first one and write it"""
+    if len(imols) > 1:
+        merge_molecules(imols[1:], imols[0])
+    scipion_write(imols[0], outLabel)
+
+def scipion_refine_windows(imol, windows, outLabel):
+    """real space refine the [chain, first, last] windows of model imol
+    and write it. This function is used by the coot batch protocol"""
+    set_refinement_immediate_replacement(1)
+    for chain, first, last in windows:
+        refine_zone(imol, chain, first, last, "")
+        accept_regularizement()
+    scipion_write(imol, outLabel)
+
+def scipion_replace_windows(imol, fragments, outLabel):
+    """copy into model imol the windows refined in other models,
+    fragments is a list of [imolFragment, windows], and write it"""
+    for imolFragment, windows in fragments:
+        for chain, first, last in windows:
+            replace_fragment(imol, imolFragment,
+                             "//%s/%d-%d" % (chain, first, last))
+    scipion_write(imol, outLabel)
 
 def doIt(command):
     """launch command"""
@@ -665,6 +887,7 @@ def _finishProj():
     filenName = mydict['outfile']%(1,1,1)
     dirPath = os.path.dirname(filenName)
     fileName = os.path.join(dirPath,"STOPPROTCOL")
+    flushDataBase()
     open(fileName,"w").close()
     beep(0.1)
     coot_real_exit(0)
@@ -703,35 +926,12 @@ add_key_binding("finish project","e", lambda: _finishProj())
 
 '''
 def getModels(outpuDataBaseNameWithLabels, table_name):
-    # open database
-    conn = sqlite3.connect(outpuDataBaseNameWithLabels)
-    if not _checkTableExists(conn, table_name):
-        conn.close()
-        return
-
-    c = conn.cursor()
-
-    # read filename and label in a loop
-    # get id of the last copy per each file
-    sqlCommand = """SELECT fileName 
-                    FROM %s  NATURAL JOIN lastid
-                    WHERE type = %d""" % \
-                    (table_name, TYPE_3DMAP)
-    c.execute(sqlCommand)
-
-    listOfMaps = []
-    for row in c:
-        listOfMaps.append(row[0])
-
-    c.execute("""SELECT fileName 
-                 FROM %s  NATURAL JOIN lastid
-                 WHERE type = %d """ %
-              (table_name, TYPE_ATOMSTRUCT))
-
-    listOfAtomStructs = []
-    for row in c:
-        listOfAtomStructs.append(row[0])
-    return listOfMaps, listOfAtomStructs
+    # get the last copy of each model
+    db = CootDataBase(outpuDataBaseNameWithLabels, table_name)
+    if not db.tableExists():
+        return [], []
+    return db.getLastFileNames(TYPE_3DMAP), \
+           db.getLastFileNames(TYPE_ATOMSTRUCT)
 
 def createScriptFile(imol,  # problem PDB id
                      scriptFile,  # name of the coot script file
@@ -743,11 +943,17 @@ def createScriptFile(imol,  # problem PDB id
                      editorFileName='/tmp/editor.py',
                      outpuDataBaseNameWithLabels='output.db',
                      table_name='pdb',
-                     protId=0
+                     protId=0,
+                     atomStructs=None,  # files to load instead of
+                     maps=None          # the ones in the database
                      ):
 
     listOfMaps, listOfAtomStructs = getModels(outpuDataBaseNameWithLabels,
                                               table_name)
+    if atomStructs is not None:
+        listOfAtomStructs = atomStructs
+    if maps is not None:
+        listOfMaps = maps
 
     f = open(scriptFile, "w")
     d = {'imol':imol,
@@ -756,8 +962,10 @@ def createScriptFile(imol,  # problem PDB id
          'editorFileName':editorFileName,
          'outpuDataBaseNameWithLabels':outpuDataBaseNameWithLabels,
          'table_name':table_name,
+         'version_table_name':VERSIONTABLENAME,
          'TYPE_3DMAP':TYPE_3DMAP,
          'TYPE_ATOMSTRUCT':TYPE_ATOMSTRUCT,
+         'TIMEOUT':TIMEOUT,
          'protId':protId}
 
     f.write(cootScriptHeader.format(**d))
@@ -777,7 +985,8 @@ def createScriptFile(imol,  # problem PDB id
         f.write("handle_read_ccp4_map('%s', 0)\n" % vol)
         #imol_counter += 1
     # set color of first map
-    f.write(f"set_map_colour({imol_counter}, *map_colour)\n")
+    if listOfMaps:
+        f.write(f"set_map_colour({imol_counter}, *map_colour)\n")
 
     f.write("\n#Extra Commands\n")
     f.write(extraCommands)
@@ -874,17 +1083,3 @@ with open(path, 'r') as f:
 tk.mainloop()
 """)
         f.close()
-def _checkTableExists(dbcon, tablename):
-    dbcur = dbcon.cursor()
-    dbcur.execute("""
-        SELECT COUNT(*)
-        FROM sqlite_master
-        WHERE type='table'
-         AND name='%s'
-        """%tablename)
-    if dbcur.fetchone()[0] == 1:
-        dbcur.close()
-        return True
-
-    dbcur.close()
-    return False
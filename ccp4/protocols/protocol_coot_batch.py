@@ -0,0 +1,497 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import pyworkflow.utils as pwutils
+from pyworkflow import VERSION_1_2
+from pyworkflow.protocol.constants import STEPS_PARALLEL
+from pyworkflow.protocol.params import (MultiPointerParam, PointerParam,
+                                        BooleanParam, IntParam,
+                                        StringParam, TextParam)
+from pwem.convert.atom_struct import AtomicStructHandler
+from pwem.objects import AtomStruct, SetOfAtomStructs
+from pwem.protocols import EMProtocol
+from ccp4 import Plugin
+from ccp4.constants import CCP4_BINARIES
+from ccp4.convert import (runCCP4Program, validVersion, fixMapFile,
+                          normalizeMrcFile)
+from .coot_database import CootDataBase, closeConnection
+from .protocol_coot import (createScriptFile, COOTPDBTEMPLATEFILENAME,
+                            COOTSCRIPTFILENAME,
+                            OUTPUTDATABASENAMESWITHLABELS)
+
+# operation name: number of arguments (minimum, maximum)
+BATCHOPERATIONS = {'refine_windows': (0, 2),
+                   'refine_chain': (0, 0),
+                   'fit_chain': (0, 0),
+                   'change_chain_id': (1, 1)}
+
+
+def parseOperations(text):
+    """ list of [name, arg1, ...] from text with an operation per line.
+    Integer arguments are converted, lines starting with # are ignored.
+    Raises ValueError if an operation is unknown or has a wrong number
+    of arguments"""
+    operations = []
+    for line in text.splitlines():
+        words = line.split('#')[0].split()
+        if not words:
+            continue
+        name, args = words[0], words[1:]
+        if name not in BATCHOPERATIONS:
+            raise ValueError("unknown operation %s" % name)
+        minArgs, maxArgs = BATCHOPERATIONS[name]
+        if not minArgs <= len(args) <= maxArgs:
+            raise ValueError("wrong number of arguments: %s" % line.strip())
+        if name == 'refine_windows':
+            args = [int(arg) for arg in args]
+            size, overlap = (args + [10, 2][len(args):])
+            if size < 1 or not 0 <= overlap < size:
+                raise ValueError("overlap should be smaller than the "
+                                 "window size: %s" % line.strip())
+        operations.append([name] + args)
+    return operations
+
+
+class CootBatch(EMProtocol):
+    """ Apply a list of coot operations (real space refinement of sliding
+    windows or whole chains, rigid body fitting, chain renaming) to
+    several atomic structures without user interaction. Each chain is
+    processed by its own coot process (extra/model_XXX/chain_Y), several
+    of them run at the same time, and the chains of each structure are
+    merged at the end. Saved files are recorded in the coot database.
+
+    Long chains may be refined instead in overlapping windows (as the z
+    key of the interactive protocol does). Windows are refined in two
+    passes, the windows of each pass do not overlap and are shared among
+    several coot processes (extra/model_XXX/pass_P_worker_WWW).
+    """
+    _label = 'coot batch'
+    # chains and windows are processed by steps running in parallel threads
+    stepsExecutionMode = STEPS_PARALLEL
+    _program = ""
+    _version = VERSION_1_2
+    COOT = CCP4_BINARIES['COOT']
+    COOTINI = 'coot.txt'
+    EDITOR = 'editor.py'
+    modelDirName = "model_%03d"
+    chainDirName = "chain_%s"
+    windowsDirName = "pass_%d_worker_%03d"
+    passName = "pass_%d"
+    # windows are refined in two passes: even windows, then odd ones
+    windowPasses = 2
+    mapFileName = "map.mrc"
+    normalizedMapFileName = "map_normalized.mrc"
+
+    # --------------------------- DEFINE param functions -------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolume', PointerParam, pointerClass="Volume",
+                      label='Input Volume', allowsNull=True,
+                      help='Map used by coot. If empty, the volume '
+                           'associated to the first atomic structure is '
+                           'used.')
+        form.addParam('doNormalize', BooleanParam, default=True,
+                      label='Normalize',
+                      help='If set to True, the map is divided by its '
+                           'maximum, the way COOT prefers it.')
+        form.addParam('inputStructures', MultiPointerParam,
+                      label='Atomic structures', important=True,
+                      pointerClass='AtomStruct, SetOfAtomStructs',
+                      help='Atomic structures (or sets of atomic '
+                           'structures) to be processed.')
+        form.addParam('chains', StringParam, default='',
+                      label='Chains',
+                      help='Chains to be processed, separated by spaces. '
+                           'If empty, all the chains of each structure. '
+                           'Other chains are not included in the output.')
+        form.addParam('doWindows', BooleanParam, default=False,
+                      label='Refine windows in parallel',
+                      help='If set to True, chains are split into '
+                           'overlapping windows which are real space '
+                           'refined by several coot processes at the same '
+                           'time, and the whole structure is the output. '
+                           'Windows are the ones refined by the z key '
+                           'of the interactive protocol (residues '
+                           'aaNumber-2 to aaNumber+step).')
+        form.addParam('windowStep', IntParam, default=10,
+                      condition='doWindows',
+                      label='Window step',
+                      help='Distance in residues between consecutive '
+                           'windows (step in coot.ini).')
+        form.addParam('firstResidue', IntParam, allowsNull=True,
+                      condition='doWindows',
+                      label='First residue',
+                      help='Residue number of the first window '
+                           '(aaNumber in coot.ini). If empty, the first '
+                           'residue of each chain.')
+        form.addParam('operations', TextParam,
+                      default='refine_windows 10 2',
+                      condition='not doWindows',
+                      label='Operations',
+                      help='Operations applied in order to each chain, '
+                           'one per line:\n'
+                           'refine_windows [size] [overlap]: real space '
+                           'refinement of windows of size residues '
+                           '(default 10), consecutive windows share overlap '
+                           'residues (default 2)\n'
+                           'refine_chain: real space refinement of the '
+                           'whole chain\n'
+                           'fit_chain: rigid body fitting of the chain\n'
+                           'change_chain_id newId: rename the chain')
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        convertId = self._insertFunctionStep('convertInputStep')
+        mergeIds = []
+        for i, pdbFileName in enumerate(self._getInputStructureFileNames(),
+                                        1):
+            if self.doWindows.get():
+                mergeIds.append(self._insertWindowsSteps(i, pdbFileName,
+                                                         convertId))
+                continue
+            chains = self._getChains(pdbFileName)
+            chainIds = [self._insertFunctionStep('runChainStep', i,
+                                                 pdbFileName, chain,
+                                                 prerequisites=[convertId])
+                        for chain in chains]
+            mergeIds.append(self._insertFunctionStep('mergeChainsStep', i,
+                                                     chains,
+                                                     prerequisites=chainIds))
+        self._insertFunctionStep('createOutputStep', prerequisites=mergeIds)
+
+    def _insertWindowsSteps(self, i, pdbFileName, prerequisite):
+        """ steps that refine the windows of structure i, the windows of
+        each pass are split among numberOfThreads - 1 coot processes (one
+        thread runs the protocol)"""
+        windows = self._getWindows(pdbFileName)
+        nWorkers = max(1, self.numberOfThreads.get() - 1)
+        for p in range(self.windowPasses):
+            passWindows = windows[p::self.windowPasses]
+            n = len(passWindows)
+            groups = [passWindows[w * n // nWorkers:(w + 1) * n // nWorkers]
+                      for w in range(nWorkers)]
+            groups = [group for group in groups if group]
+            workerIds = [self._insertFunctionStep('refineWindowsStep', i, p,
+                                                  w, pdbFileName, group,
+                                                  prerequisites=[
+                                                      prerequisite])
+                         for w, group in enumerate(groups, 1)]
+            prerequisite = self._insertFunctionStep(
+                'mergeWindowsStep', i, p, pdbFileName, groups,
+                prerequisites=workerIds or [prerequisite])
+        return prerequisite
+
+    # --------------------------- STEPS functions ---------------------------
+    def convertInputStep(self):
+        """ create the database and the map used by every coot process"""
+        CootDataBase(self._getDataBasePath()).createTables()
+        closeConnection(self._getDataBasePath())
+
+        vol = self._getInputVolume()
+        mapFileName = self._getExtraPath(self.mapFileName)
+        fixMapFile(vol.getFileName().replace(":mrc", ""), mapFileName,
+                   vol.getOrigin(force=True).getShifts(),
+                   vol.getSamplingRate())
+        if self.doNormalize.get():
+            normalizeMrcFile(mapFileName,
+                             self._getExtraPath(self.normalizedMapFileName))
+
+    def runChainStep(self, i, pdbFileName, chain):
+        """ apply the operations to a chain in a headless coot process"""
+        workDir = self._getChainPath(i, chain)
+        pwutils.makePath(workDir)
+        label = self._getChainLabel(i, chain)
+        operations = parseOperations(self.operations.get())
+        # the atomic structure is model 0
+        extraCommands = ("set_imol_refinement_map(1)\n"
+                         "scipion_batch(0, %r, %r, %r)\n"
+                         "coot_real_exit(0)\n"
+                         % (chain, operations, label))
+        self._runCoot(workDir, [os.path.abspath(pdbFileName)],
+                      [self._getMapFileName()], extraCommands)
+
+    def mergeChainsStep(self, i, chains):
+        """ merge the chains of structure i in a headless coot process"""
+        db = CootDataBase(self._getDataBasePath())
+        fileNames = [db.getLastFileName(self._getChainLabel(i, chain))
+                     for chain in chains]
+        closeConnection(self._getDataBasePath())
+        if None in fileNames:
+            failed = [chain for chain, fileName in zip(chains, fileNames)
+                      if fileName is None]
+            print(pwutils.redStr("Processing of chains %s of model %d "
+                                 "failed, skipping it"
+                                 % (" ".join(failed), i)))
+            return
+        workDir = self._getModelPath(i)
+        extraCommands = ("scipion_merge(%r, %r)\n"
+                         "coot_real_exit(0)\n"
+                         % (list(range(len(fileNames))),
+                            self.modelDirName % i))
+        self._runCoot(workDir, fileNames, [], extraCommands)
+
+    def refineWindowsStep(self, i, p, w, pdbFileName, windows):
+        """ refine some windows of pass p in a headless coot process"""
+        inFileName = self._getPassInputFileName(i, p, pdbFileName)
+        if inFileName is None:
+            return
+        workDir = self._getModelPath(i, self.windowsDirName % (p, w))
+        pwutils.makePath(workDir)
+        # the atomic structure is model 0
+        extraCommands = ("set_imol_refinement_map(1)\n"
+                         "scipion_refine_windows(0, %r, %r)\n"
+                         "coot_real_exit(0)\n"
+                         % (windows, self._getWindowsLabel(i, p, w)))
+        self._runCoot(workDir, [inFileName], [self._getMapFileName()],
+                      extraCommands)
+
+    def mergeWindowsStep(self, i, p, pdbFileName, groups):
+        """ copy the windows refined in pass p into the input structure of
+        the pass in a headless coot process"""
+        inFileName = self._getPassInputFileName(i, p, pdbFileName)
+        if inFileName is None:
+            print(pwutils.redStr("Refinement of model %d failed, "
+                                 "skipping it" % i))
+            return
+        db = CootDataBase(self._getDataBasePath())
+        atomStructs = [inFileName]
+        fragments = []
+        for w, windows in enumerate(groups, 1):
+            fileName = db.getLastFileName(self._getWindowsLabel(i, p, w))
+            if fileName is None:
+                print(pwutils.redStr("Refinement of windows %s failed, "
+                                     "skipping them" % windows))
+                continue
+            atomStructs.append(fileName)
+            fragments.append([len(atomStructs) - 1, windows])
+        closeConnection(self._getDataBasePath())
+        extraCommands = ("scipion_replace_windows(0, %r, %r)\n"
+                         "coot_real_exit(0)\n"
+                         % (fragments, self._getPassLabel(i, p)))
+        self._runCoot(self._getModelPath(i), atomStructs, [], extraCommands)
+
+    def createOutputStep(self):
+        db = CootDataBase(self._getDataBasePath())
+        outputSet = self._createSetOfPDBs()
+        for i, pdbFileName in enumerate(self._getInputStructureFileNames(),
+                                        1):
+            outFileName = db.getLastFileName(self.modelDirName % i)
+            if outFileName is None:
+                continue
+            pdb = AtomStruct()
+            pdb.setFileName(outFileName)
+            pdb.setObjComment(os.path.basename(pdbFileName))
+            outputSet.append(pdb)
+
+        # files are registered in scipion
+        lastId = db.getWatermark()
+        rows = db.getUnsavedFilesAfter(lastId)
+        if rows:
+            db.setSavedUpTo(lastId, rows[-1][0])
+        closeConnection(self._getDataBasePath())
+
+        self._defineOutputs(outputAtomStructs=outputSet)
+        self._defineSourceRelation(self.inputStructures, outputSet)
+        self._defineSourceRelation(self._getInputVolume(), outputSet)
+
+    # --------------------------- INFO functions ---------------------------
+    def _validate(self):
+        errors = []
+        if not validVersion(7, 0.056):
+            errors.append("CCP4 version should be at least 7.0.056")
+        if not self._getInputStructureFileNames():
+            errors.append("Error: You should provide at least one atomic "
+                          "structure.\n")
+        elif self._getInputVolume() is None:
+            errors.append("Error: You should provide a volume.\n")
+        if self.doWindows.get():
+            if self.windowStep.get() < 3:
+                errors.append("Error: The window step should be at least "
+                              "3 residues, otherwise windows of the same "
+                              "pass overlap.\n")
+            return errors
+        try:
+            if not parseOperations(self.operations.get()):
+                errors.append("Error: You should provide at least one "
+                              "operation.\n")
+        except ValueError as e:
+            errors.append("Error: %s\n" % e)
+        return errors
+
+    @classmethod
+    def validateInstallation(cls):
+        # Check that the programs exist
+        installed, message = Plugin.checkBinaries(cls.COOT)
+        if not installed:
+            return [message]
+        else:
+            return []
+
+    def _summary(self):
+        summary = []
+        fileNames = self._getInputStructureFileNames()
+        if not hasattr(self, 'outputAtomStructs'):
+            summary.append("Processing %d atomic structures"
+                           % len(fileNames))
+        else:
+            summary.append("%d of %d atomic structures processed"
+                           % (self.outputAtomStructs.getSize(),
+                              len(fileNames)))
+        if self.doWindows.get():
+            summary.append("Windows refined in parallel, step: %d residues"
+                           % self.windowStep.get())
+        else:
+            summary.append("Operations: %s"
+                           % "; ".join(" ".join(str(w) for w in operation)
+                                       for operation in parseOperations(
+                                           self.operations.get())))
+        return summary
+
+    def _citations(self):
+        return ['Emsley_2004']
+
+    # --------------------------- UTILS functions --------------------------
+    def _runCoot(self, workDir, atomStructs, maps, extraCommands):
+        """ run coot without graphics in workDir, loading atomStructs and
+        maps and executing extraCommands"""
+        workDir = os.path.abspath(workDir)
+        scriptFileName = os.path.join(workDir, COOTSCRIPTFILENAME)
+        createScriptFile(0,  # imol
+                         scriptFileName,
+                         os.path.join(workDir, COOTPDBTEMPLATEFILENAME),
+                         extraCommands,
+                         os.path.join(workDir, self.COOTINI),
+                         os.path.join(workDir, self.EDITOR),
+                         self._getDataBasePath(),
+                         protId=self.getObjId(),
+                         atomStructs=atomStructs,
+                         maps=maps)
+        args = " --no-graphics --script " + scriptFileName
+        self._log.info('Launching: ' + Plugin.getProgram(self.COOT) + ' ' +
+                       args)
+        runCCP4Program(Plugin.getProgram(self.COOT), args, cwd=workDir)
+
+    def _getInputStructures(self):
+        """ atomic structures to be processed, sets are expanded"""
+        structures = []
+        for pointer in self.inputStructures:
+            obj = pointer.get()
+            if obj is None:
+                continue
+            if isinstance(obj, SetOfAtomStructs):
+                structures.extend(item.clone() for item in obj)
+            else:
+                structures.append(obj)
+        return structures
+
+    def _getInputStructureFileNames(self):
+        return [structure.getFileName()
+                for structure in self._getInputStructures()]
+
+    def _getInputVolume(self):
+        if self.inputVolume.get() is not None:
+            return self.inputVolume.get()
+        for structure in self._getInputStructures():
+            if structure.getVolume() is not None:
+                return structure.getVolume()
+        return None
+
+    def _getChains(self, pdbFileName):
+        """ chains of the first model of the structure, restricted to the
+        ones selected by the user"""
+        structure = AtomicStructHandler(pdbFileName).getStructure()
+        chains = [chain.id for chain in next(structure.get_models())]
+        if self.chains.get():
+            selected = self.chains.get().split()
+            chains = [chain for chain in chains if chain in selected]
+        return chains
+
+    def _getWindows(self, pdbFileName):
+        """ [chain, first, last] residues of the windows of the selected
+        chains, the same ones refined by the z key of the interactive
+        protocol. Consecutive windows overlap"""
+        structure = AtomicStructHandler(pdbFileName).getStructure()
+        step = self.windowStep.get()
+        selected = self.chains.get().split()
+        windows = []
+        for chain in next(structure.get_models()):
+            if selected and chain.id not in selected:
+                continue
+            # hetero atoms and waters are not refined
+            residues = [residue.id[1] for residue in chain
+                        if residue.id[0] == ' ']
+            if not residues:
+                continue
+            first, last = min(residues), max(residues)
+            aaNumber = first
+            if self.firstResidue.get() is not None:
+                aaNumber = max(first, self.firstResidue.get())
+            while aaNumber <= last:
+                windows.append([chain.id, max(first, aaNumber - 2),
+                                min(last, aaNumber + step)])
+                aaNumber += step
+        return windows
+
+    def _getPassInputFileName(self, i, p, pdbFileName):
+        """ structure refined in pass p, the output of the previous pass"""
+        if p == 0:
+            return os.path.abspath(pdbFileName)
+        db = CootDataBase(self._getDataBasePath())
+        fileName = db.getLastFileName(self._getPassLabel(i, p - 1))
+        closeConnection(self._getDataBasePath())
+        return fileName
+
+    def _getPassLabel(self, i, p):
+        """ the output of the last pass is the output of the model"""
+        if p == self.windowPasses - 1:
+            return self.modelDirName % i
+        return "%s_%s" % (self.modelDirName % i, self.passName % p)
+
+    def _getWindowsLabel(self, i, p, w):
+        return "%s_%s" % (self.modelDirName % i,
+                          self.windowsDirName % (p, w))
+
+    def _getMapFileName(self):
+        if self.doNormalize.get() and \
+                os.path.exists(self._getExtraPath(self.normalizedMapFileName)):
+            return os.path.abspath(
+                self._getExtraPath(self.normalizedMapFileName))
+        return os.path.abspath(self._getExtraPath(self.mapFileName))
+
+    def _getDataBasePath(self):
+        return os.path.abspath(
+            self._getExtraPath(OUTPUTDATABASENAMESWITHLABELS))
+
+    def _getModelPath(self, i, *paths):
+        return self._getExtraPath(self.modelDirName % i, *paths)
+
+    def _getChainPath(self, i, chain):
+        return self._getModelPath(i, self.chainDirName % chain)
+
+    def _getChainLabel(self, i, chain):
+        return "%s_%s" % (self.modelDirName % i, self.chainDirName % chain)
@@ -24,57 +24,78 @@
 # *
 # **************************************************************************
 
+import itertools
+import json
+import math
 import os
+import re
+import resource
+import shutil
 import stat
+import time
+from contextlib import contextmanager
+import numpy as np
+import pyworkflow.utils as pwutils
 import pyworkflow.protocol.constants as const
 from pyworkflow import VERSION_1_2
 try:
     from pwem.objects import AtomStruct
 except:
     from pwem.objects import PdbFile as AtomStruct
+from pwem.convert.atom_struct import AtomicStructHandler
 from pwem.convert.headers import Ccp4Header
 from ccp4 import Plugin
-from ccp4.convert import (runCCP4Program, validVersion)
+from ccp4.convert import (runCCP4Program, validVersion, fixMapFile,
+                          cropMrcFile, setPdbCell, getFftSize)
+from ccp4.cache import FileCache, getProjectCacheDir, linkOrCopy
 from .refmac_template_map2mtz import \
-    template_refmac_preprocess_NOMASK, template_refmac_preprocess_MASK
+    template_refmac_preprocess_NOMASK, template_refmac_preprocess_MASK, \
+    template_refmac_preprocess_PDBSET
 from .refmac_template_refine \
     import template_refmac_refine_MASK, template_refmac_refine_NOMASK
+from .refmac_log_parser import getRefmacLogParser, RefmacLogParser, \
+    RefineMonitor
+from .refmac_pipeline import getStages, runPipeline
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.params import PointerParam, IntParam, FloatParam, \
-    BooleanParam, StringParam
+    BooleanParam, StringParam, EnumParam
 from ccp4.constants import CCP4_BINARIES
 
-class CCP4ProtRunRefmac(EMProtocol):
-    """ Automatic refinement program in Fourier space of macromolecule
-    structures regarding electron density maps. Generates files for
-    volumes and FSCs to submit structures to EMDB
+class CCP4ProtRefmacBase(EMProtocol):
+    """ Code shared by the refmac protocols: refmac parameters, map
+    conversion and creation/execution of the refmac scripts
     """
-    _label = 'refmac'
     _program = ""
     _version = VERSION_1_2
     refmacMap2MtzScriptFileName = "map2mtz_refmac.sh"
     refmacRefineScriptFileName = "refine_refmac.sh"
+    refmacPdbsetScriptFileName = "pdbset_refmac.sh"
     OutPdbFileName = "refmac-refined.pdb"
     createMaskLogFileName = "mask.log"
     refineLogFileName = "refine.log"
+    refineLogCacheFileName = "refine_log_cache.json"
+    refineProgressFileName = "refine_progress.json"
+    refineChunkLogFileName = "refine_chunk_%03d.log"
+    refineChunkPdbFileName = "refine_chunk_%03d.pdb"
+    refineChunkScriptFileName = "chunk_%03d_"
+    checkpointFileName = "checkpoint.json"
+    metricsFileName = "metrics.json"
+
+    # grid of the masked map computed by fft
+    GRID_AUTO = 0
+    GRID_HEADER = 1
+    GRID_EXPLICIT = 2
 
     REFMAC = CCP4_BINARIES['REFMAC']
     PDBSET = CCP4_BINARIES['PDBSET']
 
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
+        # records of the programs running now, see _trackPrograms
+        self._runningPrograms = []
 
     # --------------------------- DEFINE param functions ---------------------
-    def _defineParams(self, form):
-        form.addSection(label='Input')
-
-        form.addParam('inputVolume', PointerParam, label="Input Volume",
-                      allowsNull=True, pointerClass='Volume',
-                      help='This is the unit cell volume.')
-        form.addParam('inputStructure', PointerParam,
-                      label='Atomic structure to be refined',
-                      important=True, pointerClass='AtomStruct',
-                      help='Specify a PDBx/mmCIF object to be refined.')
+    def _defineRefmacParams(self, form):
         form.addParam('maxResolution', FloatParam, default=5,
                       label='Max. Resolution (A):',
                       help="Max resolution used in the refinement (Angstroms)."
@@ -100,10 +121,112 @@ class CCP4ProtRunRefmac(EMProtocol):
                       condition='generateMaskedVolume',
                       label='SFCALC mradius:',
                       help='Specify the radius (Angstroms) to calculate the mask')
+        form.addParam('maskedVolumeGrid', EnumParam, default=self.GRID_AUTO,
+                      choices=['auto', 'header', 'explicit'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='generateMaskedVolume',
+                      label='Masked volume grid:',
+                      help='Grid of the masked volume computed by fft.\n'
+                           'auto: smallest grid sampling the map cell at '
+                           'half the max. resolution with sizes fast for '
+                           'fft (even, factors 2, 3 and 5).\n'
+                           'header: grid of the input volume.\n'
+                           'explicit: the grid given below.')
+        form.addParam('maskedVolumeGridSize', StringParam, default='',
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='generateMaskedVolume and '
+                                'maskedVolumeGrid == %d' % self.GRID_EXPLICIT,
+                      label='Masked volume grid size:',
+                      help='Number of grid points along X, Y and Z, '
+                           'e.g. "256 256 256".')
+        form.addParam('cropMap', BooleanParam, default=False,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      label='Crop map around the structure',
+                      help='If set to True, the map is cropped to the box '
+                           'containing the atomic structure (all of them in '
+                           'batch mode) plus a margin before computing the '
+                           'structure factors, so that refmac and fft work '
+                           'on this box instead of the whole map. The '
+                           'refined structure is written with the cell of '
+                           'the whole map.')
+        form.addParam('cropMargin', FloatParam, default=10,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='cropMap',
+                      label='Crop margin (A):',
+                      help='Distance (Angstroms) between the atomic '
+                           'structure and the border of the cropped map.')
+        form.addParam('useSfcalcCache', BooleanParam, default=True,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      label='Reuse map to mtz conversion',
+                      help='If set to True, the structure factors computed '
+                           'from the map (refmac SFCALC mode) are saved in '
+                           'the project Tmp folder and reused by other '
+                           'refmac runs with the same map, resolution and '
+                           'SFCALC parameters (and atomic structure if the '
+                           'masked volume is generated).')
+        form.addParam('runDirectly', BooleanParam, default=False,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      label='Run programs without scripts',
+                      help='If set to True, pdbset, refmac and fft are '
+                           'executed directly instead of through the '
+                           'shell scripts (which are still written in the '
+                           'Tmp folder as a reference). Independent '
+                           'programs run at the same time and the time '
+                           'used by each one is reported in the log.')
         form.addParam('nRefCycle', IntParam, default=30,
                       expertLevel=const.LEVEL_ADVANCED,
                       label='Number of refinement iterations:',
                       help='Specify the number of cycles of refinement.\n')
+        form.addParam('doConvergence', BooleanParam, default=False,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='not generateMaskedVolume',
+                      label='Stop refinement when converged',
+                      help='If set to True, refmac is executed in chunks of '
+                           'cycles, each one starting from the structure '
+                           'refined by the previous chunk (B factors are '
+                           'only set before the first one). The refinement '
+                           'stops when, during a chunk, R factor and FOM '
+                           'change less than the tolerances and rms '
+                           'BondLength is below the maximum, or when the '
+                           'number of refinement iterations is reached. '
+                           'Not available with masked volume.')
+        form.addParam('doCheckpoint', BooleanParam, default=False,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='not generateMaskedVolume',
+                      label='Resume interrupted refinement',
+                      help='If set to True, refmac is executed in chunks of '
+                           'cycles (as when stopping when converged) and '
+                           'the structure and statistics of each chunk are '
+                           'saved. When the protocol is continued after '
+                           'being interrupted, the refinement resumes after '
+                           'the last finished chunk. Not available with '
+                           'masked volume.')
+        form.addParam('convergenceChunk', IntParam, default=5,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='(doConvergence or doCheckpoint) and '
+                                'not generateMaskedVolume',
+                      label='Cycles per chunk:',
+                      help='Number of refinement cycles between convergence '
+                           'checks or saved checkpoints.')
+        form.addParam('convergenceRfact', FloatParam, default=0.002,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='doConvergence and not generateMaskedVolume',
+                      label='R factor tolerance:',
+                      help='Maximum change of the R factor in a converged '
+                           'chunk.')
+        form.addParam('convergenceFOM', FloatParam, default=0.005,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='doConvergence and not generateMaskedVolume',
+                      label='FOM tolerance:',
+                      help='Maximum change of the figure of merit in a '
+                           'converged chunk.')
+        form.addParam('convergenceMaxRmsBond', FloatParam, default=0.025,
+                      expertLevel=const.LEVEL_ADVANCED,
+                      condition='doConvergence and not generateMaskedVolume',
+                      label='Max. rms BondLength:',
+                      help='The refinement is not considered converged '
+                           'while rms BondLength is above this value.')
         form.addParam('weightMatrix', FloatParam, default=0.0,
                       expertLevel=const.LEVEL_ADVANCED,
                       label='Matrix refinement weight:',
@@ -125,19 +248,6 @@ class CCP4ProtRunRefmac(EMProtocol):
                       HYDR Yes | HOUT Yes
                       """)
 
-    # --------------------------- INSERT steps functions --------------------
-    def _insertAllSteps(self):
-        self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('createDataDictStep')
-        self._insertFunctionStep('createMapMtzRefmacStep')
-        self._insertFunctionStep('executeMapMtzRefmacStep')
-        self._insertFunctionStep('createRefineScriptFileStep')
-        self._insertFunctionStep('executeRefineRefmacStep')
-        self._insertFunctionStep('createRefmacOutputStep')  # create output
-        #                                                     pdb file
-        # self._insertFunctionStep('writeFinalResultsTableStep')  # Print output
-        # #                                                         results
-
     # --------------------------- STEPS functions ---------------------------
     def convertInputStep(self):
         """ convert 3Dmaps to MRC '.mrc' format
@@ -146,112 +256,455 @@ class CCP4ProtRunRefmac(EMProtocol):
         fnVol = self._getInputVolume()
         inFileName = fnVol.getFileName()
         if inFileName.endswith(":mrc"):
-            inFileName.replace(":mrc", "")
+            inFileName = inFileName.replace(":mrc", "")
 
-        # create local copy of 3Dmap (tmp3DMapFile.mrc)
+        # create local 3Dmap (tmp3DMapFile.mrc), the voxels of mrc maps
+        # are linked/cloned instead of copied
         localInFileName = self._getVolumeFileName()
         origin = fnVol.getOrigin(force=True).getShifts()
         sampling = fnVol.getSamplingRate()
-        Ccp4Header.fixFile(inFileName, localInFileName, origin, sampling,
-                        Ccp4Header.START)
+        fixMapFile(inFileName, localInFileName, origin, sampling)
+        if self.cropMap.get():
+            self._cropVolume(localInFileName)
 
-    def createDataDictStep(self):
-        """ Precompute parameters to be used by refmac"""
+    def _cropVolume(self, fileName):
+        """ crop the map fileName to the atomic structures plus
+        cropMargin, see cropMrcFile"""
+        coords = np.array([atom.get_coord()
+                           for pdbFileName in
+                           self._getInputStructureFileNames()
+                           for atom in AtomicStructHandler(
+                               pdbFileName).getStructure().get_atoms()])
+        margin = self.cropMargin.get()
+        if len(coords) and cropMrcFile(fileName, fileName,
+                                       coords.min(axis=0) - margin,
+                                       coords.max(axis=0) + margin):
+            header = Ccp4Header(fileName, readHeader=True)
+            print("Map cropped to %d x %d x %d voxels"
+                  % tuple(header.getGridSampling()), flush=True)
+        else:
+            print("The map has not been cropped", flush=True)
+
+    # --------------------------- UTLIS functions --------------------------
+    def _getDataDict(self, pdbFileName):
+        """ Precompute parameters to be used by refmac when refining
+        pdbFileName"""
         localInFileName = self._getVolumeFileName()
         header = Ccp4Header(localInFileName,
                             readHeader=True)
-        self.dict = {}
+        dataDict = {}
         x, y, z = header.getCellDimensions()
-        self.dict['Xlength'] = x
-        self.dict['Ylength'] = y
-        self.dict['Zlength'] = z
+        dataDict['Xlength'] = x
+        dataDict['Ylength'] = y
+        dataDict['Zlength'] = z
         x, y, z = header.getGridSampling()
-        self.dict['XDim'] = x
-        self.dict['YDim'] = y
-        self.dict['ZDim'] = z
-        self.dict['CCP4_HOME'] = Plugin.getHome()
-        self.dict['REFMAC_BIN'] = Plugin.getProgram(self.REFMAC)
-        self.dict['PDBSET_BIN'] = Plugin.getProgram(self.PDBSET)
-        self.dict['PDBFILE'] = \
-            os.path.basename(self.inputStructure.get().getFileName())
-        self.dict['PDBDIR'] = os.path.abspath(os.path.dirname(
-            self.inputStructure.get().getFileName()))
-        self.dict['MAPFILE'] = os.path.abspath(self._getVolumeFileName())
-
-        self.dict['RESOMIN'] = self.minResolution.get()
-        self.dict['RESOMAX'] = self.maxResolution.get()
-        self.dict['NCYCLE'] = self.nRefCycle.get()
-        if self.weightMatrix.get() == 0:
-            self.dict['WEIGHT MATRIX'] = 'auto'
+        dataDict['XDim'] = x
+        dataDict['YDim'] = y
+        dataDict['ZDim'] = z
+        dataDict['CCP4_HOME'] = Plugin.getHome()
+        if Plugin.getSetupEnviron() is None:
+            dataDict['SETUP_CCP4'] = '. $PATHMRCENV'
+        else:
+            # the environment is passed by _runScript
+            dataDict['SETUP_CCP4'] = '# environment of $PATHMRCENV ' \
+                                     'set by scipion'
+        dataDict['REFMAC_BIN'] = Plugin.getProgram(self.REFMAC)
+        dataDict['PDBSET_BIN'] = Plugin.getProgram(self.PDBSET)
+        dataDict['PDBFILE'] = os.path.basename(pdbFileName)
+        dataDict['PDBDIR'] = os.path.abspath(os.path.dirname(pdbFileName))
+        dataDict['MAPFILE'] = os.path.abspath(self._getVolumeFileName())
+
+        dataDict['RESOMIN'] = self.minResolution.get()
+        dataDict['RESOMAX'] = self.maxResolution.get()
+        self._setRefineValues(dataDict, self.weightMatrix.get(),
+                              self.BFactorSet.get(), self.nRefCycle.get())
+        dataDict['OUTPUTDIR'] = self._getExtraPath('')
+        dataDict['MASKED_VOLUME'] = self._getMapMaskedByPdbBasedMaskFileName()
+        dataDict['PDBSET_MASKED'] = self._getPdbsetMaskPDBFileName()
+        dataDict['PDBSET_NO_MASKED'] = self._getPdbsetNOMaskPDBFileName()
+        dataDict['SFCALC_MAPRADIUS'] = self.SFCALCmapradius.get()
+        dataDict['SFCALC_MRADIUS'] = self.SFCALCmradius.get()
+        dataDict['GRID'] = "%d %d %d" % tuple(self._getMaskedVolumeGrid(
+            dataDict))
+        dataDict['EXTRA_PARAMS'] = self.extraParams.get().replace('|','\n')
+        return dataDict
+
+    def _getMaskedVolumeGrid(self, dataDict):
+        """ grid of the masked volume, see maskedVolumeGrid"""
+        choice = self.maskedVolumeGrid.get()
+        if choice == self.GRID_HEADER:
+            return [dataDict['XDim'], dataDict['YDim'], dataDict['ZDim']]
+        if choice == self.GRID_EXPLICIT:
+            return [int(n) for n in self.maskedVolumeGridSize.get().split()]
+        # fft needs at least two points per resolution length
+        return [getFftSize(2. * length / dataDict['RESOMAX'])
+                for length in [dataDict['Xlength'], dataDict['Ylength'],
+                               dataDict['Zlength']]]
+
+    def _setRefineValues(self, dataDict, weightMatrix, bFactor, nCycle):
+        """ set the refinement weight, B factor and number of cycles"""
+        dataDict['NCYCLE'] = nCycle
+        if weightMatrix == 0:
+            dataDict['WEIGHT MATRIX'] = 'auto'
         else:
-            self.dict['WEIGHT MATRIX'] = str(self.weightMatrix.get())
-        self.dict['OUTPUTDIR'] = self._getExtraPath('')
-        self.dict['MASKED_VOLUME'] = self._getMapMaskedByPdbBasedMaskFileName()
-        self.dict['PDBSET_MASKED'] = self._getPdbsetMaskPDBFileName()
-        self.dict['PDBSET_NO_MASKED'] = self._getPdbsetNOMaskPDBFileName()
-        self.dict['SFCALC_MAPRADIUS'] = self.SFCALCmapradius.get()
-        self.dict['SFCALC_MRADIUS'] = self.SFCALCmradius.get()
-        if self.BFactorSet.get() == 0:
-            self.dict['BFACTOR_SET'] = "0"
+            dataDict['WEIGHT MATRIX'] = str(weightMatrix)
+        if bFactor == 0:
+            dataDict['BFACTOR_SET'] = "0"
         else:
-            self.dict['BFACTOR_SET'] = "%f" % self.BFactorSet.get()
-        self.dict['EXTRA_PARAMS'] = self.extraParams.get().replace('|','\n')
+            dataDict['BFACTOR_SET'] = "%f" % bFactor
+        dataDict['BFACTOR_SET_LINE'] = "BFACTOR_SET=%s" % \
+            dataDict['BFACTOR_SET']
 
+    def _writeScriptFile(self, template, scriptFileName, dataDict):
+        """ fill template with dataDict and save it as an executable
+        script"""
+        f_script = open(scriptFileName, "w")
+        f_script.write(template % dataDict)
+        f_script.close()
+        os.chmod(scriptFileName, stat.S_IEXEC | stat.S_IREAD | stat.S_IWRITE)
 
-    def createMapMtzRefmacStep(self):
-        if self.generateMaskedVolume.get():
-            script_map2mtz = template_refmac_preprocess_MASK  % self.dict
+    def _runScript(self, scriptFileName, cwd, template=None, dataDict=None):
+        """ run the script. If runDirectly is set and the template (and
+        dataDict) the script was created from are given, the programs are
+        executed without the script, see refmac_pipeline"""
+        # the environment of ccp4.setup-sh (if available) is passed
+        # instead of sourcing it in the script, see _getDataDict
+        setupEnviron = Plugin.getSetupEnviron()
+        stages = None
+        if self.runDirectly.get() and template is not None:
+            stages = getStages(template, dataDict)
+        if stages is not None:
+            env = Plugin.getEnviron()
+            env.update(setupEnviron or {})
+            with self._trackPrograms({}):
+                times = runPipeline(stages[0], cwd, env=env,
+                                    cleanFiles=stages[1])
         else:
-            script_map2mtz = template_refmac_preprocess_NOMASK % self.dict
-        f_map2mtz = open(self._getMapMtzScriptFileName(), "w")
-        f_map2mtz.write(script_map2mtz)
-        f_map2mtz.close()
-        os.chmod(self._getMapMtzScriptFileName(), stat.S_IEXEC | stat.S_IREAD |
-                 stat.S_IWRITE)
+            times = [self._runScriptUsage(scriptFileName, cwd,
+                                          setupEnviron)]
+        self._storeMetrics(scriptFileName, cwd, times)
 
-    def executeMapMtzRefmacStep(self):
-        # Generic is a env variable that coot uses as base dir for some
-        # but not all files. "" force a trailing slash
-        runCCP4Program(self._getMapMtzScriptFileName(), args="",
-                       #extraEnvDict={'GENERIC': self._getExtraPath("")},
-                       cwd=self._getExtraPath())
+    def _runScriptUsage(self, scriptFileName, cwd, setupEnviron):
+        """ run the script with runCCP4Program and return the resources
+        used by its programs, as runStage does. They are measured as the
+        resources of the children of this process (getrusage), so if
+        other programs run at the same time (steps running in parallel)
+        the record has 'overlap' set and its cpu time includes theirs.
+        maxrss is the largest peak of the programs run by this process
+        up to the end of the script"""
+        record = {'stage': self._getScriptStageName(scriptFileName),
+                  'overlap': False}
+        with self._trackPrograms(record):
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.time()
+            runCCP4Program(scriptFileName, "", extraEnvDict=setupEnviron,
+                           cwd=cwd)
+            record['wall'] = time.time() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record['cpu'] = (after.ru_utime + after.ru_stime -
+                         before.ru_utime - before.ru_stime)
+        # kilobytes in linux
+        record['maxrss'] = after.ru_maxrss / 1024.
+        return record
 
-    def createRefineScriptFileStep(self):
-        if self.generateMaskedVolume.get():
-            data_refine = template_refmac_refine_MASK  % self.dict
+    @contextmanager
+    def _trackPrograms(self, record):
+        """ add record to the running programs while the block runs, the
+        'overlap' of the records of programs running at the same time is
+        set"""
+        with self._lock:  # steps may run in parallel
+            for other in self._runningPrograms:
+                other['overlap'] = True
+            record['overlap'] = bool(self._runningPrograms)
+            self._runningPrograms.append(record)
+        try:
+            yield record
+        finally:
+            with self._lock:
+                self._runningPrograms.remove(record)
+
+    def _runRefineScript(self, scriptFileName, cwd, template, dataDict):
+        """ run the refine script, in chunks of cycles if doConvergence
+        or doCheckpoint are set"""
+        if self._isChunkedMode():
+            self._runChunkedRefinement(scriptFileName, cwd, template,
+                                       dataDict)
         else:
-            data_refine = template_refmac_refine_NOMASK % self.dict
-        f_refine = open(self._getRefineScriptFileName(), "w")
-        f_refine.write(data_refine)
-        f_refine.close()
-        os.chmod(self._getRefineScriptFileName(), stat.S_IEXEC | stat.S_IREAD |
-                 stat.S_IWRITE)
+            self._runMonitoredScript(scriptFileName, cwd, template, dataDict)
+        if self.cropMap.get():
+            # the coordinates are those of the whole map, not its cell
+            setPdbCell(os.path.join(cwd, self.OutPdbFileName),
+                       self._getInputVolumeCell())
 
-    def executeRefineRefmacStep(self):
-        # Generic is a env variable that coot uses as base dir for some
-        # but not all files. "" force a trailing slash
-        runCCP4Program(self._getRefineScriptFileName(), args = "",
-                       #extraEnvDict = {'GENERIC': self._getExtraPath("")},
-                       cwd=self._getExtraPath())
+    def _runMonitoredScript(self, scriptFileName, cwd, template, dataDict):
+        """ run the refine script while a thread reports the statistics
+        of each cycle (see RefineMonitor) in the log and in
+        refine_progress.json, next to refine.log"""
+        monitor = RefineMonitor(os.path.join(cwd, self.refineLogFileName),
+                                os.path.join(cwd,
+                                             self.refineProgressFileName),
+                                dataDict['NCYCLE'])
+        monitor.start()
+        try:
+            self._runScript(scriptFileName, cwd, template, dataDict)
+        finally:
+            monitor.stop()
 
-    def createRefmacOutputStep(self):
-        pdb = AtomStruct()
-        pdb.setFileName(self._getOutPdbFileName(self.OutPdbFileName))
-        self._defineOutputs(outputPdb=pdb)
-        self._defineSourceRelation(self.inputStructure, self.outputPdb)
-        fnVol = self._getInputVolume()
-        self._defineSourceRelation(fnVol, self.outputPdb)
+    def _runChunkedRefinement(self, scriptFileName, cwd, template,
+                              dataDict):
+        """ refine in chunks of convergenceChunk cycles, each one starting
+        from the structure refined by the previous chunk, until a chunk
+        converges (if doConvergence is set, see _hasConverged) or
+        dataDict['NCYCLE'] cycles are done. The logs of the chunks are
+        joined in refine.log.
+        After each chunk the progress is saved in checkpoint.json, if
+        doCheckpoint is set a refinement interrupted by a previous
+        execution resumes after its last finished chunk"""
+        # at least one chunk, its output is the refined structure
+        nCycles = max(1, dataDict['NCYCLE'])
+        key = self._getCheckpointKey(dataDict)
+        checkpoint = None
+        if self.doCheckpoint.get():
+            checkpoint = self._loadCheckpoint(cwd, key)
+        if checkpoint is None:
+            checkpoint = {'key': key, 'cycles': 0, 'converged': False,
+                          'chunks': []}
+        else:
+            print("Resuming refinement after %d cycles"
+                  % checkpoint['cycles'], flush=True)
+        chunkDict = dict(dataDict)
+        if checkpoint['chunks']:
+            self._setChunkInput(chunkDict, checkpoint['chunks'][-1]['pdb'])
+        while checkpoint['cycles'] < nCycles and not checkpoint['converged']:
+            i = len(checkpoint['chunks']) + 1
+            chunkDict['NCYCLE'] = min(self.convergenceChunk.get(),
+                                      nCycles - checkpoint['cycles'])
+            chunkScriptFileName = os.path.join(
+                os.path.dirname(scriptFileName),
+                self.refineChunkScriptFileName % i +
+                os.path.basename(scriptFileName))
+            self._writeScriptFile(template, chunkScriptFileName, chunkDict)
+            self._runMonitoredScript(chunkScriptFileName, cwd, template,
+                                     chunkDict)
+            chunk = {'log': self.refineChunkLogFileName % i,
+                     'pdb': self.refineChunkPdbFileName % i,
+                     'cycles': chunkDict['NCYCLE']}
+            os.replace(os.path.join(cwd, self.refineLogFileName),
+                       os.path.join(cwd, chunk['log']))
+            # refmac cannot overwrite its input, the output is copied
+            shutil.copy(os.path.join(cwd, self.OutPdbFileName),
+                        os.path.join(cwd, chunk['pdb']))
+            chunk['stats'] = self._getChunkStats(os.path.join(cwd,
+                                                              chunk['log']))
+            checkpoint['chunks'].append(chunk)
+            checkpoint['cycles'] += chunk['cycles']
+            checkpoint['converged'] = self._isConvergenceMode() and \
+                self._hasConverged(chunk['stats'])
+            self._saveCheckpoint(cwd, checkpoint)
+            self._setChunkInput(chunkDict, chunk['pdb'])
+        if checkpoint['converged']:
+            print("Refinement converged after %d cycles"
+                  % checkpoint['cycles'], flush=True)
+        elif self._isConvergenceMode():
+            print("Refinement did not converge in %d cycles"
+                  % checkpoint['cycles'], flush=True)
+        # the output of a resumed refinement may have been removed
+        shutil.copy(os.path.join(cwd, checkpoint['chunks'][-1]['pdb']),
+                    os.path.join(cwd, self.OutPdbFileName))
+        with open(os.path.join(cwd, self.refineLogFileName), 'wb') as log:
+            for chunk in checkpoint['chunks']:
+                with open(os.path.join(cwd, chunk['log']), 'rb') as chunkLog:
+                    shutil.copyfileobj(chunkLog, log)
 
-    # def writeFinalResultsTableStep(self):
-    #     with open(self._getlogFileName()) as input_data:
-    #         for line in input_data:
-    #             if line.strip() == '$TEXT:Result: $$ Final results $$':
-    #                 break
-    #         for line in input_data:
-    #             if line.strip() == '$$':
-    #                 break
+    def _setChunkInput(self, chunkDict, pdbFileName):
+        """ refine pdbFileName keeping its B factors"""
+        chunkDict['PDBSET_NO_MASKED'] = pdbFileName
+        chunkDict['BFACTOR_SET_LINE'] = \
+            "# B-factors refined by the previous cycles are kept"
 
-    # --------------------------- UTLIS functions --------------------------
+    def _getChunkStats(self, logFileName):
+        """ (first, last) values of Rfact, FOM and rmsBOND in the
+        "stats vs cycle" table of logFileName, None if not available"""
+        logParser = RefmacLogParser(logFileName)
+        logParser.update()
+        stats = logParser.getStatsVsCycle()
+        chunkStats = {}
+        for name in ['Rfact', 'FOM', 'rmsBOND']:
+            chunkStats[name] = None
+            if stats is not None and name in stats.dtype.names:
+                values = [float(stats[name][0]), float(stats[name][-1])]
+                # overflowed values (nan) are not valid JSON
+                if not any(v != v for v in values):
+                    chunkStats[name] = values
+        return chunkStats
+
+    def _hasConverged(self, chunkStats):
+        """ True if R factor and FOM changed less than the tolerances
+        during a chunk and its final rms BondLength is below the
+        maximum"""
+        for name, tolerance in [('Rfact', self.convergenceRfact.get()),
+                                ('FOM', self.convergenceFOM.get())]:
+            values = chunkStats[name]
+            if values is None or abs(values[1] - values[0]) > tolerance:
+                return False
+        rmsBond = chunkStats['rmsBOND']
+        return rmsBond is not None and \
+            rmsBond[1] <= self.convergenceMaxRmsBond.get()
+
+    def _getCheckpointKey(self, dataDict):
+        """ values that determine the refinement, a checkpoint saved
+        with other values is not resumed"""
+        key = dict((name, dataDict[name]) for name in
+                   ['PDBDIR', 'PDBFILE', 'MAPFILE', 'RESOMIN', 'RESOMAX',
+                    'NCYCLE', 'WEIGHT MATRIX', 'BFACTOR_SET',
+                    'EXTRA_PARAMS'])
+        key['chunk'] = self.convergenceChunk.get()
+        key['convergence'] = [self._isConvergenceMode(),
+                              self.convergenceRfact.get(),
+                              self.convergenceFOM.get(),
+                              self.convergenceMaxRmsBond.get()]
+        return key
+
+    def _loadCheckpoint(self, cwd, key):
+        """ checkpoint saved in cwd by a previous execution with the
+        same key, None if there is none or its files are missing"""
+        try:
+            with open(os.path.join(cwd, self.checkpointFileName)) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # JSON has no tuples
+        if checkpoint.get('key') != json.loads(json.dumps(key)):
+            return None
+        for chunk in checkpoint['chunks']:
+            if not (os.path.exists(os.path.join(cwd, chunk['log'])) and
+                    os.path.exists(os.path.join(cwd, chunk['pdb']))):
+                return None
+        return checkpoint
+
+    def _saveCheckpoint(self, cwd, checkpoint):
+        checkpointFileName = os.path.join(cwd, self.checkpointFileName)
+        with open(checkpointFileName + ".tmp", 'w') as f:
+            json.dump(checkpoint, f, indent=1)
+        os.replace(checkpointFileName + ".tmp", checkpointFileName)
+
+    def _isChunkedMode(self):
+        return (self.doConvergence.get() or self.doCheckpoint.get()) and \
+            not self.generateMaskedVolume.get()
+
+    def _isConvergenceMode(self):
+        return self.doConvergence.get() and \
+            not self.generateMaskedVolume.get()
+
+    def _getScriptStageName(self, scriptFileName):
+        """ name of the metrics of a script, the same for the scripts of
+        every sweep run or model"""
+        for baseName in [self.refmacMap2MtzScriptFileName,
+                         self.refmacRefineScriptFileName,
+                         self.refmacPdbsetScriptFileName]:
+            if scriptFileName.endswith(baseName):
+                return os.path.splitext(baseName)[0]
+        return os.path.splitext(os.path.basename(scriptFileName))[0]
+
+    def _storeMetrics(self, scriptFileName, cwd, times):
+        """ add the resources used by the programs run by a script (see
+        runStage and _runScriptUsage) to extra/metrics.json"""
+        with self._lock:  # steps may run in parallel
+            metrics = self._readMetrics()
+            for stageTimes in times:
+                record = dict(stageTimes)
+                record['script'] = os.path.basename(scriptFileName)
+                record['dir'] = os.path.relpath(cwd, self._getExtraPath())
+                metrics.append(record)
+            metricsFileName = self._getExtraPath(self.metricsFileName)
+            with open(metricsFileName + ".tmp", 'w') as f:
+                json.dump(metrics, f, indent=1)
+            os.replace(metricsFileName + ".tmp", metricsFileName)
+
+    def _readMetrics(self):
+        try:
+            with open(self._getExtraPath(self.metricsFileName)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _getMetricsSummary(self):
+        """ summary lines with the resources used by each kind of
+        program"""
+        totals = {}
+        for record in self._readMetrics():
+            total = totals.setdefault(record['stage'], [0, 0., 0., 0., ""])
+            total[0] += 1
+            total[1] += record['wall']
+            total[2] += record.get('cpu', 0.)
+            total[3] = max(total[3], record.get('maxrss', 0.))
+            if record.get('overlap'):
+                total[4] = " *"
+        if not totals:
+            return []
+        summary = ["Programs (runs, wall time, cpu time, peak memory):"]
+        for stage, (runs, wall, cpu, maxrss, overlap) in totals.items():
+            summary.append("%s: %d, %0.1f s, %0.1f s, %0.0f MB%s"
+                           % (stage, runs, wall, cpu, maxrss, overlap))
+        if any(total[4] for total in totals.values()):
+            summary.append("* cpu time and memory include programs run "
+                           "at the same time")
+        return summary
+
+    def _runSfcalcScript(self, scriptFileName, dataDict, cwd,
+                         pdbsetScriptFileName=None, template=None):
+        """ run the map to mtz script (created from template) unless its
+        products are already in the project cache. When they are, the
+        cached files are linked into cwd. Without mask pdbset output is
+        not cached, so pdbsetScriptFileName (if any) is executed
+        instead"""
+        if not self.useSfcalcCache.get() or not Plugin.getCacheMaxSize():
+            self._runScript(scriptFileName, cwd, template, dataDict)
+            return
+        cache = FileCache(getProjectCacheDir(self, 'sfcalc'),
+                          Plugin.getCacheMaxSize())
+        key = self._getSfcalcCacheKey(cache, dataDict)
+        if cache.contains(key):
+            if pdbsetScriptFileName is not None and \
+                    not self.generateMaskedVolume.get():
+                self._writeScriptFile(template_refmac_preprocess_PDBSET,
+                                      pdbsetScriptFileName, dataDict)
+                self._runScript(pdbsetScriptFileName, cwd,
+                                template_refmac_preprocess_PDBSET, dataDict)
+            if cache.fetch(key, cwd):
+                print("Reusing map to mtz conversion from %s" %
+                      cache.cacheDir)
+                return
+        # files may be hardlinks to the cache, they must not be
+        # overwritten in place
+        for fileName in self._getSfcalcFileNames():
+            pwutils.cleanPath(os.path.join(cwd, fileName))
+        self._runScript(scriptFileName, cwd, template, dataDict)
+        cache.store(key, self._getSfcalcFileNames(), cwd)
+
+    def _getSfcalcCacheKey(self, cache, dataDict):
+        """ values that determine the output of the map to mtz script"""
+        key = {'map': cache.getFileChecksum(dataDict['MAPFILE']),
+               'resolution': dataDict['RESOMAX'],
+               'refmac': dataDict['REFMAC_BIN'],
+               'masked': bool(self.generateMaskedVolume.get())}
+        if self.generateMaskedVolume.get():
+            key['mapradius'] = dataDict['SFCALC_MAPRADIUS']
+            key['mradius'] = dataDict['SFCALC_MRADIUS']
+            key['grid'] = dataDict['GRID']
+            key['model'] = cache.getFileChecksum(
+                os.path.join(dataDict['PDBDIR'], dataDict['PDBFILE']))
+        return key
+
+    def _getSfcalcFileNames(self):
+        """ files created by the map to mtz script that may be reused"""
+        fileNames = ['map2mtz.mtz']
+        if self.generateMaskedVolume.get():
+            fileNames += ['masked_fs.mtz', 'shifts.txt',
+                          self._getPdbsetNOMaskPDBFileName(),
+                          self._getPdbsetMaskPDBFileName(),
+                          self._getMapMaskedByPdbBasedMaskFileName()]
+        return fileNames
 
     def _validate(self):
 
@@ -264,6 +717,25 @@ class CCP4ProtRunRefmac(EMProtocol):
         if self._getInputVolume() is None:
             errors.append("Error: You should provide a volume.\n")
 
+        if self.generateMaskedVolume.get() and \
+                self.maskedVolumeGrid.get() == self.GRID_EXPLICIT:
+            try:
+                grid = [int(n) for n in
+                        self.maskedVolumeGridSize.get().split()]
+            except ValueError:
+                grid = []
+            if len(grid) != 3 or min(grid) <= 0:
+                errors.append("Error: The masked volume grid size should "
+                              "be three positive integers.\n")
+
+        if self._isChunkedMode():
+            if self.nRefCycle.get() < 1:
+                errors.append("Error: The number of refinement iterations "
+                              "should be at least 1.\n")
+            if self.convergenceChunk.get() < 1:
+                errors.append("Error: Cycles per chunk should be at least "
+                              "1.\n")
+
         return errors
 
     @classmethod
@@ -280,6 +752,261 @@ class CCP4ProtRunRefmac(EMProtocol):
 
         return errors
 
+    def _getPreprocessTemplate(self):
+        """ template of the map to mtz script"""
+        if self.generateMaskedVolume.get():
+            return template_refmac_preprocess_MASK
+        return template_refmac_preprocess_NOMASK
+
+    def _getRefineTemplate(self):
+        """ template of the refine script"""
+        if self.generateMaskedVolume.get():
+            return template_refmac_refine_MASK
+        return template_refmac_refine_NOMASK
+
+    def _getInputVolumeCell(self):
+        """ cell lengths of the input volume (Angstroms)"""
+        fnVol = self._getInputVolume()
+        sampling = fnVol.getSamplingRate()
+        return [n * sampling for n in fnVol.getDim()]
+
+    def _getVolumeFileName(self, baseFileName="tmp3DMapFile.mrc"):
+        return self._getExtraPath(baseFileName)
+
+    def _citations(self):
+        return ['Vagin_2004']
+
+    def _parseFinalResults(self, refineLogFileName):
+        self.finalResults = []
+        # the parsed log is cached next to the log file
+        cacheFileName = os.path.join(os.path.dirname(refineLogFileName),
+                                     self.refineLogCacheFileName)
+        logParser = getRefmacLogParser(refineLogFileName, cacheFileName)
+        _, dataList = logParser.getFinalResults()
+        for label, initial, final in dataList[:4]:
+            self.finalResults.append(initial)
+            self.finalResults.append(final)
+
+    def _getMapMaskedByPdbBasedMaskFileName(self, baseFileName='mapMaskedByPdbBasedMask.mrc'):
+        return baseFileName
+
+    def _getPdbsetMaskPDBFileName(self, baseFileName='pdbset_mask.pdb'):
+        return baseFileName
+
+    def _getPdbsetNOMaskPDBFileName(self, baseFileName='pdbset.pdb'):
+        return baseFileName
+
+
+def parseValueList(text, valueType=float):
+    """ parse a list of values separated by spaces or commas. Ranges
+    may be given as start:stop:step, stop is included if it is start plus
+    a multiple of step (values never go past stop)"""
+    values = []
+    for token in re.split(r'[\s,]+', text.strip()):
+        if not token:
+            continue
+        if ':' in token:
+            start, stop, step = [valueType(v) for v in token.split(':')]
+            if step <= 0:
+                raise ValueError("Invalid range step in %s" % token)
+            n = int(math.floor((stop - start) / float(step) + 1e-9))
+            values.extend(valueType(round(start + j * step, 10))
+                          for j in range(n + 1))
+        else:
+            values.append(valueType(token))
+    return values
+
+
+class CCP4ProtRunRefmac(CCP4ProtRefmacBase):
+    """ Automatic refinement program in Fourier space of macromolecule
+    structures regarding electron density maps. Generates files for
+    volumes and FSCs to submit structures to EMDB
+    """
+    _label = 'refmac'
+    # sweep combinations are refined by steps running in parallel threads
+    stepsExecutionMode = const.STEPS_PARALLEL
+    sweepDirName = "sweep_%03d"
+    sweepResultsFileName = "sweep_results.json"
+    # rms BondLength above this value is considered overfitting
+    SWEEPMAXRMSBOND = 0.025
+
+    # --------------------------- DEFINE param functions ---------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+
+        form.addParam('inputVolume', PointerParam, label="Input Volume",
+                      allowsNull=True, pointerClass='Volume',
+                      help='This is the unit cell volume.')
+        form.addParam('inputStructure', PointerParam,
+                      label='Atomic structure to be refined',
+                      important=True, pointerClass='AtomStruct',
+                      help='Specify a PDBx/mmCIF object to be refined.')
+        self._defineRefmacParams(form)
+
+        form.addSection(label='Sweep')
+        form.addParam('doSweep', BooleanParam, default=False,
+                      label='Sweep refinement parameters',
+                      help='If set to True, refmac is executed once for each '
+                           'combination of the matrix weights, B factors '
+                           'and number of cycles given below. The runs are '
+                           'ranked by Rfree (Rfact if there is no free set) '
+                           'preferring runs with rms BondLength below '
+                           '%0.3f, and the best one is used as output. '
+                           'Combinations are refined at the same time, as '
+                           'many as threads minus one.'
+                           % self.SWEEPMAXRMSBOND)
+        form.addParam('sweepWeightMatrix', StringParam, default='',
+                      condition='doSweep',
+                      label='Matrix refinement weights:',
+                      help='List of values separated by spaces or commas, '
+                           'ranges may be given as start:stop:step (stop '
+                           'included if it falls on a step), e.g. '
+                           '"0.001 0.005 0.01:0.05:0.01". '
+                           '0 means automatic weight. If empty, the value of '
+                           'the "Matrix refinement weight" parameter is used.')
+        form.addParam('sweepBFactor', StringParam, default='',
+                      condition='doSweep',
+                      label='B Factors:',
+                      help='List of values or ranges (see matrix weights). '
+                           'If empty, the value of the "B Factor" parameter '
+                           'is used.')
+        form.addParam('sweepNCycles', StringParam, default='',
+                      condition='doSweep',
+                      label='Numbers of refinement iterations:',
+                      help='List of values or ranges (see matrix weights). '
+                           'If empty, the value of the "Number of refinement '
+                           'iterations" parameter is used.')
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('convertInputStep')
+        self._insertFunctionStep('createDataDictStep')
+        self._insertFunctionStep('createMapMtzRefmacStep')
+        mapId = self._insertFunctionStep('executeMapMtzRefmacStep')
+        if self.doSweep.get():
+            # all combinations share map2mtz.mtz and run in parallel
+            sweepIds = []
+            for i, values in enumerate(self._getSweepCombinations(), 1):
+                sweepIds.append(self._insertFunctionStep(
+                    'refineSweepStep', i, *values, prerequisites=[mapId]))
+            self._insertFunctionStep('selectBestSweepStep',
+                                     prerequisites=sweepIds)
+        else:
+            self._insertFunctionStep('createRefineScriptFileStep')
+            self._insertFunctionStep('executeRefineRefmacStep')
+        self._insertFunctionStep('createRefmacOutputStep')  # create output
+        #                                                     pdb file
+        # self._insertFunctionStep('writeFinalResultsTableStep')  # Print output
+        # #                                                         results
+
+    # --------------------------- STEPS functions ---------------------------
+    def createDataDictStep(self):
+        """ Precompute parameters to be used by refmac"""
+        self.dict = self._getDataDict(
+            self.inputStructure.get().getFileName())
+
+    def createMapMtzRefmacStep(self):
+        self._writeScriptFile(self._getPreprocessTemplate(),
+                              self._getMapMtzScriptFileName(), self.dict)
+
+    def executeMapMtzRefmacStep(self):
+        self._runSfcalcScript(self._getMapMtzScriptFileName(), self.dict,
+                              cwd=self._getExtraPath(),
+                              pdbsetScriptFileName=self._getPdbsetScriptFileName(),
+                              template=self._getPreprocessTemplate())
+
+    def createRefineScriptFileStep(self):
+        self._writeScriptFile(self._getRefineTemplate(),
+                              self._getRefineScriptFileName(), self.dict)
+
+    def executeRefineRefmacStep(self):
+        if not hasattr(self, 'dict'):
+            # continued protocol, createDataDictStep was executed by a
+            # previous execution
+            self.createDataDictStep()
+        self._runRefineScript(self._getRefineScriptFileName(),
+                              self._getExtraPath(),
+                              self._getRefineTemplate(), self.dict)
+
+    def refineSweepStep(self, i, weightMatrix, bFactor, nCycle):
+        """ refine the structure with one combination of the swept
+        values in its own directory (extra/sweep_XXX)"""
+        workDir = self._getSweepPath(i)
+        pwutils.makePath(workDir)
+        for fileName in self._getSfcalcFileNames() + \
+                [self._getPdbsetNOMaskPDBFileName()]:
+            if os.path.exists(self._getExtraPath(fileName)):
+                pwutils.createLink(self._getExtraPath(fileName),
+                                   os.path.join(workDir, fileName))
+        dataDict = self._getDataDict(self.inputStructure.get().getFileName())
+        self._setRefineValues(dataDict, weightMatrix, bFactor, nCycle)
+        template = self._getRefineTemplate()
+        scriptFileName = os.path.abspath(self._getTmpPath(
+            "%s_%s" % (self.sweepDirName % i,
+                       self.refmacRefineScriptFileName)))
+        self._writeScriptFile(template, scriptFileName, dataDict)
+        self._runRefineScript(scriptFileName, workDir, template, dataDict)
+
+    def selectBestSweepStep(self):
+        """ rank the sweep runs and copy the best one to extra"""
+        results = []
+        for i, (weightMatrix, bFactor, nCycle) in \
+                enumerate(self._getSweepCombinations(), 1):
+            result = {'run': self.sweepDirName % i,
+                      'weightMatrix': weightMatrix,
+                      'bFactor': bFactor,
+                      'nCycle': nCycle}
+            result.update(self._getSweepStats(i))
+            results.append(result)
+        results.sort(key=self._sweepRankKey)
+        with open(self._getSweepResultsFileName(), 'w') as f:
+            json.dump(results, f, indent=1)
+
+        best = results[0]
+        if best['Rfact'] is None:
+            raise Exception("Refmac failed for all the combinations of "
+                            "swept values")
+        bestDir = self._getExtraPath(best['run'])
+        for fileName in [self.OutPdbFileName, 'refmac-refined.mtz',
+                         self.refineLogFileName]:
+            if os.path.exists(os.path.join(bestDir, fileName)):
+                linkOrCopy(os.path.join(bestDir, fileName),
+                           self._getExtraPath(fileName))
+
+    def createRefmacOutputStep(self):
+        pdb = AtomStruct()
+        pdb.setFileName(self._getOutPdbFileName(self.OutPdbFileName))
+        self._defineOutputs(outputPdb=pdb)
+        self._defineSourceRelation(self.inputStructure, self.outputPdb)
+        fnVol = self._getInputVolume()
+        self._defineSourceRelation(fnVol, self.outputPdb)
+
+    # def writeFinalResultsTableStep(self):
+    #     with open(self._getlogFileName()) as input_data:
+    #         for line in input_data:
+    #             if line.strip() == '$TEXT:Result: $$ Final results $$':
+    #                 break
+    #         for line in input_data:
+    #             if line.strip() == '$$':
+    #                 break
+
+    # --------------------------- UTLIS functions --------------------------
+    def _validate(self):
+        errors = CCP4ProtRefmacBase._validate(self)
+        if self.doSweep.get():
+            try:
+                combinations = self._getSweepCombinations()
+            except ValueError as e:
+                errors.append("Error: Invalid list of swept values: %s\n"
+                              % e)
+            else:
+                if self._isChunkedMode() and \
+                        min(nCycle for _, _, nCycle in combinations) < 1:
+                    errors.append("Error: The swept numbers of refinement "
+                                  "iterations should be at least 1.\n")
+        return errors
+
     def _getInputVolume(self):
         if self.inputVolume.get() is None:
             if self.inputStructure.get() is None:
@@ -290,6 +1017,9 @@ class CCP4ProtRunRefmac(EMProtocol):
             fnVol = self.inputVolume.get()
         return fnVol
 
+    def _getInputStructureFileNames(self):
+        return [self.inputStructure.get().getFileName()]
+
     def _getOutPdbFileName(self, fileName=None):
         if fileName is None:
             fileName = self.OutPdbFileName
@@ -301,30 +1031,73 @@ class CCP4ProtRunRefmac(EMProtocol):
     def _getRefineScriptFileName(self):
         return os.path.abspath(self._getTmpPath(self.refmacRefineScriptFileName))
 
+    def _getPdbsetScriptFileName(self):
+        return os.path.abspath(self._getTmpPath(self.refmacPdbsetScriptFileName))
+
     def _getlogFileName(self):
         return self._getExtraPath(self.refineLogFileName)
 
-    def _getVolumeFileName(self, baseFileName="tmp3DMapFile.mrc"):
-        return self._getExtraPath(baseFileName)
+    def _getSweepPath(self, i, *paths):
+        return self._getExtraPath(self.sweepDirName % i, *paths)
 
-    def _citations(self):
-        return ['Vagin_2004']
+    def _getSweepResultsFileName(self):
+        return self._getExtraPath(self.sweepResultsFileName)
 
-    def _parseFinalResults(self, refineLogFileName):
-        self.finalResults = []
-        with open(refineLogFileName, "r") as filePointer:
-            line = filePointer.readline()
-            while line:
-                line = filePointer.readline()
-                words = line.strip().split()
-                if len(words) > 1:
-                    if (words[0] == '$TEXT:Result:' and words[1] == '$$'):
-                        line = filePointer.readline()
-                        for i in range(4):
-                            line = filePointer.readline()
-                            words = line.strip().split()
-                            self.finalResults.append(words[2])
-                            self.finalResults.append(words[3])
+    def _getSweepCombinations(self):
+        """ list of (weightMatrix, bFactor, nCycle) to be refined"""
+        weights = parseValueList(self.sweepWeightMatrix.get(), float) or \
+            [self.weightMatrix.get()]
+        bFactors = parseValueList(self.sweepBFactor.get(), float) or \
+            [self.BFactorSet.get()]
+        nCycles = parseValueList(self.sweepNCycles.get(), int) or \
+            [self.nRefCycle.get()]
+        return list(itertools.product(weights, bFactors, nCycles))
+
+    def _getSweepStats(self, i):
+        """ Rfact, Rfree and rmsBOND of the last cycle of sweep run i"""
+        stats = {'Rfact': None, 'Rfree': None, 'rmsBOND': None}
+        logParser = getRefmacLogParser(self._getSweepPath(
+            i, self.refineLogFileName))
+        statsVsCycle = logParser.getStatsVsCycle()
+        if statsVsCycle is not None and \
+                os.path.exists(self._getSweepPath(i, self.OutPdbFileName)):
+            for name in stats:
+                if name in statsVsCycle.dtype.names:
+                    stats[name] = float(statsVsCycle[name][-1])
+        return stats
+
+    def _sweepRankKey(self, result):
+        """ failed runs last, then runs with too large bond deviations,
+        then by Rfree (Rfact if there is no free set)"""
+        if result['Rfact'] is None:
+            return (2, 0.)
+        rFactor = result['Rfree'] or result['Rfact']
+        rmsBond = result['rmsBOND'] or 0.
+        return (int(rmsBond > self.SWEEPMAXRMSBOND), rFactor)
+
+    def _getLastCycle(self):
+        """ last refmac cycle of the output refinement"""
+        nCycle = self.nRefCycle.get()
+        if self.doSweep.get():
+            try:
+                nCycle = self._readSweepResults()[0]['nCycle']
+            except (OSError, ValueError, IndexError):
+                pass
+        if self._isConvergenceMode():
+            # the refinement may stop before nCycle cycles
+            stats = getRefmacLogParser(
+                self._getlogFileName(),
+                self._getlogCacheFileName()).getStatsVsCycle()
+            if stats is not None:
+                nCycle = int(stats['Ncyc'][-1])
+        return nCycle + 1
+
+    def _readSweepResults(self):
+        with open(self._getSweepResultsFileName()) as f:
+            return json.load(f)
+
+    def _getlogCacheFileName(self):
+        return self._getExtraPath(self.refineLogCacheFileName)
 
     def _summary(self):
         summary = []
@@ -357,13 +1130,31 @@ class CCP4ProtRunRefmac(EMProtocol):
                            )
         except:
             summary.append("Refmac results are not yet computed")
+        if self._isConvergenceMode() and \
+                os.path.exists(self._getlogFileName()):
+            summary.append("Refinement cycles: %d of %d"
+                           % (self._getLastCycle() - 1,
+                              self.nRefCycle.get()))
+        if self.doSweep.get():
+            try:
+                results = self._readSweepResults()
+                summary.append("Sweep results (best first):")
+                summary.append("run    weight   B factor  cycles   Rfact    "
+                               "Rfree    rmsBOND")
+                for result in results:
+                    if result['Rfact'] is None:
+                        summary.append("%s  %s  %s  %d   failed"
+                                       % (result['run'],
+                                          result['weightMatrix'],
+                                          result['bFactor'],
+                                          result['nCycle']))
+                        continue
+                    summary.append("%s  %s  %s  %d   %0.4f   %0.4f   %0.4f"
+                                   % (result['run'], result['weightMatrix'],
+                                      result['bFactor'], result['nCycle'],
+                                      result['Rfact'], result['Rfree'] or 0.,
+                                      result['rmsBOND'] or 0.))
+            except:
+                summary.append("Sweep results are not yet computed")
+        summary.extend(self._getMetricsSummary())
         return summary
-
-    def _getMapMaskedByPdbBasedMaskFileName(self, baseFileName='mapMaskedByPdbBasedMask.mrc'):
-        return baseFileName
-
-    def _getPdbsetMaskPDBFileName(self, baseFileName='pdbset_mask.pdb'):
-        return baseFileName
-
-    def _getPdbsetNOMaskPDBFileName(self, baseFileName='pdbset.pdb'):
-        return baseFileName
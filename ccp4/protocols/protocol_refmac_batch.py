@@ -0,0 +1,216 @@
+# **************************************************************************
+# *
+# * Authors:     Marta Martinez (mmmtnez@cnb.csic.es)
+# *              Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import pyworkflow.utils as pwutils
+from pwem.objects import AtomStruct, SetOfAtomStructs
+from pyworkflow.protocol.constants import STEPS_PARALLEL
+from pyworkflow.protocol.params import PointerParam, MultiPointerParam
+from .protocol_refmac import CCP4ProtRefmacBase
+from .refmac_template_map2mtz import \
+    template_refmac_preprocess_MAP, template_refmac_preprocess_PDBSET, \
+    template_refmac_preprocess_MASK
+from .refmac_template_refine \
+    import template_refmac_refine_MASK, template_refmac_refine_NOMASK
+
+
+class CCP4ProtRunRefmacBatch(CCP4ProtRefmacBase):
+    """ Refine several atomic structures against the same electron
+    density map with refmac. The map is converted once and the
+    structures are refined in parallel, each one in its own
+    directory (extra/model_XXX).
+    """
+    _label = 'refmac batch'
+    # structures are refined by steps running in parallel threads
+    stepsExecutionMode = STEPS_PARALLEL
+    modelDirName = "model_%03d"
+
+    # --------------------------- DEFINE param functions ---------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+
+        form.addParam('inputVolume', PointerParam, label="Input Volume",
+                      allowsNull=True, pointerClass='Volume',
+                      help='This is the unit cell volume. If empty, the '
+                           'volume associated to the first atomic '
+                           'structure is used.')
+        form.addParam('inputStructures', MultiPointerParam,
+                      label='Atomic structures to be refined',
+                      important=True,
+                      pointerClass='AtomStruct, SetOfAtomStructs',
+                      help='Atomic structures (or sets of atomic '
+                           'structures) to be refined against the same '
+                           'volume.')
+        self._defineRefmacParams(form)
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        convertId = self._insertFunctionStep('convertInputStep')
+        if self.generateMaskedVolume.get():
+            # masked structure factors depend on the atomic structure
+            mapId = convertId
+        else:
+            mapId = self._insertFunctionStep('executeMapMtzRefmacStep',
+                                             prerequisites=[convertId])
+        refineIds = []
+        for i, pdbFileName in enumerate(self._getInputStructureFileNames(),
+                                        1):
+            refineIds.append(self._insertFunctionStep('refineStructureStep',
+                                                      i, pdbFileName,
+                                                      prerequisites=[mapId]))
+        self._insertFunctionStep('createRefmacOutputStep',
+                                 prerequisites=refineIds)
+
+    # --------------------------- STEPS functions ---------------------------
+    def executeMapMtzRefmacStep(self):
+        """ map to mtz conversion shared by all atomic structures"""
+        dataDict = self._getDataDict(self._getInputStructureFileNames()[0])
+        scriptFileName = self._getScriptFileName(
+            self.refmacMap2MtzScriptFileName)
+        self._writeScriptFile(template_refmac_preprocess_MAP,
+                              scriptFileName, dataDict)
+        self._runSfcalcScript(scriptFileName, dataDict,
+                              cwd=self._getExtraPath(),
+                              template=template_refmac_preprocess_MAP)
+
+    def refineStructureStep(self, i, pdbFileName):
+        workDir = self._getModelPath(i)
+        pwutils.makePath(workDir)
+        dataDict = self._getDataDict(pdbFileName)
+
+        if self.generateMaskedVolume.get():
+            preprocessTemplate = template_refmac_preprocess_MASK
+            refineTemplate = template_refmac_refine_MASK
+        else:
+            preprocessTemplate = template_refmac_preprocess_PDBSET
+            refineTemplate = template_refmac_refine_NOMASK
+
+        scriptFileName = self._getScriptFileName(
+            self.refmacMap2MtzScriptFileName, i)
+        self._writeScriptFile(preprocessTemplate, scriptFileName, dataDict)
+        if self.generateMaskedVolume.get():
+            self._runSfcalcScript(scriptFileName, dataDict, cwd=workDir,
+                                  template=preprocessTemplate)
+        else:
+            self._runScript(scriptFileName, workDir, preprocessTemplate,
+                            dataDict)
+
+        if not self.generateMaskedVolume.get():
+            # reuse the structure factors computed for the whole map
+            pwutils.createLink(self._getExtraPath('map2mtz.mtz'),
+                               os.path.join(workDir, 'map2mtz.mtz'))
+
+        scriptFileName = self._getScriptFileName(
+            self.refmacRefineScriptFileName, i)
+        self._writeScriptFile(refineTemplate, scriptFileName, dataDict)
+        self._runRefineScript(scriptFileName, workDir, refineTemplate,
+                              dataDict)
+
+    def createRefmacOutputStep(self):
+        outputSet = self._createSetOfPDBs()
+        for i, pdbFileName in enumerate(self._getInputStructureFileNames(),
+                                        1):
+            outFileName = os.path.join(self._getModelPath(i),
+                                       self.OutPdbFileName)
+            if not os.path.exists(outFileName):
+                print(pwutils.redStr("Refinement of %s failed, skipping it"
+                                     % pdbFileName))
+                continue
+            pdb = AtomStruct()
+            pdb.setFileName(outFileName)
+            pdb.setObjComment(os.path.basename(pdbFileName))
+            outputSet.append(pdb)
+        self._defineOutputs(outputAtomStructs=outputSet)
+        self._defineSourceRelation(self.inputStructures, outputSet)
+        self._defineSourceRelation(self._getInputVolume(), outputSet)
+
+    # --------------------------- UTLIS functions --------------------------
+    def _validate(self):
+        errors = CCP4ProtRefmacBase._validate(self)
+        if not self._getInputStructureFileNames():
+            errors.append("Error: You should provide at least one atomic "
+                          "structure.\n")
+        return errors
+
+    def _getInputStructures(self):
+        """ atomic structures to be refined, sets are expanded"""
+        structures = []
+        for pointer in self.inputStructures:
+            obj = pointer.get()
+            if obj is None:
+                continue
+            if isinstance(obj, SetOfAtomStructs):
+                structures.extend(item.clone() for item in obj)
+            else:
+                structures.append(obj)
+        return structures
+
+    def _getInputStructureFileNames(self):
+        return [structure.getFileName()
+                for structure in self._getInputStructures()]
+
+    def _getInputVolume(self):
+        if self.inputVolume.get() is not None:
+            return self.inputVolume.get()
+        for structure in self._getInputStructures():
+            if structure.getVolume() is not None:
+                return structure.getVolume()
+        return None
+
+    def _getModelPath(self, i, *paths):
+        return self._getExtraPath(self.modelDirName % i, *paths)
+
+    def _getScriptFileName(self, baseFileName, i=None):
+        if i is not None:
+            baseFileName = "%s_%s" % (self.modelDirName % i, baseFileName)
+        return os.path.abspath(self._getTmpPath(baseFileName))
+
+    def _summary(self):
+        summary = []
+        summary.append('refmac '
+                       'keywords: '
+                       'https://www2.mrc-lmb.cam.ac.uk/groups/murshudov'
+                       '/content/refmac/refmac_keywords.html')
+        fileNames = self._getInputStructureFileNames()
+        summary.append("Refmac results:  R factor (Goal: ~ 0.3)     "
+                       "Rms BondLength (Goal: ~ 0.02)")
+        for i, pdbFileName in enumerate(fileNames, 1):
+            try:
+                self._parseFinalResults(self._getModelPath(
+                    i, self.refineLogFileName))
+                summary.append("%s:   %0.4f -> %0.4f     %0.4f -> %0.4f"
+                               % (os.path.basename(pdbFileName),
+                                  float(self.finalResults[0]),
+                                  float(self.finalResults[1]),
+                                  float(self.finalResults[2]),
+                                  float(self.finalResults[3])))
+            except:
+                summary.append("%s: refmac results are not yet computed"
+                               % os.path.basename(pdbFileName))
+        summary.extend(self._getMetricsSummary())
+        return summary
@@ -0,0 +1,461 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Streaming parser for refmac log files (refine.log).
+
+Refmac writes its results using the CCP4 loggraph format:
+
+    $TABLE: title :
+    $GRAPHS: graph1 :N:1,2: :graph2 :N:1,3: $$
+    column names $$
+    comments $$
+    data $$
+
+    $TEXT: title: $$ summary $$
+    body $$
+
+The log is read once, line by line, and every block is extracted in the
+same pass. The parser remembers the byte offset it has reached so that a
+second call to update() only reads the lines appended since then.
+
+A log may hold several refinements run one after the other (convergence
+mode of the refmac protocols writes the log of each chunk of cycles to the
+same file). Their "stats vs cycle" tables and cycle summaries are joined,
+the cycles of each refinement numbered after those of the previous one.
+
+The parsed results may be saved to a small JSON sidecar file keyed on the
+size and modification time of the log, so that the project GUI does not
+need to read the log again while it does not change.
+
+RefineMonitor follows a log while refmac is writing it and reports the
+statistics of each cycle as soon as the cycle finishes.
+"""
+
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+# number of lines following the per cycle "M(Fom) v. resln" table
+# that hold the "variable = value" summary of the cycle
+CYCLESUMMARYLINES = 14
+
+# number of $$ separated sections of each loggraph block
+TABLESECTIONS = 4
+TEXTSECTIONS = 3
+
+TABLE = '$TABLE'
+TEXT = '$TEXT'
+SEPARATOR = '$$'
+
+cyclePattern = re.compile(r'Cycle\s+(\d+)\.')
+
+# seconds between reads of the log of a running refinement
+MONITORINTERVAL = 5
+
+# statistics reported for each cycle: name -> start of the variable in
+# the cycle summary
+CYCLEVALUES = {'Rfact': 'Overall R factor',
+               'Rfree': 'Free R factor',
+               'rmsBOND': 'Rms BondLength'}
+
+
+class RefmacLogParser():
+    """Single pass, resumable parser of refmac log files"""
+    STATSVSCYCLE = 'stats vs cycle'
+    FOMVSRESOLUTION = 'M(Fom) v. resln'
+    FINALRESULTS = 'Final results'
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.reset()
+
+    def reset(self):
+        """ forget everything parsed so far"""
+        self._statsArray = None  # (table, array) of getStatsVsCycle()
+        self.offset = 0  # bytes of the log file already parsed
+        self._fileId = None
+        self.tables = []  # finished $TABLE blocks, in log order
+        self.texts = []  # finished $TEXT blocks, in log order
+        self.cycleSummaries = {}  # cycle -> [(variable, value), ...]
+        self._cycleOffset = 0  # cycles of the previous refinements
+        self._block = None  # block being parsed
+        self._summaryCycle = None  # cycle whose summary is being parsed
+        self._summaryLines = 0
+
+    def update(self):
+        """ parse the lines appended to the log file since the last call.
+        Returns True if new lines have been parsed"""
+        try:
+            st = os.stat(self.fileName)
+        except OSError:
+            return False
+        fileId = (st.st_dev, st.st_ino)
+        if fileId != self._fileId or st.st_size < self.offset:
+            # the log has been rewritten (protocol relaunched)
+            self.reset()
+            self._fileId = fileId
+        if st.st_size == self.offset:
+            return False
+
+        offset = self.offset
+        with open(self.fileName, 'rb') as filePointer:
+            filePointer.seek(offset)
+            for line in filePointer:
+                if not line.endswith(b'\n'):
+                    # incomplete line, refmac is still writing it
+                    break
+                offset += len(line)
+                self._feed(line.decode('latin-1').rstrip())
+        parsed = offset != self.offset
+        self.offset = offset
+        return parsed
+
+    # --------------------------- state machine ---------------------------
+    def _feed(self, line):
+        if self._block is not None:
+            self._feedBlock(line)
+            return
+        stripped = line.lstrip()
+        if stripped.startswith(TABLE) or stripped.startswith(TEXT):
+            self._summaryCycle = None
+            kind = TABLE if stripped.startswith(TABLE) else TEXT
+            self._block = {'kind': kind, 'sections': [[]]}
+            self._feedBlock(stripped)
+        elif self._summaryCycle is not None:
+            self._feedCycleSummary(line)
+
+    def _feedBlock(self, line):
+        block = self._block
+        sections = block['sections']
+        pieces = line.split(SEPARATOR)
+        sections[-1].append(pieces[0].strip())
+        for piece in pieces[1:]:
+            # each $$ closes a section
+            nSections = TABLESECTIONS if block['kind'] == TABLE \
+                else TEXTSECTIONS
+            if len(sections) == nSections:
+                self._closeBlock()
+                return
+            sections.append([piece.strip()])
+
+    def _closeBlock(self):
+        block = self._block
+        self._block = None
+        sections = [[l for l in section if l]
+                    for section in block['sections']]
+        header = sections[0]
+        title = header[0].split(':', 1)[1].strip() \
+            if header and ':' in header[0] else ''
+        title = title.rstrip(':').strip()
+        if block['kind'] == TABLE:
+            graphs = header[1:]
+            columns = " ".join(sections[1]).split()
+            table = {'title': title,
+                     'graphs': graphs,
+                     'columns': columns,
+                     'rows': sections[3]}
+            self.tables.append(table)
+            if self.STATSVSCYCLE in title:
+                # next refinement (if any) starts where this one ends
+                self._cycleOffset += _getLastCycle(table)
+            match = cyclePattern.search(title) or \
+                cyclePattern.search(" ".join(graphs))
+            if match and any(self.FOMVSRESOLUTION in g for g in graphs):
+                # "variable = value" summary of this cycle follows
+                self._summaryCycle = int(match.group(1)) + \
+                    self._cycleOffset
+                self._summaryLines = 0
+                self.cycleSummaries[self._summaryCycle] = []
+        else:
+            self.texts.append({'title': title,
+                               'summary': " ".join(sections[1]),
+                               'lines': sections[2]})
+
+    def _feedCycleSummary(self, line):
+        self._summaryLines += 1
+        words = line.split("=")
+        if len(words) > 1:
+            self.cycleSummaries[self._summaryCycle].append(
+                (words[0].strip(), words[1].strip()))
+        if self._summaryLines >= CYCLESUMMARYLINES:
+            self._summaryCycle = None
+
+    # --------------------------- sidecar cache ---------------------------
+    def saveCache(self, cacheFileName):
+        """ save the parsed results (and the parser state) in
+        cacheFileName"""
+        try:
+            st = os.stat(self.fileName)
+        except OSError:
+            return
+        # only the blocks used by scipion are kept
+        tables = [t for t in self.tables if self.STATSVSCYCLE in t['title']]
+        texts = [t for t in self.texts if self.FINALRESULTS in t['summary']]
+        cache = {'size': st.st_size,
+                 'mtime': st.st_mtime_ns,
+                 'fileId': self._fileId,
+                 'offset': self.offset,
+                 'tables': tables,
+                 'texts': texts,
+                 'cycleSummaries': self.cycleSummaries,
+                 'block': self._block,
+                 'summaryCycle': self._summaryCycle,
+                 'summaryLines': self._summaryLines,
+                 'cycleOffset': self._cycleOffset}
+        tmpFileName = cacheFileName + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmpFileName, cacheFileName)
+
+    def loadCache(self, cacheFileName):
+        """ restore the parser from cacheFileName. Returns True if the
+        cache is up to date with the log file, in that case there is no
+        need to call update()"""
+        try:
+            with open(cacheFileName) as f:
+                cache = json.load(f)
+            st = os.stat(self.fileName)
+        except (OSError, ValueError):
+            return False
+        fileId = tuple(cache['fileId']) if cache['fileId'] else None
+        if fileId != (st.st_dev, st.st_ino) or st.st_size < cache['offset']:
+            # cache belongs to a previous execution
+            return False
+        self.offset = cache['offset']
+        self._fileId = fileId
+        self.tables = cache['tables']
+        self.texts = cache['texts']
+        self._statsArray = None
+        self.cycleSummaries = {int(cycle): [tuple(row) for row in rows]
+                               for cycle, rows in
+                               cache['cycleSummaries'].items()}
+        self._block = cache['block']
+        self._summaryCycle = cache['summaryCycle']
+        self._summaryLines = cache['summaryLines']
+        self._cycleOffset = cache.get('cycleOffset', 0)
+        # nanoseconds, float seconds may not survive the JSON round trip
+        return cache['size'] == st.st_size and \
+            cache['mtime'] == st.st_mtime_ns
+
+    # --------------------------- accessors -------------------------------
+    def getTable(self, titleSubstring):
+        """ return last finished table whose title contains titleSubstring"""
+        for table in reversed(self.tables):
+            if titleSubstring in table['title']:
+                return table
+        return None
+
+    def getText(self, summarySubstring):
+        """ return last finished text block whose summary
+        contains summarySubstring"""
+        for text in reversed(self.texts):
+            if summarySubstring in text['summary']:
+                return text
+        return None
+
+    def getStatsVsCycle(self):
+        """ return the "stats vs cycle" table as a structured numpy array,
+        one field per column (Ncyc, Rfact, Rfree, FOM, -LL, ...).
+        Fields are views of the array, e.g. stats['Rfact'].
+        The tables of consecutive refinements are joined.
+        None if the table is not available"""
+        tables = [t for t in self.tables if self.STATSVSCYCLE in t['title']]
+        if not tables or not tables[-1]['rows']:
+            return None
+        table = tables[-1]
+        if self._statsArray is None or self._statsArray[0] is not table:
+            rows = list(tables[0]['rows'])
+            offset = _getLastCycle(tables[0])
+            for previous in tables[1:]:
+                for row in previous['rows']:
+                    words = row.split(None, 1)
+                    if int(words[0]) == 0:
+                        continue  # last cycle of the previous refinement
+                    rows.append("%d %s" % (int(words[0]) + offset,
+                                           words[1] if len(words) > 1
+                                           else ""))
+                offset += _getLastCycle(previous)
+            dtype = [(name, int if name == 'Ncyc' else float)
+                     for name in table['columns']]
+            try:
+                stats = np.loadtxt(rows, dtype=dtype, ndmin=1)
+            except ValueError:
+                # overflowed fields (*****) are read as nan
+                stats = np.genfromtxt(rows, dtype=dtype, ndmin=1)
+                # genfromtxt removes characters such as - from the names
+                stats.dtype.names = [name for name, _ in dtype]
+            self._statsArray = (table, stats)
+        return self._statsArray[1]
+
+    def getFinalResults(self):
+        """ return header and rows of the "Final results" text block.
+        Each row is (label, initial, final). If there are several
+        refinements initial values are those of the first one"""
+        texts = [t for t in self.texts if self.FINALRESULTS in t['summary']]
+        if not texts or not texts[-1]['lines']:
+            return [], []
+        headerList = [" "] + texts[-1]['lines'][0].split()
+        initials = dict((label, initial) for label, initial, _
+                        in _parseFinalResults(texts[0]))
+        dataList = [(label, initials.get(label, initial), final)
+                    for label, initial, final
+                    in _parseFinalResults(texts[-1])]
+        return headerList, dataList
+
+    def getFinishedCycleSummaries(self):
+        """ cycle -> "variable = value" list of the cycles whose summary
+        has been completely read"""
+        return {cycle: summary
+                for cycle, summary in self.cycleSummaries.items()
+                if cycle != self._summaryCycle}
+
+    def getCycleSummary(self, cycle=None):
+        """ return the "variable = value" list printed after the given
+        cycle. By default the last cycle found"""
+        if not self.cycleSummaries:
+            return []
+        if cycle is None or cycle not in self.cycleSummaries:
+            cycle = max(self.cycleSummaries)
+        return self.cycleSummaries[cycle]
+
+
+def _getLastCycle(table):
+    """ Ncyc of the last row of a "stats vs cycle" table"""
+    for row in reversed(table['rows']):
+        try:
+            return int(row.split()[0])
+        except (ValueError, IndexError):
+            pass
+    return 0
+
+
+def _parseFinalResults(text):
+    """ (label, initial, final) rows of a "Final results" text block"""
+    dataList = []
+    for line in text['lines'][1:]:
+        words = line.split()
+        if len(words) < 3:
+            continue
+        # the first column may have several words
+        dataList.append((" ".join(words[:-2]), words[-2], words[-1]))
+    return dataList
+
+
+# parsers already used by this process. Reopening a viewer on a running
+# protocol only parses the new lines of the log file
+_parsers = {}
+
+
+def getRefmacLogParser(fileName, cacheFileName=None):
+    """ return an up to date parser for fileName, reusing the previous
+    one if available. If cacheFileName is given the parsed results are
+    read from (and saved to) this sidecar file"""
+    key = os.path.abspath(fileName)
+    parser = _parsers.get(key)
+    if parser is None:
+        parser = RefmacLogParser(key)
+        _parsers[key] = parser
+        if cacheFileName is not None and parser.loadCache(cacheFileName):
+            return parser
+    if parser.update() and cacheFileName is not None:
+        parser.saveCache(cacheFileName)
+    return parser
+
+
+class RefineMonitor(threading.Thread):
+    """ thread that reads the log of a running refinement every
+    MONITORINTERVAL seconds. Rfact, Rfree and rmsBOND of each finished
+    cycle are printed and saved, with the fraction of the refinement
+    done, in progressFileName (JSON), which is cheap to poll"""
+    def __init__(self, logFileName, progressFileName, nCycles,
+                 interval=MONITORINTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.parser = RefmacLogParser(logFileName)
+        self.progressFileName = progressFileName
+        # refmac reports cycles 1 to nCycles + 1 (final statistics)
+        self.nCycles = nCycles + 1
+        self.interval = interval
+        self.cycles = []
+        self._stopEvent = threading.Event()
+
+    def run(self):
+        while not self._stopEvent.wait(self.interval):
+            try:
+                self.update()
+            except Exception as e:
+                print("Cannot read refmac progress: %s" % e, flush=True)
+
+    def stop(self):
+        """ stop the thread and report the last cycles"""
+        self._stopEvent.set()
+        if self.is_alive():
+            self.join()
+        self.update(finished=True)
+
+    def update(self, finished=False):
+        """ report the cycles finished since the last call"""
+        if not self.parser.update() and not finished:
+            return
+        summaries = self.parser.getFinishedCycleSummaries()
+        if self.cycles and self.cycles[-1]['cycle'] not in summaries:
+            self.cycles = []  # the log has been rewritten
+        lastCycle = self.cycles[-1]['cycle'] if self.cycles else 0
+        for cycle in sorted(c for c in summaries if c > lastCycle):
+            values = {'cycle': cycle}
+            for name, variable in CYCLEVALUES.items():
+                values[name] = None
+                for summaryVariable, value in summaries[cycle]:
+                    if summaryVariable.startswith(variable):
+                        try:
+                            values[name] = float(value.split()[0])
+                        except (ValueError, IndexError):
+                            pass
+                        break
+            self.cycles.append(values)
+            print("refmac cycle %d/%d: %s"
+                  % (cycle, self.nCycles,
+                     ", ".join("%s %s" % (name, values[name])
+                               for name in CYCLEVALUES)), flush=True)
+        self.saveProgress(finished)
+
+    def getProgress(self):
+        """ fraction of the cycles finished"""
+        if not self.cycles:
+            return 0.
+        return min(1., float(self.cycles[-1]['cycle']) / self.nCycles)
+
+    def saveProgress(self, finished=False):
+        progress = {'progress': self.getProgress(),
+                    'nCycles': self.nCycles,
+                    'finished': finished,
+                    'cycles': self.cycles}
+        tmpFileName = self.progressFileName + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            json.dump(progress, f)
+        os.replace(tmpFileName, self.progressFileName)
@@ -0,0 +1,238 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Run the programs of the refmac scripts (see refmac_template_map2mtz and
+refmac_template_refine) directly, without a shell.
+
+Each program is a Stage: the command line, the keyword input (the here
+document of the script) written to its stdin and the log file that
+receives its stdout. Stages start as soon as the stages they depend on
+have finished, so independent programs (pdbset and the map to mtz
+conversion without mask) run at the same time.
+"""
+
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .refmac_template_map2mtz import \
+    template_refmac_preprocess_NOMASK, template_refmac_preprocess_MASK, \
+    template_refmac_preprocess_MAP, template_refmac_preprocess_PDBSET
+from .refmac_template_refine \
+    import template_refmac_refine_MASK, template_refmac_refine_NOMASK
+
+keywords_pdbset = """CELL %(Xlength)f %(Ylength)f %(Zlength)f  90.0 90.0 90.0
+END
+"""
+
+keywords_map_to_mtz = """MODE SFCALC
+RESO %(RESOMAX)f
+SOURCE EM MB
+END
+"""
+
+keywords_map_to_mtz_mask = """MODE SFCALC
+SFCALC mapradius %(SFCALC_MAPRADIUS)s
+SFCALC mradius %(SFCALC_MRADIUS)s
+SFCALC shift
+END
+"""
+
+keywords_ifft = """LABIN F1=Fout0 PHI=Pout0
+SCALE F1 1.0 300.0
+RESOLUTION %(RESOMAX)f
+GRID %(GRID)s
+END
+"""
+
+keywords_refine = """LABIN FP=Fout0 PHIB=Pout0
+RESO = %(RESOMIN)f  %(RESOMAX)f
+%(BFACTOR_SET_LINE)s
+NCYCLE = %(NCYCLE)d
+WEIGHT MATRIX = %(WEIGHT MATRIX)s
+source EM
+"""
+
+keywords_refine_mask = """@shifts.txt
+"""
+
+keywords_refine_footer = """ridge dist sigma 0.01
+ridge dist dmax 4.2
+%(EXTRA_PARAMS)s
+END
+"""
+
+# files removed by the header of the map to mtz scripts
+PREPROCESSCLEANFILES = ['map2mtz.mtz', 'map2mtz.log', '_orig_data_start.txt',
+                        'pdbset.pdb', 'refmac-refined.mtz',
+                        'refmac-refined.pdb']
+
+
+class Stage():
+    """ a program run with keyword input. Starts after the stages
+    named in after. If keywords is None stdin is not redirected, if
+    logFileName is None stdout is not"""
+    def __init__(self, name, program, args, keywords, logFileName,
+                 after=()):
+        self.name = name
+        self.program = program
+        self.args = args
+        self.keywords = keywords
+        self.logFileName = logFileName
+        self.after = after
+
+
+def _pdbsetStage(d):
+    return Stage('pdbset', d['PDBSET_BIN'],
+                 ['XYZIN', os.path.join(d['PDBDIR'], d['PDBFILE']),
+                  'XYZOUT', d['PDBSET_NO_MASKED']],
+                 keywords_pdbset % d, 'pdbset.log')
+
+
+def _mapToMtzStage(d):
+    return Stage('map_to_mtz', d['REFMAC_BIN'],
+                 ['MAPIN', d['MAPFILE'], 'HKLOUT', 'map2mtz.mtz',
+                  'XYZOUT', 'tmp_map2mtz.pdb'],
+                 keywords_map_to_mtz % d, 'map_to_mtz.log')
+
+
+def _mapToMtzMaskStages(d):
+    return [Stage('map_to_mtz_mask', d['REFMAC_BIN'],
+                  ['MAPIN', d['MAPFILE'], 'HKLOUT', 'map2mtz.mtz',
+                   'XYZIN', d['PDBSET_NO_MASKED'],
+                   'XYZOUT', d['PDBSET_MASKED']],
+                  keywords_map_to_mtz_mask % d, 'map_to_mtz_mask.log',
+                  after=['pdbset']),
+            Stage('ifft', os.path.join(d['CCP4_HOME'], 'bin', 'fft'),
+                  ['HKLIN', 'masked_fs.mtz', 'MAPOUT', d['MASKED_VOLUME']],
+                  keywords_ifft % d, 'ifftMask.log',
+                  after=['map_to_mtz_mask'])]
+
+
+def _refineStage(d, masked):
+    if masked:
+        hklin, xyzin = 'masked_fs.mtz', d['PDBSET_MASKED']
+        keywords = keywords_refine + keywords_refine_mask
+    else:
+        hklin, xyzin = 'map2mtz.mtz', d['PDBSET_NO_MASKED']
+        keywords = keywords_refine
+    keywords += keywords_refine_footer
+    return Stage('refine', d['REFMAC_BIN'],
+                 ['HKLIN', hklin, 'XYZIN', xyzin,
+                  'HKLOUT', 'refmac-refined.mtz',
+                  'XYZOUT', 'refmac-refined.pdb',
+                  'atomsf', os.path.join(d['CCP4_HOME'], 'lib', 'data',
+                                         'atomsf_electron.lib')],
+                 keywords % d, 'refine.log')
+
+
+def getStages(template, dataDict):
+    """ return (stages, files to remove first) equivalent to the script
+    template filled with dataDict, None if the template is unknown"""
+    if template is template_refmac_preprocess_NOMASK:
+        return ([_pdbsetStage(dataDict), _mapToMtzStage(dataDict)],
+                PREPROCESSCLEANFILES)
+    if template is template_refmac_preprocess_MASK:
+        return ([_pdbsetStage(dataDict)] + _mapToMtzMaskStages(dataDict),
+                PREPROCESSCLEANFILES)
+    if template is template_refmac_preprocess_MAP:
+        return [_mapToMtzStage(dataDict)], PREPROCESSCLEANFILES
+    if template is template_refmac_preprocess_PDBSET:
+        return [_pdbsetStage(dataDict)], PREPROCESSCLEANFILES
+    if template is template_refmac_refine_NOMASK:
+        return [_refineStage(dataDict, False)], []
+    if template is template_refmac_refine_MASK:
+        return [_refineStage(dataDict, True)], []
+    return None
+
+
+def runStage(stage, cwd, env=None):
+    """ run the program of stage in cwd. Returns a dictionary with the
+    wall and cpu (user + system) time in seconds and the peak memory
+    (resident set size) in MB. These are the resources of the program
+    and the processes it waited for (e.g. those run by a script)"""
+    start = time.time()
+    log = None
+    if stage.logFileName is not None:
+        log = open(os.path.join(cwd, stage.logFileName), 'w')
+    try:
+        process = subprocess.Popen(
+            [stage.program] + stage.args,
+            stdin=None if stage.keywords is None else subprocess.PIPE,
+            stdout=log, cwd=cwd, env=env)
+        if stage.keywords is not None:
+            try:
+                process.stdin.write(stage.keywords.encode())
+                process.stdin.close()
+            except BrokenPipeError:
+                pass  # the program did not read its input, see its log
+        # wait4 returns the resources used by the program, unlike
+        # getrusage(RUSAGE_CHILDREN) it is not affected by the programs
+        # run by other threads
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        if log is not None:
+            log.close()
+    process.returncode = os.WEXITSTATUS(status) \
+        if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if process.returncode != 0:
+        raise Exception("%s failed with exit code %d%s"
+                        % (stage.program, process.returncode,
+                           "" if log is None else ", see %s" % log.name))
+    return {'stage': stage.name,
+            'wall': time.time() - start,
+            'cpu': usage.ru_utime + usage.ru_stime,
+            # kilobytes in linux
+            'maxrss': usage.ru_maxrss / 1024.}
+
+
+def runPipeline(stages, cwd, env=None, cleanFiles=()):
+    """ remove cleanFiles from cwd and run the stages, each one as soon as
+    the stages it depends on finish. Stages must be sorted so that
+    dependencies come first. Returns the times of each stage, see
+    runStage"""
+    for fileName in cleanFiles:
+        fileName = os.path.join(cwd, fileName)
+        if os.path.lexists(fileName):
+            os.remove(fileName)
+
+    def runAfter(stage, dependencies):
+        for future in dependencies:
+            future.result()  # raises if a dependency failed
+        return runStage(stage, cwd, env)
+
+    futures = {}
+    # one thread per stage, so waiting stages never block ready ones
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        for stage in stages:
+            futures[stage.name] = executor.submit(
+                runAfter, stage, [futures[name] for name in stage.after])
+        times = [futures[stage.name].result() for stage in stages]
+    for stageTimes in times:
+        print("%(stage)s: wall time %(wall)0.2f s, cpu time %(cpu)0.2f s, "
+              "peak memory %(maxrss)0.1f MB" % stageTimes, flush=True)
+    return times
@@ -87,7 +87,7 @@ ${RM} ${OUTPUTDIR}refmac-refined.mtz ${OUTPUTDIR}refmac-refined.pdb
 ###TODO: MOVE THIS INITIALIZATION TO convert.getEnv
 PATHMRCBIN=$PATHCCP4/bin
 PATHMRCENV=$PATHMRCBIN/ccp4.setup-sh
-. $PATHMRCENV
+%(SETUP_CCP4)s
 
 # create a mask by calculating complex structure factors around a given radius 
 # taken from the input model 
@@ -155,10 +155,9 @@ fft HKLIN masked_fs.mtz\\
     LABIN F1=Fout0 PHI=Pout0
     SCALE F1 1.0 300.0
     RESOLUTION %(RESOMAX)f
-    GRID 256 256 256
+    GRID %(GRID)s
     END
 END-fft
-#    GRID %(XDim)d %(YDim)d %(ZDim)d
 
 """
 
@@ -171,4 +170,10 @@ template_refmac_preprocess_MASK   = template_refmac_header + \
                           template_map_to_mtz_mask + \
                                     template_ifft
 
+# batch refinement: the map is converted to mtz once (MAP) and each
+# atomic structure is processed by pdbset in its own directory (PDBSET)
+template_refmac_preprocess_MAP = template_refmac_header + \
+                          template_map_to_mtz
 
+template_refmac_preprocess_PDBSET = template_refmac_header + \
+                          template_pdbset
@@ -48,7 +48,7 @@ PATHCCP4=%(CCP4_HOME)s
 
 PATHMRCBIN=$PATHCCP4/bin
 PATHMRCENV=$PATHMRCBIN/ccp4.setup-sh
-. $PATHMRCENV
+%(SETUP_CCP4)s
 
 # Name of fixed pdb file by pdbset
 PDBSET_NO_MASKED=%(PDBSET_NO_MASKED)s
@@ -83,7 +83,7 @@ LABIN FP=Fout0 PHIB=Pout0
 RESO = %(RESOMIN)f  %(RESOMAX)f
 
 # set B-factors at %(BFACTOR_SET)s prior to refinement:
-BFACTOR_SET=%(BFACTOR_SET)s
+%(BFACTOR_SET_LINE)s
 
 # specify number of refinement cycles:
 NCYCLE = %(NCYCLE)d
@@ -0,0 +1,175 @@
+# ***************************************************************************
+# * Authors:    Roberto Marabini (roberto@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# unit tests of the project file cache, they do not need ccp4
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ccp4 import cache
+from ccp4.cache import FileCache, linkOrCopy, MANIFESTFILENAME
+
+
+class TestFileCache(unittest.TestCase):
+    """ store, fetch and eviction of cache entries"""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmpDir, 'cache')
+        self.sourceDir = self._makeDir('source')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _makeDir(self, name):
+        path = os.path.join(self.tmpDir, name)
+        os.makedirs(path)
+        return path
+
+    def _writeFile(self, fileName, text, directory=None):
+        fileName = os.path.join(directory or self.sourceDir, fileName)
+        with open(fileName, 'w') as f:
+            f.write(text)
+        return fileName
+
+    def _readFile(self, fileName):
+        with open(fileName) as f:
+            return f.read()
+
+    def _setLastUse(self, fileCache, key, lastUse):
+        os.utime(fileCache._getEntryPath(key, MANIFESTFILENAME),
+                 (lastUse, lastUse))
+
+    def testStoreAndFetch(self):
+        fileCache = FileCache(self.cacheDir)
+        key = {'map': 'abc', 'resolution': 3.5}
+        self._writeFile('map2mtz.mtz', 'mtz')
+        self._writeFile('shifts.txt', 'shifts')
+        self.assertFalse(fileCache.contains(key))
+        # missing files are ignored
+        fileCache.store(key, ['map2mtz.mtz', 'shifts.txt', 'missing.pdb'],
+                        self.sourceDir)
+        self.assertTrue(fileCache.contains(key))
+
+        destDir = self._makeDir('dest')
+        self.assertTrue(fileCache.fetch(key, destDir))
+        self.assertEqual(sorted(os.listdir(destDir)),
+                         ['map2mtz.mtz', 'shifts.txt'])
+        self.assertEqual(self._readFile(os.path.join(destDir,
+                                                     'map2mtz.mtz')), 'mtz')
+        # hardlinks, evicting the entry does not remove fetched files
+        self.assertTrue(os.path.samefile(
+            os.path.join(destDir, 'map2mtz.mtz'),
+            os.path.join(self.sourceDir, 'map2mtz.mtz')))
+
+    def testMiss(self):
+        fileCache = FileCache(self.cacheDir)
+        self._writeFile('map2mtz.mtz', 'mtz')
+        fileCache.store({'map': 'abc'}, ['map2mtz.mtz'], self.sourceDir)
+        destDir = self._makeDir('dest')
+        self.assertFalse(fileCache.contains({'map': 'abd'}))
+        self.assertFalse(fileCache.fetch({'map': 'abd'}, destDir))
+        self.assertEqual(os.listdir(destDir), [])
+
+    def testEvictionOrder(self):
+        """ least recently used entries are evicted first, fetching an
+        entry makes it the most recently used"""
+        fileCache = FileCache(self.cacheDir)
+        keys = [{'entry': i} for i in range(3)]
+        for i, key in enumerate(keys):
+            self._writeFile('data%d' % i, 'x' * 1000)
+            fileCache.store(key, ['data%d' % i], self.sourceDir)
+            self._setLastUse(fileCache, key, 1000 + i)
+        self.assertTrue(fileCache.fetch(keys[0], self._makeDir('dest')))
+        # room for two entries
+        fileCache.evict(2500)
+        self.assertEqual([fileCache.contains(key) for key in keys],
+                         [True, False, True])
+        fileCache.evict(1500)
+        self.assertEqual([fileCache.contains(key) for key in keys],
+                         [True, False, False])
+
+    def testStoreEvicts(self):
+        fileCache = FileCache(self.cacheDir, maxSize=1500)
+        for i in range(2):
+            self._writeFile('data%d' % i, 'x' * 1000)
+            fileCache.store({'entry': i}, ['data%d' % i], self.sourceDir)
+            self._setLastUse(fileCache, {'entry': i}, 1000 + i)
+        self.assertFalse(fileCache.contains({'entry': 0}))
+        self.assertTrue(fileCache.contains({'entry': 1}))
+
+    def testFetchRacingEviction(self):
+        """ an entry evicted (by another process) while it is fetched is
+        not available"""
+        fileCache = FileCache(self.cacheDir)
+        key = {'map': 'abc'}
+        self._writeFile('map2mtz.mtz', 'mtz')
+        fileCache.store(key, ['map2mtz.mtz'], self.sourceDir)
+
+        def evictAndLink(source, dest):
+            fileCache.evict(0)
+            linkOrCopy(source, dest)
+
+        with mock.patch.object(cache, 'linkOrCopy', evictAndLink):
+            self.assertFalse(fileCache.fetch(key, self._makeDir('dest')))
+        self.assertFalse(fileCache.contains(key))
+
+    def testLinkOrCopy(self):
+        source = self._writeFile('source.txt', 'data')
+        dest = self._writeFile('dest.txt', 'old', self._makeDir('dest'))
+        linkOrCopy(source, dest)
+        self.assertTrue(os.path.samefile(source, dest))
+        # hardlinks not possible (e.g. another file system)
+        with mock.patch('os.link', side_effect=OSError):
+            linkOrCopy(source, dest)
+        self.assertFalse(os.path.samefile(source, dest))
+        self.assertEqual(self._readFile(dest), 'data')
+
+    def testStoreAndFetchFile(self):
+        fileCache = FileCache(self.cacheDir)
+        key = {'normalized': 'abc'}
+        destFileName = os.path.join(self._makeDir('dest'), 'map.mrc')
+        self.assertFalse(fileCache.fetchFile(key, destFileName))
+        fileCache.storeFile(key, self._writeFile('normalized.mrc', 'map'))
+        self.assertTrue(fileCache.fetchFile(key, destFileName))
+        self.assertEqual(self._readFile(destFileName), 'map')
+
+    def testFileChecksum(self):
+        """ checksums are remembered until the file changes"""
+        fileCache = FileCache(self.cacheDir)
+        fileName = self._writeFile('map.mrc', 'map')
+        checksum = fileCache.getFileChecksum(fileName)
+        with mock.patch('hashlib.sha1') as sha1:
+            self.assertEqual(fileCache.getFileChecksum(fileName), checksum)
+            # also through a link, the real path is used
+            link = os.path.join(self.tmpDir, 'link.mrc')
+            os.symlink(fileName, link)
+            self.assertEqual(fileCache.getFileChecksum(link), checksum)
+            sha1.assert_not_called()
+        self._writeFile('map.mrc', 'other map')
+        self.assertNotEqual(fileCache.getFileChecksum(fileName), checksum)
+        # a new instance (another process) reads the memo from disk
+        self.assertEqual(FileCache(self.cacheDir).getFileChecksum(fileName),
+                         fileCache.getFileChecksum(fileName))
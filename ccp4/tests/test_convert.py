@@ -0,0 +1,272 @@
+# ***************************************************************************
+# * Authors:    Roberto Marabini (roberto@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# unit tests of the MRC helpers of ccp4.convert, they use small synthetic
+# maps and do not need ccp4
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ccp4 import convert
+from ccp4.convert import MRCHEADERSIZE, fixMapFile
+
+
+def writeMrc(fileName, data, mode=2, start=(0, 0, 0), sampling=1.5,
+             extendedHeader=b'', ispg=1):
+    """ write data ((ns, nr, nc) array) as a little endian MRC map"""
+    ns, nr, nc = data.shape
+    header = bytearray(MRCHEADERSIZE)
+    struct.pack_into('<4i', header, 0, nc, nr, ns, mode)
+    struct.pack_into('<3i', header, 16, *start)
+    struct.pack_into('<3i', header, 28, nc, nr, ns)
+    struct.pack_into('<3f', header, 40, nc * sampling, nr * sampling,
+                     ns * sampling)
+    struct.pack_into('<3i', header, 64, 1, 2, 3)
+    struct.pack_into('<i', header, 88, ispg)
+    struct.pack_into('<i', header, 92, len(extendedHeader))
+    header[208:212] = b'MAP '
+    header[212] = 0x44  # little endian
+    with open(fileName, 'wb') as f:
+        f.write(header)
+        f.write(extendedHeader)
+        f.write(data.astype(convert.MRCMODES[mode]).tobytes())
+
+
+def readMrc(fileName):
+    """ (header values, data) of a float32 MRC map"""
+    with open(fileName, 'rb') as f:
+        header = f.read(MRCHEADERSIZE)
+    values = {'shape': struct.unpack_from('<3i', header, 0),
+              'mode': struct.unpack_from('<i', header, 12)[0],
+              'start': struct.unpack_from('<3i', header, 16),
+              'grid': struct.unpack_from('<3i', header, 28),
+              'cell': struct.unpack_from('<3f', header, 40),
+              'stats': struct.unpack_from('<3f', header, 76),
+              'ispg': struct.unpack_from('<i', header, 88)[0],
+              'nsymbt': struct.unpack_from('<i', header, 92)[0],
+              'origin': struct.unpack_from('<3f', header, 196),
+              'rms': struct.unpack_from('<f', header, 216)[0]}
+    nc, nr, ns = values['shape']
+    data = np.fromfile(fileName, dtype='<f4',
+                       offset=MRCHEADERSIZE + values['nsymbt'])
+    return values, data.reshape(ns, nr, nc)
+
+
+class TestMrcFiles(unittest.TestCase):
+    """ MRC maps written by ccp4.convert"""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.data = np.random.RandomState(0).uniform(
+            -1., 3., (6, 8, 10)).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _getPath(self, fileName):
+        return os.path.join(self.tmpDir, fileName)
+
+    def _writeMap(self, fileName='map.mrc', **kwargs):
+        data = kwargs.pop('data', self.data)
+        writeMrc(self._getPath(fileName), data, **kwargs)
+        return self._getPath(fileName)
+
+    # --------------------------- fixMapFile -------------------------------
+    def testFixMapFileLink(self):
+        """ maps whose header does not change are linked"""
+        inFileName = self._writeMap(start=(2, 3, 4))
+        outFileName = self._getPath('fixed.mrc')
+        fixMapFile(inFileName, outFileName, (3., 4.5, 6.), 1.5)
+        self.assertTrue(os.path.islink(outFileName))
+        self.assertTrue(os.path.samefile(inFileName, outFileName))
+
+    def _checkFixedMap(self, inFileName, outFileName):
+        values, data = readMrc(outFileName)
+        self.assertEqual(values['start'], (2, 3, 4))
+        self.assertEqual(values['cell'], (20., 16., 12.))
+        self.assertEqual(values['origin'], (0., 0., 0.))
+        self.assertEqual(values['ispg'], 1)
+        np.testing.assert_array_equal(data, self.data)
+        # the input is not modified
+        self.assertEqual(readMrc(inFileName)[0]['start'], (0, 0, 0))
+
+    def testFixMapFile(self):
+        """ the header of the copy (or clone) is fixed, with or without
+        an extended header"""
+        for extendedHeader in [b'', b'x' * 80]:
+            inFileName = self._writeMap(extendedHeader=extendedHeader,
+                                        ispg=0)
+            outFileName = self._getPath('fixed.mrc')
+            fixMapFile(inFileName + ":mrc", outFileName, (4., 6., 8.), 2.)
+            self.assertFalse(os.path.islink(outFileName))
+            self._checkFixedMap(inFileName, outFileName)
+            with open(outFileName, 'rb') as f:
+                f.seek(MRCHEADERSIZE)
+                self.assertEqual(f.read(len(extendedHeader)),
+                                 extendedHeader)
+
+    def testFixMapFileCopy(self):
+        """ without reflinks nor copy_file_range the data is copied"""
+        inFileName = self._writeMap()
+        outFileName = self._getPath('fixed.mrc')
+        noClone = mock.patch.object(convert.fcntl, 'ioctl',
+                                    side_effect=OSError)
+        noCopyRange = mock.patch('os.copy_file_range', side_effect=OSError,
+                                 create=True)
+        with noClone, noCopyRange:
+            fixMapFile(inFileName, outFileName, (4., 6., 8.), 2.)
+        self._checkFixedMap(inFileName, outFileName)
+
+    def testFixMapFileConvert(self):
+        """ maps that are not float32 are converted by Ccp4Header"""
+        inFileName = self._writeMap(mode=1, data=self.data * 100)
+        outFileName = self._getPath('fixed.mrc')
+        self.assertIsNone(convert._getFixedMrcHeader(inFileName,
+                                                     (0., 0., 0.), 1.5))
+        with mock.patch.object(convert.Ccp4Header, 'fixFile') as fixFile:
+            fixMapFile(inFileName, outFileName, (0., 0., 0.), 1.5)
+        fixFile.assert_called_once_with(inFileName, outFileName,
+                                        (0., 0., 0.), 1.5,
+                                        convert.Ccp4Header.START)
+
+    # --------------------------- normalizeMrcFile -------------------------
+    def _checkNormalizedMap(self, outFileName, data, nsymbt=0):
+        values, normalized = readMrc(outFileName)
+        data = data.astype(np.float64)
+        self.assertEqual(values['mode'], 2)
+        self.assertEqual(values['nsymbt'], nsymbt)
+        np.testing.assert_allclose(normalized, data / data.max(), rtol=1e-6)
+        np.testing.assert_allclose(values['stats'],
+                                   [data.min() / data.max(), 1.,
+                                    data.mean() / data.max()], rtol=1e-5)
+        self.assertAlmostEqual(values['rms'], data.std() / data.max(),
+                               places=5)
+
+    def testNormalizeMrcFile(self):
+        """ statistics computed by slabs are those of the whole map"""
+        inFileName = self._writeMap()
+        outFileName = self._getPath('normalized.mrc')
+        # 10 x 8 float32 sections of 320 bytes, slabs of 2 sections
+        self.assertTrue(convert.normalizeMrcFile(inFileName, outFileName,
+                                                 slabSize=700))
+        self._checkNormalizedMap(outFileName, self.data)
+        self.assertTrue(convert.normalizeMrcFile(inFileName, outFileName))
+        self._checkNormalizedMap(outFileName, self.data)
+
+    def testNormalizeMrcFileModes(self):
+        """ int16 maps with an extended header, which is kept"""
+        data = np.round(self.data * 1000)
+        inFileName = self._writeMap(mode=1, data=data,
+                                    extendedHeader=b'x' * 160)
+        outFileName = self._getPath('normalized.mrc')
+        self.assertTrue(convert.normalizeMrcFile(inFileName, outFileName,
+                                                 slabSize=500))
+        self._checkNormalizedMap(outFileName, data, nsymbt=160)
+        with open(outFileName, 'rb') as f:
+            f.seek(MRCHEADERSIZE)
+            self.assertEqual(f.read(160), b'x' * 160)
+
+    def testNormalizeOtherFiles(self):
+        inFileName = self._writeMap('map.spi')
+        outFileName = self._getPath('normalized.mrc')
+        self.assertFalse(convert.normalizeMrcFile(inFileName, outFileName))
+        self.assertFalse(os.path.exists(outFileName))
+
+    # --------------------------- cropMrcFile ------------------------------
+    def testCropMrcFile(self):
+        """ box start, size and cell, the voxels are those of the box"""
+        # 10 x 8 x 6 voxels of 2 A starting at voxel (5, 0, 2)
+        inFileName = self._writeMap(start=(5, 0, 2), sampling=2.)
+        outFileName = self._getPath('cropped.mrc')
+        self.assertTrue(convert.cropMrcFile(inFileName, outFileName,
+                                            (20., 3., 6.), (29., 9., 9.)))
+        values, data = readMrc(outFileName)
+        # x: voxels 10 to 14 (5 to 9 of the map), odd size enlarged
+        # downwards at the end of the map, y: 1 to 5, odd size enlarged,
+        # z: 3 to 5 (1 to 3 of the map), odd size enlarged
+        self.assertEqual(values['shape'], (6, 6, 4))
+        self.assertEqual(values['grid'], (6, 6, 4))
+        self.assertEqual(values['start'], (9, 1, 3))
+        self.assertEqual(values['cell'], (12., 12., 8.))
+        self.assertEqual(values['mode'], 2)
+        np.testing.assert_array_equal(data, self.data[1:5, 1:7, 4:10])
+        np.testing.assert_allclose(values['stats'],
+                                   [data.min(), data.max(), data.mean()],
+                                   rtol=1e-6)
+
+    def testCropMrcFileInPlace(self):
+        """ an int16 map with extended header, cropped into a link to
+        it, the linked map is not modified"""
+        data = np.round(self.data * 1000)
+        inFileName = self._writeMap(mode=1, data=data,
+                                    extendedHeader=b'x' * 80)
+        linkFileName = self._getPath('link.mrc')
+        os.symlink(inFileName, linkFileName)
+        self.assertTrue(convert.cropMrcFile(linkFileName, linkFileName,
+                                            (0., 0., 0.), (4., 4., 4.)))
+        self.assertFalse(os.path.islink(linkFileName))
+        values, cropped = readMrc(linkFileName)
+        self.assertEqual(values['nsymbt'], 0)
+        self.assertEqual(values['start'], (0, 0, 0))
+        np.testing.assert_array_equal(cropped, data[:4, :4, :4])
+        self.assertEqual(os.path.getsize(inFileName),
+                         MRCHEADERSIZE + 80 + data.size * 2)
+
+    def testCropMrcFileWholeMap(self):
+        inFileName = self._writeMap()
+        outFileName = self._getPath('cropped.mrc')
+        # the box is the whole map
+        self.assertFalse(convert.cropMrcFile(inFileName, outFileName,
+                                             (-10., -10., -10.),
+                                             (100., 100., 100.)))
+        # the box is outside the map
+        self.assertFalse(convert.cropMrcFile(inFileName, outFileName,
+                                             (100., 100., 100.),
+                                             (110., 110., 110.)))
+        self.assertFalse(os.path.exists(outFileName))
+
+    def testSetPdbCell(self):
+        pdbFileName = self._getPath('model.pdb')
+        with open(pdbFileName, 'w') as f:
+            f.write("CRYST1   12.000   12.000    8.000  90.00  90.00  90.00 "
+                    "P 1           1\n"
+                    "ATOM      1  N   MET A   1      11.104  13.207   "
+                    "2.100  1.00 40.00           N\n")
+        convert.setPdbCell(pdbFileName, (20., 16., 12.))
+        with open(pdbFileName) as f:
+            lines = f.readlines()
+        self.assertEqual(lines[0], "CRYST1   20.000   16.000   12.000  "
+                                   "90.00  90.00  90.00 P 1           1\n")
+        self.assertTrue(lines[1].startswith("ATOM      1  N   MET A   1"))
+
+
+class TestFftSize(unittest.TestCase):
+    def testGetFftSize(self):
+        self.assertEqual([convert.getFftSize(n) for n in
+                          [0.5, 7, 61, 97.2, 121, 255, 257, 1000]],
+                         [2, 8, 64, 100, 128, 256, 270, 1000])
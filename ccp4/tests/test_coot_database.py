@@ -0,0 +1,169 @@
+# ***************************************************************************
+# * Authors:    Roberto Marabini (roberto@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+
+# unit tests of the database shared by scipion and coot, they do not need
+# coot
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from ccp4.protocols.coot_database import (CootDataBase, closeConnection,
+                                          getConnection, DATABASETABLENAME,
+                                          VERSIONTABLENAME,
+                                          WATERMARKTABLENAME,
+                                          TYPE_3DMAP, TYPE_ATOMSTRUCT)
+
+
+class TestCootDataBase(unittest.TestCase):
+    """ files saved by coot and registered in scipion"""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.databasePath = os.path.join(self.tmpDir, 'coot.sqlite')
+        self.db = CootDataBase(self.databasePath)
+
+    def tearDown(self):
+        closeConnection(self.databasePath)
+        shutil.rmtree(self.tmpDir)
+
+    def _getTables(self):
+        cursor = self.db.getConnection().execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")
+        return set(row[0] for row in cursor)
+
+    def testCreateTables(self):
+        self.assertFalse(self.db.tableExists())
+        self.db.createTables()
+        self.assertTrue(self.db.tableExists())
+        self.assertTrue(set([DATABASETABLENAME, WATERMARKTABLENAME,
+                             VERSIONTABLENAME]) <= self._getTables())
+        mode = self.db.getConnection().execute(
+            "PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def testOldDataBase(self):
+        """ tables are added to databases created by older versions, their
+        rows are kept"""
+        conn = sqlite3.connect(self.databasePath)
+        conn.execute("CREATE TABLE %s (id integer primary key "
+                     "AUTOINCREMENT, modelId integer, fileName text, "
+                     "labelName text, type int, saved integer default 1)"
+                     % DATABASETABLENAME)
+        conn.execute("INSERT INTO %s (modelId, fileName, labelName, type, "
+                     "saved) VALUES (0, 'old.pdb', 'old', %d, 1)"
+                     % (DATABASETABLENAME, TYPE_ATOMSTRUCT))
+        conn.commit()
+        conn.close()
+        self.assertTrue(self.db.tableExists())
+        self.db.createTables()
+        self.assertTrue(set([WATERMARKTABLENAME, VERSIONTABLENAME]) <=
+                        self._getTables())
+        self.assertEqual(self.db.getSavedFileNames(), ['old.pdb'])
+        self.assertEqual(self.db.getWatermark(), 0)
+
+    def testConnections(self):
+        """ one connection for each thread"""
+        conn = getConnection(self.databasePath)
+        self.assertIs(self.db.getConnection(), conn)
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(getConnection(
+                self.databasePath)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], conn)
+        closeConnection(self.databasePath)
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                          "SELECT 1")
+        self.assertIsNot(getConnection(self.databasePath), conn)
+
+    def testWatermark(self):
+        """ only files saved after the watermark are read, new versions
+        saved later are read by the next call"""
+        self.db.createTables()
+        self.db.insertFiles([(0, 'model_0001.pdb', 'model_0001',
+                              TYPE_ATOMSTRUCT, 0),
+                             (1, 'other_0001.pdb', 'other_0001',
+                              TYPE_ATOMSTRUCT, 0),
+                             (2, 'map.mrc', 'map', TYPE_3DMAP, 0)])
+        lastId = self.db.getWatermark()
+        rows = self.db.getUnsavedFilesAfter(lastId)
+        self.assertEqual([row[2] for row in rows],
+                         ['model_0001.pdb', 'other_0001.pdb', 'map.mrc'])
+        # a file saved by coot while the rows are registered
+        self.db.insertFile(0, 'model_0002.pdb', 'model_0002',
+                           TYPE_ATOMSTRUCT)
+        self.db.setSavedUpTo(lastId, rows[-1][0])
+        self.assertEqual(self.db.getWatermark(), rows[-1][0])
+        self.assertEqual(self.db.getSavedFileNames(),
+                         ['model_0001.pdb', 'other_0001.pdb', 'map.mrc'])
+
+        lastId = self.db.getWatermark()
+        rows = self.db.getUnsavedFilesAfter(lastId)
+        self.assertEqual([row[1:] for row in rows],
+                         [(0, 'model_0002.pdb', 'model_0002',
+                           TYPE_ATOMSTRUCT)])
+        self.db.setSavedUpTo(lastId, rows[-1][0])
+        self.assertEqual(self.db.getUnsavedFilesAfter(
+            self.db.getWatermark()), [])
+        self.assertEqual(self.db.getSavedFileNames()[-1], 'model_0002.pdb')
+
+        self.assertEqual(self.db.getLastFileNames(TYPE_ATOMSTRUCT),
+                         ['model_0002.pdb', 'other_0001.pdb'])
+        self.assertEqual(self.db.getLastFileName('other_0001'),
+                         'other_0001.pdb')
+        self.assertIsNone(self.db.getLastFileName('missing'))
+
+    def testConcurrentInserts(self):
+        """ files saved at the same time by several threads (coot
+        processes), none is lost"""
+        self.db.createTables()
+        nThreads, nFiles = 4, 50
+
+        def save(modelId):
+            db = CootDataBase(self.databasePath)
+            for i in range(nFiles):
+                db.insertFile(modelId, 'model_%d_%04d.pdb' % (modelId, i),
+                              'model_%d' % modelId, TYPE_ATOMSTRUCT)
+            closeConnection(self.databasePath)
+
+        threads = [threading.Thread(target=save, args=(modelId,))
+                   for modelId in range(nThreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rows = self.db.getUnsavedFilesAfter(self.db.getWatermark())
+        self.assertEqual(len(rows), nThreads * nFiles)
+        for modelId in range(nThreads):
+            # files of each model in save order
+            self.assertEqual([row[2] for row in rows if row[1] == modelId],
+                             ['model_%d_%04d.pdb' % (modelId, i)
+                              for i in range(nFiles)])
+        self.assertEqual(self.db.getLastFileNames(TYPE_ATOMSTRUCT),
+                         ['model_%d_%04d.pdb' % (modelId, nFiles - 1)
+                          for modelId in range(nThreads)])
@@ -0,0 +1,80 @@
+# ***************************************************************************
+# * Authors:    Roberto Marabini (roberto@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+
+# unit tests of the plugin environment, they do not need ccp4
+
+import os
+import unittest
+from unittest import mock
+
+from ccp4 import Plugin
+
+
+class TestCcp4Environ(unittest.TestCase):
+    """ memo of the environment used to run ccp4 programs"""
+    def setUp(self):
+        Plugin._ccp4EnvironKey = None
+        patcher = mock.patch.object(Plugin, 'getHome',
+                                    return_value='/opt/ccp4-7.0')
+        self.getHome = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, Plugin, '_ccp4EnvironKey', None)
+
+    def testEnviron(self):
+        environ = Plugin.getCcp4Environ()
+        self.assertEqual(environ['CCP4'], '/opt/ccp4-7.0')
+        self.assertEqual(environ['CBIN'], '/opt/ccp4-7.0/bin')
+        self.assertTrue(environ['PATH'].startswith('/opt/ccp4-7.0/bin'))
+        self.assertIs(Plugin.getCcp4Environ(), environ)
+
+    def testReadOnly(self):
+        """ callers cannot modify the memo, getEnviron returns a copy"""
+        environ = Plugin.getCcp4Environ()
+        with self.assertRaises(TypeError):
+            environ['CCP4'] = '/tmp'
+        with self.assertRaises(TypeError):
+            del environ['CCP4']
+        copy = Plugin.getEnviron()
+        copy['CCP4'] = '/tmp'
+        self.assertEqual(Plugin.getCcp4Environ()['CCP4'], '/opt/ccp4-7.0')
+        self.assertIs(Plugin.getCcp4Environ(), environ)
+
+    def testHomeChanged(self):
+        environ = Plugin.getCcp4Environ()
+        self.getHome.return_value = '/opt/ccp4-7.1'
+        newEnviron = Plugin.getCcp4Environ()
+        self.assertIsNot(newEnviron, environ)
+        self.assertEqual(newEnviron['CCP4'], '/opt/ccp4-7.1')
+        self.assertTrue(newEnviron['PATH'].startswith('/opt/ccp4-7.1/bin'))
+
+    def testOsEnvironChanged(self):
+        environ = Plugin.getCcp4Environ()
+        with mock.patch.dict(os.environ, {'CCP4_TEST_VARIABLE': '1'}):
+            newEnviron = Plugin.getCcp4Environ()
+            self.assertIsNot(newEnviron, environ)
+            self.assertEqual(newEnviron['CCP4_TEST_VARIABLE'], '1')
+            self.assertIs(Plugin.getCcp4Environ(), newEnviron)
+        self.assertNotIn('CCP4_TEST_VARIABLE', Plugin.getCcp4Environ())
+        # os.environ is not modified
+        self.assertNotEqual(os.environ.get('CCP4'), '/opt/ccp4-7.0')
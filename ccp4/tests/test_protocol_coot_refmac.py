@@ -28,7 +28,8 @@
 import os.path
 from pwem.protocols.protocol_import import (ProtImportPdb,
                                             ProtImportVolumes)
-from ccp4.protocols import CootRefine, CCP4ProtRunRefmac
+from ccp4.protocols import (CootRefine, CootBatch, CCP4ProtRunRefmac,
+                             CCP4ProtRunRefmacBatch)
 from pyworkflow.tests import *
 
 
@@ -444,6 +445,48 @@ coot_real_exit(0)
         # Viewer: Input map + Atomic structures used as input +
         # THREE Atomic structures as output
 
+    def testCootBatch(self):
+        """ This test checks that the chains of an atomic structure are
+        refined without user interaction"""
+        print("Run Coot batch refinement of sliding windows")
+
+        structure_PDB = self._importStructurePDBWithVol()
+
+        args = {'inputStructures': [structure_PDB],
+                'operations': 'refine_windows 20 4',
+                'numberOfThreads': 2
+                }
+        protCoot = self.newProtocol(CootBatch, **args)
+        protCoot.setObjLabel('coot batch\n refine windows')
+        self.launchProtocol(protCoot)
+        self.assertEqual(protCoot.outputAtomStructs.getSize(), 1)
+        for pdb in protCoot.outputAtomStructs:
+            self.assertTrue(os.path.exists(pdb.getFileName()))
+
+    def testCootBatchParallelWindows(self):
+        """ This test checks that the windows of a chain are refined by
+        several coot processes and merged"""
+        print("Run Coot batch refinement of windows in parallel")
+
+        structure_PDB = self._importStructurePDBWithVol()
+
+        args = {'inputStructures': [structure_PDB],
+                'doWindows': True,
+                'windowStep': 15,
+                'numberOfThreads': 3
+                }
+        protCoot = self.newProtocol(CootBatch, **args)
+        protCoot.setObjLabel('coot batch\n parallel windows')
+        self.launchProtocol(protCoot)
+        self.assertEqual(protCoot.outputAtomStructs.getSize(), 1)
+        for pdb in protCoot.outputAtomStructs:
+            self.assertTrue(os.path.exists(pdb.getFileName()))
+        # 3 threads, one runs the protocol and two coot processes
+        workerDirs = [protCoot._getModelPath(1, protCoot.windowsDirName
+                                             % (0, w)) for w in (1, 2, 3)]
+        self.assertEqual([os.path.isdir(d) for d in workerDirs],
+                         [True, True, False])
+
 class TestRefmacRefinement2(TestImportData):
     """ Test the flexible fitting of refmac refinement protocol
     """
@@ -781,3 +824,134 @@ class TestRefmacRefinement2(TestImportData):
         self.assertIsNotNone(protRefmac.outputPdb.getFileName(),
                              "There was a problem with the alignment")
         self.assertTrue(os.path.exists(protRefmac.outputPdb.getFileName()))
+
+    def testRefmacBatch(self):
+        """ This test checks that refmac batch refines several atomic
+        structures against the same volume (refmac without mask)
+         """
+        print("Run batch Refmac refinement withouth mask from imported "
+              "volume and two pdb files")
+
+        # Import Volume
+        volume = self._importVolume2()
+
+        # import PDBs
+        structure_PDB = self._importStructurePDBWoVol()
+        structure_mmCIF = self._importStructuremmCIFWoVol()
+
+        args = {'inputVolume': volume,
+                'inputStructures': [structure_PDB, structure_mmCIF],
+                'generateMaskedVolume': False,
+                'numberOfThreads': 2
+                }
+        protRefmac = self.newProtocol(CCP4ProtRunRefmacBatch, **args)
+        protRefmac.setObjLabel('refmac batch refinement\n'
+                               'volume and two pdbs\n save models')
+        self.launchProtocol(protRefmac)
+        self.assertEqual(protRefmac.outputAtomStructs.getSize(), 2)
+        for pdb in protRefmac.outputAtomStructs:
+            self.assertTrue(os.path.exists(pdb.getFileName()))
+
+    def testRefmacSweep(self):
+        """ This test checks that refmac sweep mode refines the atomic
+        structure with several matrix weights and keeps the best one
+         """
+        print("Run Refmac sweep of matrix weights withouth mask from "
+              "imported volume and pdb file")
+
+        # Import Volume
+        volume = self._importVolume2()
+
+        # import PDB
+        structure_PDB = self._importStructurePDBWoVol()
+
+        args = {'inputVolume': volume,
+                'inputStructure': structure_PDB,
+                'generateMaskedVolume': False,
+                'doSweep': True,
+                'sweepWeightMatrix': '0.01 0.1',
+                'sweepNCycles': '5',
+                'numberOfThreads': 2
+                }
+        protRefmac = self.newProtocol(CCP4ProtRunRefmac, **args)
+        protRefmac.setObjLabel('refmac sweep refinement\n'
+                               'volume and pdb\n save model')
+        self.launchProtocol(protRefmac)
+        self.assertTrue(os.path.exists(protRefmac.outputPdb.getFileName()))
+        results = protRefmac._readSweepResults()
+        self.assertEqual(len(results), 2)
+        self.assertIsNotNone(results[0]['Rfact'])
+
+    def testRefmacRunDirectly(self):
+        """ This test checks that refmac runs with mask when the programs
+        are executed without scripts
+         """
+        print("Run MASK Refmac refinement without scripts from associated "
+              "volume to a cif file")
+
+        # import PDB
+        structure_PDB = self._importStructuremmCIFWithVol2()
+
+        args = {'inputStructure': structure_PDB,
+                'generateMaskedVolume': True,
+                'runDirectly': True
+                }
+        protRefmac = self.newProtocol(CCP4ProtRunRefmac, **args)
+        protRefmac.setObjLabel('MASK refmac refinement\n'
+                               'without scripts\n save model')
+        self.launchProtocol(protRefmac)
+        self.assertTrue(os.path.exists(protRefmac.outputPdb.getFileName()))
+        self.assertTrue(os.path.exists(protRefmac._getExtraPath(
+            protRefmac._getMapMaskedByPdbBasedMaskFileName())))
+        # resources used by pdbset, refmac (twice) and fft
+        stages = [record['stage'] for record in protRefmac._readMetrics()]
+        self.assertEqual(sorted(stages), ['ifft', 'map_to_mtz_mask',
+                                          'pdbset', 'refine'])
+
+    def testRefmacConvergence(self):
+        """ This test checks that refmac runs in chunks of cycles and stops
+        when the refinement converges
+         """
+        print("Run NO MASK Refmac refinement until convergence from "
+              "associated volume to a cif file")
+
+        # import PDB
+        structure_PDB = self._importStructuremmCIFWithVol2()
+
+        args = {'inputStructure': structure_PDB,
+                'generateMaskedVolume': False,
+                'doConvergence': True,
+                'convergenceChunk': 3,
+                'nRefCycle': 12
+                }
+        protRefmac = self.newProtocol(CCP4ProtRunRefmac, **args)
+        protRefmac.setObjLabel('NO MASK refmac refinement\n'
+                               'until convergence\n save model')
+        self.launchProtocol(protRefmac)
+        self.assertTrue(os.path.exists(protRefmac.outputPdb.getFileName()))
+        self.assertTrue(os.path.exists(protRefmac._getExtraPath(
+            protRefmac.refineChunkLogFileName % 1)))
+        # the cycles of every chunk are in refine.log
+        nCycle = protRefmac._getLastCycle() - 1
+        self.assertTrue(0 < nCycle <= 12)
+        self.assertEqual(nCycle % 3, 0)
+
+    def testRefmacCropMap(self):
+        """ This test checks that refmac runs with the map cropped around
+        the atomic structure
+         """
+        print("Run NO MASK Refmac refinement with cropped map from "
+              "associated volume to a cif file")
+
+        # import PDB
+        structure_PDB = self._importStructuremmCIFWithVol2()
+
+        args = {'inputStructure': structure_PDB,
+                'generateMaskedVolume': False,
+                'cropMap': True
+                }
+        protRefmac = self.newProtocol(CCP4ProtRunRefmac, **args)
+        protRefmac.setObjLabel('NO MASK refmac refinement\n'
+                               'cropped map\n save model')
+        self.launchProtocol(protRefmac)
+        self.assertTrue(os.path.exists(protRefmac.outputPdb.getFileName()))
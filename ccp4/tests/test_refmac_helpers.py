@@ -0,0 +1,276 @@
+# ***************************************************************************
+# * Authors:    Roberto Marabini (roberto@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+
+# unit tests of the helpers of the refmac protocols, they do not need ccp4
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ccp4.protocols import protocol_refmac
+from ccp4.protocols.protocol_refmac import CCP4ProtRunRefmac, parseValueList
+from ccp4.tests.test_refmac_log_parser import refinementLog
+
+
+class TestParseValueList(unittest.TestCase):
+    """ lists of swept values"""
+    def testValues(self):
+        self.assertEqual(parseValueList("0.5, 1 2,,3"), [0.5, 1., 2., 3.])
+        self.assertEqual(parseValueList("  "), [])
+        self.assertEqual(parseValueList("10 20", int), [10, 20])
+
+    def testRanges(self):
+        self.assertEqual(parseValueList("10:40:10", int), [10, 20, 30, 40])
+        self.assertEqual(parseValueList("0.1:0.3:0.1"), [0.1, 0.2, 0.3])
+        self.assertEqual(parseValueList("5 1:2:1", int), [5, 1, 2])
+        self.assertEqual(parseValueList("3:3:1", int), [3])
+        self.assertEqual(parseValueList("4:3:1", int), [])
+
+    def testUnevenRanges(self):
+        """ values never go past stop"""
+        self.assertEqual(parseValueList("10:40:20", int), [10, 30])
+        self.assertEqual(parseValueList("1:2:0.6"), [1., 1.6])
+        self.assertEqual(parseValueList("0:1:0.3"), [0., 0.3, 0.6, 0.9])
+
+    def testInvalidRanges(self):
+        for text in ["1:5:0", "1:5:-1", "1:5", "a"]:
+            with self.assertRaises(ValueError):
+                parseValueList(text)
+
+
+def runProgram(program, args="", extraEnvDict=None, cwd=None):
+    """ stand-in of runCCP4Program, a program using 1 s of cpu and 64 MB"""
+    subprocess.check_call([sys.executable, '-c',
+                           'import time\n'
+                           'data = bytearray(64 * 2**20)\n'
+                           'start = time.process_time()\n'
+                           'while time.process_time() - start < 1: pass'])
+
+
+class TestScriptUsage(unittest.TestCase):
+    """ resources used by the programs of a script"""
+    def testScriptUsage(self):
+        prot = CCP4ProtRunRefmac()
+        with mock.patch.object(protocol_refmac, 'runCCP4Program',
+                               runProgram):
+            record = prot._runScriptUsage('/tmp/refine_refmac.sh', '/tmp',
+                                          None)
+        self.assertEqual(record['stage'], 'refine_refmac')
+        self.assertFalse(record['overlap'])
+        self.assertTrue(0.9 < record['cpu'] < 1.5)
+        self.assertTrue(record['wall'] >= 0.9)
+        self.assertTrue(record['maxrss'] >= 64)
+        self.assertEqual(prot._runningPrograms, [])
+
+    def testOverlappingScripts(self):
+        """ scripts run at the same time by steps running in parallel"""
+        prot = CCP4ProtRunRefmac()
+        records = []
+
+        def runScript():
+            records.append(prot._runScriptUsage('/tmp/map2mtz_refmac.sh',
+                                                '/tmp', None))
+
+        with mock.patch.object(protocol_refmac, 'runCCP4Program',
+                               runProgram):
+            threads = [threading.Thread(target=runScript)
+                       for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([record['overlap'] for record in records],
+                         [True, True])
+
+
+class TestChunkedRefinement(unittest.TestCase):
+    """ refinement in chunks of cycles, refmac is replaced by a function
+    that writes the log of a refinement with given R factors"""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.dataDict = {'PDBDIR': self.tmpDir, 'PDBFILE': 'model.pdb',
+                         'MAPFILE': 'map.mrc', 'RESOMIN': 200.,
+                         'RESOMAX': 3.5, 'NCYCLE': 6, 'WEIGHT MATRIX': 0.01,
+                         'BFACTOR_SET': 0., 'EXTRA_PARAMS': '',
+                         'PDBSET_NO_MASKED': 'model.pdb'}
+        # R factor of each cycle
+        self.rFactors = [0.30, 0.25, 0.22, 0.21, 0.205, 0.204, 0.2035]
+        self.chunks = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _runChunk(self, scriptFileName, cwd, template, dataDict):
+        first = sum(self.chunks)
+        self.chunks.append(dataDict['NCYCLE'])
+        with open(os.path.join(cwd, 'refine.log'), 'w') as f:
+            f.write(refinementLog(
+                self.rFactors[first:first + dataDict['NCYCLE'] + 1]))
+        with open(os.path.join(cwd, 'refmac-refined.pdb'), 'w') as f:
+            f.write("chunk %d\n" % len(self.chunks))
+
+    def _refine(self, prot, nCycles=6):
+        dataDict = dict(self.dataDict, NCYCLE=nCycles)
+        with mock.patch.object(prot, '_runMonitoredScript', self._runChunk):
+            prot._runChunkedRefinement(
+                os.path.join(self.tmpDir, 'refine_refmac.sh'), self.tmpDir,
+                "%(NCYCLE)s %(PDBSET_NO_MASKED)s", dataDict)
+
+    def _readOutput(self):
+        with open(os.path.join(self.tmpDir, 'refmac-refined.pdb')) as f:
+            return f.read()
+
+    def testChunks(self):
+        prot = CCP4ProtRunRefmac(generateMaskedVolume=False,
+                                 doCheckpoint=True, convergenceChunk=4)
+        self._refine(prot)
+        self.assertEqual(self.chunks, [4, 2])
+        self.assertEqual(self._readOutput(), "chunk 2\n")
+
+    def testNoCycles(self):
+        """ one chunk is refined even if no cycles are requested"""
+        prot = CCP4ProtRunRefmac(generateMaskedVolume=False,
+                                 doCheckpoint=True, convergenceChunk=4)
+        self._refine(prot, nCycles=0)
+        self.assertEqual(self.chunks, [1])
+        self.assertEqual(self._readOutput(), "chunk 1\n")
+
+    def _getCheckpointProt(self, **kwargs):
+        values = {'generateMaskedVolume': False, 'doCheckpoint': True,
+                  'convergenceChunk': 2}
+        values.update(kwargs)
+        return CCP4ProtRunRefmac(**values)
+
+    def testResume(self):
+        """ a refinement interrupted after its first chunk resumes from
+        the checkpoint"""
+        prot = self._getCheckpointProt()
+        runChunk = self._runChunk
+
+        def interruptedChunk(*args):
+            if self.chunks:
+                raise Exception("refmac killed")
+            runChunk(*args)
+
+        self._runChunk = interruptedChunk
+        self.assertRaises(Exception, self._refine, prot)
+        self._runChunk = runChunk
+        self.chunks = []
+        self._refine(self._getCheckpointProt())
+        # the second and third chunks, from the output of the first one
+        self.assertEqual(self.chunks, [2, 2])
+        self.assertEqual(self._readOutput(), "chunk 2\n")
+        with open(os.path.join(self.tmpDir, 'chunk_002_refine_refmac.sh')) \
+                as f:
+            self.assertEqual(f.read(), "2 refine_chunk_001.pdb")
+        # the log has the three chunks
+        with open(os.path.join(self.tmpDir, 'refine.log')) as f:
+            self.assertEqual(f.read().count("stats vs cycle"), 3)
+
+        # nothing is refined again
+        self.chunks = []
+        self._refine(self._getCheckpointProt())
+        self.assertEqual(self.chunks, [])
+
+    def testCheckpointKey(self):
+        """ checkpoints of other refinements are ignored"""
+        prot = self._getCheckpointProt()
+        self._refine(prot)
+        self.assertIsNotNone(prot._loadCheckpoint(
+            self.tmpDir, prot._getCheckpointKey(self.dataDict)))
+        for name, value in [('RESOMAX', 3.), ('NCYCLE', 8),
+                            ('WEIGHT MATRIX', 0.02)]:
+            self.assertIsNone(prot._loadCheckpoint(
+                self.tmpDir, prot._getCheckpointKey(
+                    dict(self.dataDict, **{name: value}))))
+        for kwargs in [{'convergenceChunk': 3}, {'doConvergence': True},
+                       {'convergenceRfact': 0.001}]:
+            self.assertIsNone(prot._loadCheckpoint(
+                self.tmpDir, self._getCheckpointProt(
+                    **kwargs)._getCheckpointKey(self.dataDict)))
+        # a refinement with another weight starts again
+        self.chunks = []
+        self._refine(self._getCheckpointProt())
+        self.assertEqual(self.chunks, [])
+        self.dataDict['WEIGHT MATRIX'] = 0.02
+        self._refine(self._getCheckpointProt())
+        self.assertEqual(self.chunks, [2, 2, 2])
+
+    def testInvalidCheckpoint(self):
+        """ corrupt checkpoints, or whose files are missing, are ignored"""
+        prot = self._getCheckpointProt()
+        self._refine(prot)
+        key = prot._getCheckpointKey(self.dataDict)
+        checkpointFileName = os.path.join(self.tmpDir, 'checkpoint.json')
+        with open(checkpointFileName) as f:
+            text = f.read()
+        for corrupt in [text[:len(text) // 2], "", "\0" * 10]:
+            with open(checkpointFileName, 'w') as f:
+                f.write(corrupt)
+            self.assertIsNone(prot._loadCheckpoint(self.tmpDir, key))
+        with open(checkpointFileName, 'w') as f:
+            f.write(text)
+        self.assertIsNotNone(prot._loadCheckpoint(self.tmpDir, key))
+        os.remove(os.path.join(self.tmpDir, 'refine_chunk_002.pdb'))
+        self.assertIsNone(prot._loadCheckpoint(self.tmpDir, key))
+        os.remove(checkpointFileName)
+        self.assertIsNone(prot._loadCheckpoint(self.tmpDir, key))
+
+    def testHasConverged(self):
+        """ R factor and FOM changes below the tolerances, rms BondLength
+        below the maximum"""
+        prot = CCP4ProtRunRefmac(convergenceRfact=0.002, convergenceFOM=0.005,
+                                 convergenceMaxRmsBond=0.025)
+        stats = {'Rfact': [0.2050, 0.2035], 'FOM': [0.850, 0.853],
+                 'rmsBOND': [0.010, 0.012]}
+        self.assertTrue(prot._hasConverged(stats))
+        for name, values, converged in [
+                ('Rfact', [0.2050, 0.2025], False),
+                ('Rfact', [0.2035, 0.2050], True),
+                ('Rfact', [0.2035, 0.2060], False),
+                ('FOM', [0.850, 0.856], False),
+                ('FOM', [0.853, 0.850], True),
+                ('rmsBOND', [0.030, 0.024], True),
+                ('rmsBOND', [0.010, 0.026], False),
+                ('Rfact', None, False),
+                ('FOM', None, False),
+                ('rmsBOND', None, False)]:
+            self.assertEqual(prot._hasConverged(dict(stats,
+                                                     **{name: values})),
+                             converged, "%s %s" % (name, values))
+
+    def testConvergence(self):
+        """ refinement stops after the first chunk that converges"""
+        prot = CCP4ProtRunRefmac(generateMaskedVolume=False,
+                                 doConvergence=True, convergenceChunk=2,
+                                 convergenceFOM=0.05)
+        self._refine(prot, nCycles=30)
+        # R factors 0.22 to 0.205 and 0.205 to 0.2035
+        self.assertEqual(self.chunks, [2, 2, 2])
+        self.assertEqual(self._readOutput(), "chunk 3\n")
@@ -0,0 +1,219 @@
+# ***************************************************************************
+# * Authors:    Roberto Marabini (roberto@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# unit tests of the refmac log parser, they use small synthetic logs and
+# do not need ccp4
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ccp4.protocols import refmac_log_parser
+from ccp4.protocols.refmac_log_parser import (RefmacLogParser,
+                                              RefineMonitor,
+                                              getRefmacLogParser)
+
+
+def cycleLog(cycle, rFactor):
+    """ per cycle table and summary written by refmac"""
+    lines = [" $TABLE: Cycle %d. M(Fom) v. resln :" % cycle,
+             " $GRAPHS: Cycle %d. M(Fom) v. resln :N:1,3,5: $$" % cycle,
+             " M_Fom resln Nrefl $$",
+             " $$",
+             "  0.8  10.0  100",
+             "  0.7   5.0  200",
+             " $$",
+             "",
+             "           Overall R factor                     = %0.4f"
+             % rFactor,
+             "           Free R factor                        = %0.4f"
+             % (rFactor + 0.01),
+             "           Rms BondLength                       = 0.0100"]
+    # the summary takes CYCLESUMMARYLINES lines
+    lines += [""] * (refmac_log_parser.CYCLESUMMARYLINES - 4)
+    return lines
+
+
+def refinementLog(rFactors, overflow=False):
+    """ log of a refinement with len(rFactors) - 1 cycles, the statistics
+    table has ***** in the -LL column if overflow is set"""
+    lines = []
+    for cycle, rFactor in enumerate(rFactors, 1):
+        lines += cycleLog(cycle, rFactor)
+    lines += [" $TABLE: Rfactor analysis, stats vs cycle  :",
+              " $GRAPHS:<Rfactor> vs cycle :N:1,2,3: $$",
+              " Ncyc    Rfact    Rfree     FOM      -LL     -LLfree  "
+              "rmsBOND  zBOND rmsANGL  zANGL rmsCHIRAL $$",
+              " $$"]
+    for n, rFactor in enumerate(rFactors):
+        ll = "*******" if overflow and n == 1 else "1000.0"
+        lines.append("  %d  %0.4f  %0.4f  %0.3f  %s  1010.0  0.0100  0.50 "
+                     "1.500  0.70  0.100" % (n, rFactor, rFactor + 0.01,
+                                             0.800 + 0.01 * n, ll))
+    lines += [" $$",
+              " $TEXT:Result: $$ Final results $$",
+              "                      Initial    Final",
+              "           R factor    %0.4f   %0.4f"
+              % (rFactors[0], rFactors[-1]),
+              "             R free    %0.4f   %0.4f"
+              % (rFactors[0] + 0.01, rFactors[-1] + 0.01),
+              "     Rms BondLength    0.0200   0.0100",
+              " $$"]
+    return "\n".join(lines) + "\n"
+
+
+class TestRefmacLogParser(unittest.TestCase):
+    """ parsing of refmac logs"""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.logFileName = os.path.join(self.tmpDir, 'refine.log')
+        self.cacheFileName = os.path.join(self.tmpDir, 'cache.json')
+        refmac_log_parser._parsers.clear()
+
+    def tearDown(self):
+        refmac_log_parser._parsers.clear()
+        shutil.rmtree(self.tmpDir)
+
+    def _writeLog(self, text, mode='w'):
+        with open(self.logFileName, mode) as f:
+            f.write(text)
+
+    def _parse(self):
+        parser = RefmacLogParser(self.logFileName)
+        parser.update()
+        return parser
+
+    def testParse(self):
+        self._writeLog(refinementLog([0.30, 0.28, 0.27]))
+        parser = self._parse()
+        stats = parser.getStatsVsCycle()
+        self.assertEqual(list(stats['Ncyc']), [0, 1, 2])
+        self.assertAlmostEqual(stats['Rfact'][-1], 0.27)
+        self.assertAlmostEqual(stats['FOM'][0], 0.80)
+        self.assertEqual(sorted(parser.cycleSummaries), [1, 2, 3])
+        self.assertEqual(parser.getCycleSummary(2)[0],
+                         ('Overall R factor', '0.2800'))
+        header, rows = parser.getFinalResults()
+        self.assertEqual(header, [" ", "Initial", "Final"])
+        self.assertEqual(rows[0], ('R factor', '0.3000', '0.2700'))
+        self.assertEqual(len(rows), 3)
+
+    def testResumeIncompleteLog(self):
+        """ a log read while refmac writes it (even in the middle of a
+        line) gives the same results as the whole log"""
+        text = refinementLog([0.30, 0.28, 0.27])
+        parser = RefmacLogParser(self.logFileName)
+        cut = len(text) // 2 + 3
+        self._writeLog(text[:cut])
+        self.assertTrue(parser.update())
+        self.assertIsNone(parser.getStatsVsCycle())
+        self.assertTrue(parser.offset <= cut)
+        self.assertEqual(text[parser.offset - 1], "\n")
+        self._writeLog(text[cut:], 'a')
+        self.assertTrue(parser.update())
+        self.assertFalse(parser.update())
+        whole = self._parse()
+        self.assertEqual(parser.cycleSummaries, whole.cycleSummaries)
+        self.assertEqual(list(parser.getStatsVsCycle()['Rfact']),
+                         list(whole.getStatsVsCycle()['Rfact']))
+        self.assertEqual(parser.getFinalResults(), whole.getFinalResults())
+
+    def testJoinRefinements(self):
+        """ logs of consecutive refinements (refmac chunks) are joined"""
+        self._writeLog(refinementLog([0.30, 0.28, 0.27]) +
+                       refinementLog([0.27, 0.26, 0.25, 0.24]))
+        parser = self._parse()
+        stats = parser.getStatsVsCycle()
+        self.assertEqual(list(stats['Ncyc']), list(range(6)))
+        self.assertEqual(["%0.2f" % r for r in stats['Rfact']],
+                         ["0.30", "0.28", "0.27", "0.26", "0.25", "0.24"])
+        # cycles 1 to 3 and 1 to 4, the last cycle of a refinement is the
+        # first one of the next refinement
+        self.assertEqual(sorted(parser.cycleSummaries), list(range(1, 7)))
+        self.assertEqual(parser.getCycleSummary(6)[0][1], '0.2400')
+        _, rows = parser.getFinalResults()
+        self.assertEqual(rows[0], ('R factor', '0.3000', '0.2400'))
+
+    def testOverflowedValues(self):
+        """ ***** values are read as nan"""
+        self._writeLog(refinementLog([0.30, 0.28, 0.27], overflow=True))
+        stats = self._parse().getStatsVsCycle()
+        self.assertEqual(len(stats), 3)
+        self.assertNotEqual(stats['-LL'][1], stats['-LL'][1])
+        self.assertAlmostEqual(stats['-LL'][2], 1000.0)
+        self.assertAlmostEqual(stats['Rfact'][1], 0.28)
+
+    def testSidecarCache(self):
+        """ a new process (no parser in memory) reads the results from
+        the sidecar file"""
+        self._writeLog(refinementLog([0.30, 0.28, 0.27]) +
+                       refinementLog([0.27, 0.26]))
+        parser = getRefmacLogParser(self.logFileName, self.cacheFileName)
+        self.assertTrue(os.path.exists(self.cacheFileName))
+        refmac_log_parser._parsers.clear()
+
+        cached = RefmacLogParser(self.logFileName)
+        self.assertTrue(cached.loadCache(self.cacheFileName))
+        self.assertEqual(cached.offset, os.path.getsize(self.logFileName))
+        self.assertEqual(list(cached.getStatsVsCycle()['Rfact']),
+                         list(parser.getStatsVsCycle()['Rfact']))
+        self.assertEqual(cached.cycleSummaries, parser.cycleSummaries)
+        self.assertEqual(cached.getFinalResults(), parser.getFinalResults())
+
+        # the memo is rebuilt from the sidecar, the log is not read
+        with open(self.cacheFileName) as f:
+            offset = json.load(f)['offset']
+        memo = getRefmacLogParser(self.logFileName, self.cacheFileName)
+        self.assertEqual(memo.offset, offset)
+        self.assertEqual(len(memo.getStatsVsCycle()), 4)
+
+        # lines appended after the cache are parsed
+        refmac_log_parser._parsers.clear()
+        self._writeLog(refinementLog([0.26, 0.25]), 'a')
+        self.assertFalse(RefmacLogParser(self.logFileName).loadCache(
+            self.cacheFileName))
+        updated = getRefmacLogParser(self.logFileName, self.cacheFileName)
+        self.assertEqual(len(updated.getStatsVsCycle()), 5)
+
+    def testMonitor(self):
+        """ cycles are reported once their summary has been written"""
+        lines = refinementLog([0.30, 0.28, 0.27, 0.26]).splitlines(True)
+        # log written up to the middle of the summary of cycle 2
+        cut = len(cycleLog(1, 0.30)) + 9
+        self._writeLog("".join(lines[:cut]))
+        progressFileName = os.path.join(self.tmpDir, 'progress.json')
+        monitor = RefineMonitor(self.logFileName, progressFileName, 3)
+        monitor.update()
+        self.assertEqual([c['cycle'] for c in monitor.cycles], [1])
+        self.assertEqual(monitor.getProgress(), 0.25)
+        self._writeLog("".join(lines[cut:]), 'a')
+        monitor.update(finished=True)
+        with open(progressFileName) as f:
+            progress = json.load(f)
+        self.assertTrue(progress['finished'])
+        self.assertEqual(progress['progress'], 1.)
+        self.assertEqual([c['cycle'] for c in progress['cycles']],
+                         [1, 2, 3, 4])
+        self.assertEqual(progress['cycles'][1]['Rfact'], 0.28)
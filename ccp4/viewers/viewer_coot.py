@@ -25,15 +25,14 @@
 # **************************************************************************
 
 import os
-import sqlite3
 
 from pwem import Domain
 from pwem.emlib.image import ImageHandler
 from pwem.viewers.viewer_chimera import Chimera
 from pyworkflow.viewer import DESKTOP_TKINTER, Viewer
 from ccp4.protocols.protocol_coot import (CootRefine, COOTPDBTEMPLATEFILENAME,
-                                          OUTPUTDATABASENAMESWITHLABELS,
-                                          DATABASETABLENAME)
+                                          OUTPUTDATABASENAMESWITHLABELS)
+from ccp4.protocols.coot_database import CootDataBase
 
 # TODO: very likely this should inherit from ProtocolViewer
 # not from XmippViewer. But then I get an empty form :-(
@@ -106,18 +105,12 @@ class CootRefineViewer(Viewer):
         # counter = 1
         # template = self.protocol._getExtraPath(COOTPDBTEMPLATEFILENAME)
         databasePath = self.protocol._getExtraPath(OUTPUTDATABASENAMESWITHLABELS)
-        conn = sqlite3.connect(databasePath)
-        c = conn.cursor()
-        sql = 'SELECT fileName FROM %s where saved = 1 order by id' % \
-              DATABASETABLENAME
-        c.execute(sql)
-        for row in c:
-            pdbFileName = os.path.abspath(row[0])
+        for pdbFileName in CootDataBase(databasePath).getSavedFileNames():
+            pdbFileName = os.path.abspath(pdbFileName)
             if not pdbFileName.endswith(".mrc"):
                 f.write("open %s\n" % pdbFileName)
 
         f.close()
-        conn.close()
         # run in the background
         chimeraPlugin = Domain.importFromPlugin('chimera', 'Plugin', doRaise=True)
         chimeraPlugin.runChimeraProgram(chimeraPlugin.getProgram(), fnCmd + "&")
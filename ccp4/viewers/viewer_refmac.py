@@ -35,6 +35,7 @@ from pwem.viewers import TableView
 from pyworkflow.gui.plotter import Plotter
 from pwem.viewers.viewer_chimera import Chimera
 from ccp4.protocols import CCP4ProtRunRefmac
+from ccp4.protocols.refmac_log_parser import getRefmacLogParser
 
 
 def errorWindow(tkParent, msg):
@@ -58,49 +59,23 @@ class ParseFile():
     MLLFREEPLOT = "-LLfreePlot"
     GEOMETRYPLOT = "GeometryPlot"
 
-    def __init__(self, fileName, tkParent=None, lastIteration=0):
+    def __init__(self, fileName, tkParent=None, lastIteration=0,
+                 cacheFileName=None):
         self.headerDict = {}  # parsed headers goes here
         self.dataDict = {}  # parsed data goes here
         self.msgDict = {}  # error messages goes here
         self.titleDict = {}  # titles go here
         self.tkParent = tkParent
         self.fileName = fileName
+        self.cacheFileName = cacheFileName  # sidecar file with parsed data
         self._parsefile(lastIteration) # last iteration
 
-    def _parseFinalResults(self, filePointer):
-        headerList = []
-        dataList = []
-        stop = False
+    def _parseFinalResults(self, logParser):
+        headerList, dataList = logParser.getFinalResults()
         msg = ""
-        while 1:
-            line = filePointer.readline()
-            if line.find('$TEXT:Result: $$ Final results $$') != -1:
-                # detect final results
-                break
-            if not line:
-                stop = True
-                break
-        if stop:
+        if not dataList:
             msg = 'Can not find "Final result" information in log file: %s' \
                   % self.fileName
-        else:
-            # finalResultsDict={'header':}
-            # parse header
-            headerList.append(" ")
-            line = filePointer.readline()
-            words = line.strip().split()
-            headerList.extend([words[0], words[1]])
-            # parse data: another 4 lines
-            for i in range(4):
-                row = []
-                line = filePointer.readline()
-                words = line.strip().split()
-                if words == ['$$']:
-                    break
-                # the first column has 2 words
-                row.extend([words[0] + " " + words[1], words[2], words[3]])
-                dataList.append(tuple(row))
-            # TODO: remove debug lines
         self.headerDict[self.FINALRESULTS] = headerList
         self.dataDict[self.FINALRESULTS] = dataList
         self.msgDict[self.FINALRESULTS] = msg
@@ -110,46 +85,14 @@ class ParseFile():
                self.dataDict[self.FINALRESULTS], \
                self.msgDict[self.FINALRESULTS]
 
-    def _parseLastIteration(self, filePointer, iteration):
+    def _parseLastIteration(self, logParser, iteration):
         headerList = ["variable", "value"]
-        dataList = []
-        stop = False
+        dataList = [tuple(row) for row in
+                    logParser.getCycleSummary(iteration)]
         msg = ""
-        while 1:
-            line = filePointer.readline()
-            # TODO: double check space after Cycle#Chequeado
-            if line.find('$GRAPHS:Cycle   %d. M(Fom) v. resln :'
-                         'N:1,3,5,7,8,9,10:' % iteration) != -1:
-                # detect final results
-                break
-            if not line:
-                stop = True
-                break
-        if stop:
+        if not dataList:
             msg = 'Can not find "Last Iteration" information in log file: %s' \
                   % self.fileName
-        else:
-            # find three lines with $$
-            counter = 4
-            while counter != 0:
-                line = filePointer.readline()
-                if line.find("$$") != -1:
-                    counter -= 1
-                if not line:
-                    stop = True
-                    break
-            if stop:
-                msg = 'Can not find "Last Iteration" information ' \
-                      'in log file: %s' % self.fileName
-
-            for i in range(14):
-                row = []
-                line = filePointer.readline()
-                words = line.strip().split("=")
-                # the first column has 2 words
-                if len(words)>1:
-                    row.extend([words[0].strip(), words[1].strip()])
-                    dataList.append(tuple(row))
         self.headerDict[self.LASTITERATIONRESULTS] = headerList
         self.dataDict[self.LASTITERATIONRESULTS] = dataList
         self.msgDict[self.LASTITERATIONRESULTS] = msg
@@ -160,83 +103,52 @@ class ParseFile():
                self.msgDict[self.LASTITERATIONRESULTS]
 
     # table parse cycle
-    def _parseFomPlot(self, filePointer, iteration):
+    def _parseFomPlot(self, logParser):
         # headerList = ["cycle", "fom"]  # x label,y1 label and so on
-        dataList = []  # each set of values in a different column
-        stop = False
         msg = ""
-        Ncyc = []
-        while 1:
-            line = filePointer.readline()
-            if line.find('Ncyc    Rfact    Rfree     FOM      -LL     '
-                         '-LLfree  rmsBOND  zBOND rmsANGL  zANGL '
-                         'rmsCHIRAL $$') != -1:
-                break
-            if not line:
-                stop = True
-                break
-        if stop:
+        stats = logParser.getStatsVsCycle()
+        if stats is None:
             msg = 'Can not find "stats vs cycle" information in log file: ' \
                   '%s' % self.fileName
-        else:
-            # skip one line
-            line = filePointer.readline()
-            #Ncyc = []
-            Rfact = []
-            Rfree = []
-            FOM = []
-            mLL = []
-            mLLfree = []
-            rmsBOND = []
-            zBOND = []
-            rmsANGL = []
-            zANGL = []
-            rmsCHIRAL = []
-
-            for i in range(iteration):
-                line = filePointer.readline()
-                words = line.strip().split()
-                # the first column has 2 words
-                Ncyc.append(int(words[0]))
-                Rfact.append(float(words[1]))
-                Rfree.append(float(words[2]))
-                FOM.append(float(words[3]))
-                mLL.append(float(words[4]))
-                mLLfree.append(float(words[5]))
-                rmsBOND.append(float(words[6]))
-                zBOND.append(float(words[7]))
-                rmsANGL.append(float(words[8]))
-                zANGL.append(float(words[9]))
-                rmsCHIRAL.append(float(words[10]))
-
-        if len(Ncyc) > 0 :
-            self.headerDict[self.FOMPLOT] = ["cycle", "fom"]
-            self.dataDict[self.FOMPLOT] = [Ncyc, FOM]
-            self.msgDict[self.FOMPLOT] = msg
-            self.titleDict[self.FOMPLOT] = "FOM vs Cycle"
-
-            self.headerDict[self.RFACTORPLOT] = ["cycle", "Rfact", "Rfree"]
-            self.dataDict[self.RFACTORPLOT] = [Ncyc, Rfact, Rfree]
-            self.msgDict[self.RFACTORPLOT] = msg
-            self.titleDict[self.RFACTORPLOT] = "Rfact and Rfree vs Cycle"
-
-            self.headerDict[self.MLLPLOT] = ["cycle", "mLL"]
-            self.dataDict[self.MLLPLOT] = [Ncyc, mLL]
-            self.msgDict[self.MLLPLOT] = msg
-            self.titleDict[self.MLLPLOT] = "-LL vs Cycle"
-
-            self.headerDict[self.MLLFREEPLOT] = ["cycle", "mLLfree"]
-            self.dataDict[self.MLLFREEPLOT] = [Ncyc, mLLfree]
-            self.msgDict[self.MLLFREEPLOT] = msg
-            self.titleDict[self.MLLFREEPLOT] = "-LLfree vs Cycle"
-
-            self.headerDict[self.GEOMETRYPLOT] = ["cycle", "rmsBOND", "zBOND",
-                                                  "rmsANGL", "zANGL", "rmsCHIRAL"]
-            self.dataDict[self.GEOMETRYPLOT] = [Ncyc, rmsBOND, zBOND, rmsANGL,
-                                                zANGL, rmsCHIRAL]
-            self.msgDict[self.GEOMETRYPLOT] = msg
-            self.titleDict[self.GEOMETRYPLOT] = "rmsBOND, zBOND, rmsANGL, zANGL " \
-                                                "and rmsCHIRAL vs Cycle"
+
+        self.headerDict[self.FOMPLOT] = ["cycle", "fom"]
+        self.dataDict[self.FOMPLOT] = self._columns(stats, 'Ncyc', 'FOM')
+        self.msgDict[self.FOMPLOT] = msg
+        self.titleDict[self.FOMPLOT] = "FOM vs Cycle"
+
+        self.headerDict[self.RFACTORPLOT] = ["cycle", "Rfact", "Rfree"]
+        self.dataDict[self.RFACTORPLOT] = self._columns(stats, 'Ncyc',
+                                                       'Rfact', 'Rfree')
+        self.msgDict[self.RFACTORPLOT] = msg
+        self.titleDict[self.RFACTORPLOT] = "Rfact and Rfree vs Cycle"
+
+        self.headerDict[self.MLLPLOT] = ["cycle", "mLL"]
+        self.dataDict[self.MLLPLOT] = self._columns(stats, 'Ncyc', '-LL')
+        self.msgDict[self.MLLPLOT] = msg
+        self.titleDict[self.MLLPLOT] = "-LL vs Cycle"
+
+        self.headerDict[self.MLLFREEPLOT] = ["cycle", "mLLfree"]
+        self.dataDict[self.MLLFREEPLOT] = self._columns(stats, 'Ncyc',
+                                                       '-LLfree')
+        self.msgDict[self.MLLFREEPLOT] = msg
+        self.titleDict[self.MLLFREEPLOT] = "-LLfree vs Cycle"
+
+        self.headerDict[self.GEOMETRYPLOT] = ["cycle", "rmsBOND", "zBOND",
+                                              "rmsANGL", "zANGL", "rmsCHIRAL"]
+        self.dataDict[self.GEOMETRYPLOT] = self._columns(stats, 'Ncyc', 'rmsBOND',
+                                                         'zBOND', 'rmsANGL',
+                                                         'zANGL', 'rmsCHIRAL')
+        self.msgDict[self.GEOMETRYPLOT] = msg
+        self.titleDict[self.GEOMETRYPLOT] = "rmsBOND, zBOND, rmsANGL, zANGL " \
+                                            "and rmsCHIRAL vs Cycle"
+
+    @staticmethod
+    def _columns(stats, *names):
+        """ columns of the stats vs cycle table. Each column is a view
+        of the parsed array, no copies are made"""
+        if stats is None:
+            return []
+        return [stats[name] for name in names]
 
     def retrieveFomPlot(self):
         return self.headerDict[self.FOMPLOT],\
@@ -269,20 +181,21 @@ class ParseFile():
                self.titleDict[self.GEOMETRYPLOT]
 
     def _parsefile(self, lastIteration=0):
-        """ call the different functions that parse the data in the
-        right order"""
+        """ parse the log file in a single pass. If the log has already
+        been parsed (by this process or saved in the sidecar cache file)
+        only the new lines are read"""
         if not os.path.exists(self.fileName):
             msg = "File %s is not available. Wait until protocol has " \
                   "finished" % self.fileName
-            errorWindow(self.getTkRoot(), msg)
+            errorWindow(self.tkParent, msg)
 
-        with open(self.fileName, "r") as filePointer:
-            # LASTITERATION
-            self._parseLastIteration(filePointer, lastIteration)
-            # RfactorPlot FOMPLOT, LLplot LLfreePLot GeometryPlot
-            self._parseFomPlot(filePointer, lastIteration)
-            # FINALRESULTS
-            self._parseFinalResults(filePointer)
+        logParser = getRefmacLogParser(self.fileName, self.cacheFileName)
+        # LASTITERATION
+        self._parseLastIteration(logParser, lastIteration)
+        # RfactorPlot FOMPLOT, LLplot LLfreePLot GeometryPlot
+        self._parseFomPlot(logParser)
+        # FINALRESULTS
+        self._parseFinalResults(logParser)
 
 
 class CCP4ProtRunRefmacViewer(ProtocolViewer):
@@ -298,10 +211,10 @@ class CCP4ProtRunRefmacViewer(ProtocolViewer):
     # than X tmpMetadataFile = 'viewersTmp.sqlite'
     def __init__(self,  **kwargs):
         ProtocolViewer.__init__(self,  **kwargs)
-        self.parseFile = ParseFile(self.protocol._getExtraPath(
-                                   self.protocol.refineLogFileName),
+        self.parseFile = ParseFile(self.protocol._getlogFileName(),
                                    self.getTkRoot(),
-                                   self.protocol.nRefCycle.get() + 1)
+                                   self.protocol._getLastCycle(),
+                                   self.protocol._getlogCacheFileName())
 
 
     def _checkProtocolHasEnded(self):